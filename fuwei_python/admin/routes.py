@@ -12,16 +12,19 @@ from models.doc_files.model import DocFiles
 from models.users.models import User, MobileUserRight
 from models.admin.model import AdminUser, AdminRights
 from models.cammand import cammand
-from models.ai_sug_score.model import AiSugScore
+from models.ai_sug_score.model import AiSugScore, AiValCache
 from models.lx_ai_sug_score.model import LxAiSugScore
 from common.aliOss import aliOss
+from common.aiLimiter import AiLimiter
+from common.aiBreaker import AiBreaker
+from models.queue.model import AiJobQueue
 import mammoth
 import markdownify
 from datetime import datetime
 import os
 import re
 import pandas as pd
-from common.zip import zip
+from common.zip import zip, ZipStream
 import subprocess
 from urllib.parse import urlparse
 import json
@@ -104,6 +107,29 @@ def models():
         data = request.json
         ModuleToModel.edit_one(data)
         return jsonify({'msg': '修改成功',"code":1}),200
+@admin.route('/model_limits', methods=['POST'])
+def modelLimits():
+    """
+    修改模型的限流配置，限额在每个进程内单独生效
+    """
+    data = request.json
+    limits = {}
+    for name in ['max_concurrency', 'rpm', 'tpm']:
+        try:
+            limits[name] = int(data.get(name) or 0)
+        except (TypeError, ValueError):
+            return jsonify({'msg': '限流配置必须是整数', "code": -1}), 200
+        if limits[name] < 0:
+            return jsonify({'msg': '限流配置不能小于0', "code": -1}), 200
+    if not Models.edit_limits(data['id'], limits):
+        return jsonify({'msg': '模型不存在', "code": -1}), 200
+    return jsonify({'msg': '修改成功', "code": 1}), 200
+@admin.route('/ai_limiter_stats', methods=['GET'])
+def aiLimiterStats():
+    """
+    当前web进程各模型的并发/排队、熔断情况，以及任务队列各状态的任务数
+    """
+    return jsonify({'msg': '', "code": 1, 'data': {'models': AiLimiter.get_stats(), 'breakers': AiBreaker.get_stats(), 'jobs': AiJobQueue.get_state_count()}}), 200
 @admin.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -504,6 +530,17 @@ def lxBatchDelete():
         LxAiSugScore.adminDeleteAiSugScore(id)
     return jsonify({'msg': '批量删除成功', "code": 1}), 200
 
+
+@admin.route('/ai_val_cache_purge', methods=['POST'])
+def aiValCachePurge():
+    """
+    清除评估结果缓存，传type时只清除该类型(0:缺陷 1:需求 20:立项文档分块压缩结果)的缓存
+    """
+    data = request.get_json(silent=True) or {}
+    record_type = data.get('type', None)
+    num = AiValCache.purge(None if record_type is None or record_type == "" else int(record_type))
+    return jsonify({'msg': f'已清除{num}条评估缓存', "code": 1}), 200
+
 '''
 移动用户就是管理员用户
 '''
@@ -659,26 +696,11 @@ def exportAiSugScore():
             data['回归测试'].append(item.step4)
             data['回归测试AI建议'].append(item.ai_step4)
             data['回归测试AI得分（满分10）'].append(item.step4_score)
-    tmpDatePath = f'./tmp/export/{datetime.now().strftime("%Y%m%d")}/'
-    tmpIdPath = tmpDatePath+f"_admin"
-    if not os.path.exists(tmpDatePath):
-        os.mkdir(tmpDatePath)
-    if not os.path.exists(tmpIdPath):
-        os.mkdir(tmpIdPath)
-    df = pd.DataFrame(data)
-    df_filled = df.astype(str).fillna('')
-    df_filled.to_excel(f"{tmpIdPath}/export.xlsx", index=False)
-    zip.zipDirectory(tmpIdPath,tmpDatePath+f'/admin_export.zip')
-    subprocess.run(f'rm -Rf {tmpIdPath}/*',shell=True)
-    def generate(file):
-        with open(file, 'rb') as f:
-            while True:
-                chunk = f.read(4096)  # 每次读取 4KB
-                if not chunk:
-                    subprocess.run(f'rm -Rf {file}', shell=True)
-                    break
-                yield chunk
-    return Response(generate(tmpDatePath+f'admin_export.zip'), mimetype='application/octet-stream',headers={'Content-Disposition': f'attachment;filename=admin_export.zip'})
+    def generate():
+        stream = ZipStream()
+        yield stream.add_workbook("export.xlsx", data)
+        yield stream.close()
+    return Response(generate(), mimetype='application/octet-stream',headers={'Content-Disposition': f'attachment;filename=admin_export.zip'})
 @admin.route('/admin_user', methods=['GET', 'POST'])
 def adUsers():
     act = request.values.get('act','list')
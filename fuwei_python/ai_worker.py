@@ -0,0 +1,44 @@
+"""
+AI评估任务worker
+用法(在 fuwei_python 目录下)：python ai_worker.py [进程数] [每个进程的线程数]
+进程数/线程数默认取 config.ini 的 ai_worker_processes / ai_worker_threads
+"""
+import sys
+import threading
+import time
+from multiprocessing import Process
+
+from conf.config import app_config
+
+
+def worker_process(thread_num):
+    from app import app
+    from conf.logger_config import setup_module_logger
+    from services.ai_job_service import AiJobService
+    setup_module_logger(app)
+    threads = []
+    for i in range(thread_num):
+        thread = threading.Thread(target=AiJobService.run_worker, daemon=True)
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    process_num = int(sys.argv[1]) if len(sys.argv) > 1 else int(app_config.get('ai_worker_processes', 2))
+    thread_num = int(sys.argv[2]) if len(sys.argv) > 2 else int(app_config.get('ai_worker_threads', 4))
+    processes = []
+    for i in range(process_num):
+        process = Process(target=worker_process, args=(thread_num,))
+        process.start()
+        processes.append(process)
+    # 守护worker进程，异常退出的重新拉起
+    while True:
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                print(f"worker进程{process.pid}已退出，重新启动")
+                process = Process(target=worker_process, args=(thread_num,))
+                process.start()
+                processes[i] = process
+        time.sleep(5)
@@ -0,0 +1,105 @@
+"""
+文档解析结果markdown拼接的微基准：合成一份500页的DocMind解析结果，
+对比原来逐块字符串相加+每块 re.match(字符串模式) 的写法和 DocMarkdownBuilder
+
+运行：python benchmarks/bench_doc_markdown.py [页数] [每页块数] [重复次数]
+"""
+import os
+import re
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.doc_markdown_builder import DocMarkdownBuilder
+
+IMAGE_SRC = "http://docmind-api-cn-hangzhou.oss-cn-hangzhou.aliyuncs.com/docmind/{}.png?Expires=1700000000&Signature=abc"
+
+
+def make_pages(pages, blocks):
+    """
+    合成解析结果：每页 blocks 块，每20块有一张图片，其余是标题、段落和表格
+    """
+    result = []
+    for page in range(pages):
+        datas = []
+        for block in range(blocks):
+            if block % 20 == 19:
+                content = f"![图{page}-{block}]({IMAGE_SRC.format(f'{page}-{block}')})\n"
+            elif block == 0:
+                content = f"## 第{page + 1}章 项目建设内容与技术方案\n\n"
+            elif block % 7 == 0:
+                content = "|指标|目标值|完成时间|\n|---|---|---|\n" + "|研发投入|1200万元|2026年12月|\n" * 6
+            else:
+                content = "本项目围绕核心业务场景开展关键技术攻关，形成可复制推广的解决方案。" * 4 + "\n\n"
+            datas.append({'markdownContent': content})
+        result.append(datas)
+    return result
+
+
+def legacy(pages, user_id=1):
+    """原 ai_deal 里的写法"""
+    mark_down_text = ""
+    image_url = {}
+    pattern = r'!\[(.*?)\]\((http://docmind-api-cn-hangzhou.oss-cn-hangzhou.aliyuncs.com.+?)\)'
+    tag = 0
+    for datas in pages:
+        for data in datas:
+            content = data['markdownContent']
+            match = re.match(pattern, content)
+            if match:
+                img_tag = str(int(time.time() * 100000)) + str(user_id) + str(tag)
+                image_url[f'[IMAGE_{img_tag}]'] = match.group(2)
+                content = f'[IMAGE_{img_tag}]'
+                tag = tag + 1
+            mark_down_text = mark_down_text + content
+    return mark_down_text, image_url
+
+
+def builder(pages, user_id=1):
+    """现在 ai_deal 里的写法"""
+    image_url = {}
+    tag_prefix = str(int(time.time() * 100000)) + str(user_id)
+
+    def on_image(src):
+        img_tag = f'[IMAGE_{tag_prefix}{len(image_url)}]'
+        image_url[img_tag] = src
+        return img_tag
+
+    markdown_builder = DocMarkdownBuilder(on_image)
+    for datas in pages:
+        markdown_builder.add_page(datas)
+    return markdown_builder.build(), image_url
+
+
+def peak_memory(func, pages):
+    tracemalloc.start()
+    func(pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    page_num = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    block_num = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    pages = make_pages(page_num, block_num)
+    legacy_text, legacy_urls = legacy(pages)
+    builder_text, builder_urls = builder(pages)
+    # 占位符编号不同，只比较替换后的结构
+    assert len(legacy_text.split("[IMAGE_")) == len(builder_text.split("[IMAGE_"))
+    assert sorted(legacy_urls.values()) == sorted(builder_urls.values())
+    print(f"{page_num}页，每页{block_num}块，markdown {round(len(builder_text) / 1024 / 1024, 2)}MB，图片{len(builder_urls)}张")
+    results = {}
+    for name, func in [('legacy', legacy), ('builder', builder)]:
+        seconds = min(timeit.repeat(lambda: func(pages), number=1, repeat=repeat))
+        results[name] = seconds
+        print(f"{name:8s} 最快{round(seconds * 1000, 1)}ms，峰值内存{round(peak_memory(func, pages) / 1024 / 1024, 2)}MB")
+    print(f"加速 {round(results['legacy'] / results['builder'], 2)}x")
+
+
+if __name__ == '__main__':
+    main()
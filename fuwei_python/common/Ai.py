@@ -1,20 +1,25 @@
 from flask import current_app
-from openai import OpenAI
 from models.model.model import Models
 import json
 from models.doc_files.model import DocFiles
 from models.ai_sug_score.model import AiSugScore
 from models.lx_ai_sug_score.model import LxAiSugScore
 import requests
+from openai import BadRequestError
 from conf.config import app_config
 from models.users.models import User
 from user.routes import getToken
+from common.aiClient import AiClient
+from common.aiLimiter import AiLimiter, AiLimiterTimeout
+from utils.stream_json_parser import StreamStepParser, StreamStepParseError
+from services.lx_map_reduce_service import LxMapReduceService
 
 class Ai():
+    # 不支持n参数的模型 (base_url, api_key, model_name)
+    n_unsupported = set()
     @staticmethod
     def get_answer_by_content(question="", content="", before_content=""):
         usingModel = Models.getUsingModel()
-        client = OpenAI(api_key=usingModel['api_key'], base_url= usingModel['base_url'])
         aiContent = f'''
         问题：{question}
         ####
@@ -24,7 +29,7 @@ class Ai():
         前几轮的问答:\n
         {before_content}
         '''
-        response = client.chat.completions.create(
+        response = AiClient.chat(usingModel,
             model= usingModel['model_name'],
             messages = [
                 {"role": "system", "content": "请根据给出的内容与之前几轮的问答回答问题，答案只能内容与前几轮的问答中查找！"},
@@ -35,14 +40,15 @@ class Ai():
         return response.choices[0].message.content
 
     @staticmethod
-    def get_score_suggestion(record_type, data, model=None):
-        print(f"model_name:{model['model_name']}")
-        client = OpenAI(api_key=model['api_key'], base_url= model['base_url'])
+    def get_score_messages(record_type, data):
+        """
+        缺陷/需求评估的提示词
+        :return: sys_content, user_content
+        """
         standard_file = DocFiles.getStandarFile(str(record_type))
         file_name = standard_file.file_name
         content = standard_file.markdown
         command = standard_file.cammand
-        print("大模型请求中。。")
         sys_content = f"""
         {command}
         #####
@@ -77,9 +83,16 @@ class Ai():
                 回归测试:
                 {data['step4']}
             """
+        return sys_content, user_content
+
+    @staticmethod
+    def get_score_suggestion(record_type, data, model=None):
+        print(f"model_name:{model['model_name']}")
+        sys_content, user_content = Ai.get_score_messages(record_type, data)
+        print("大模型请求中。。")
         response = None
         try:
-            response = client.chat.completions.create(
+            response = AiClient.chat(model,
                 model= model['model_name'],
                 messages = [
                     {"role": "system","content": sys_content},
@@ -99,18 +112,12 @@ class Ai():
                 current_app.logger.info_module(f"respones:{response.content.decode('utf-8')}","model")
             data['state'] = -3
             data['error_message'] = "请求超时"
+            # 本进程限流排队超时，不算模型接口故障
+            data['limited'] = isinstance(e, AiLimiterTimeout)
             return data
         try:
             content = response.choices[0].message.content
-            matches =  Ai.extract_balanced_braces(content)
-            dic_result = json.loads(matches[0])
-            for v in  AiSugScore.columnStep:
-                data['ai_'+v] = f"""<b>评估依据：</b>
-                {dic_result[v]["evaluate"]}<br>
-                <b>改进建议：</b>
-                {dic_result[v]["suggestion"]}
-                """
-                data[v+'_score'] = dic_result[v]["score"]
+            Ai.parse_score_content(data, content)
             data['state'] = 1
         except Exception as e:
             current_app.logger.info_module(f"评估失败异常-get_score_suggestion:{e},文件：{e.__traceback__.tb_frame.f_globals['__file__']};行数：{e.__traceback__.tb_lineno}",'model')
@@ -121,6 +128,134 @@ class Ai():
         data['model_name'] = model['name']
         return data
 
+    @staticmethod
+    def parse_score_content(data, content):
+        """
+        解析大模型回复里的评估结果写入data，格式错误时抛出异常
+        """
+        matches =  Ai.extract_balanced_braces(content)
+        dic_result = json.loads(matches[0])
+        for v in  AiSugScore.columnStep:
+            Ai.set_step_result(data, v, dic_result[v])
+
+    @staticmethod
+    def get_score_suggestions_n(record_type, data, model, n, timeout=600):
+        """
+        一次请求返回n个采样结果(chat.completions 的 n 参数)，防抖时只需要处理一次提示词
+        接口不支持n参数(参数错误或者返回的结果数不足)时返回None，由调用方改为并发请求，
+        不支持的模型在进程内记住，之后不再尝试；超时、连接失败等请求异常直接抛出，由调用方记入熔断
+        :return: n个和 get_score_suggestion 返回值一样的结果，或者None
+        """
+        key = AiClient.get_key(model)
+        if key in Ai.n_unsupported:
+            return None
+        print(f"model_name:{model['model_name']},n:{n}")
+        sys_content, user_content = Ai.get_score_messages(record_type, data)
+        try:
+            response = AiClient.chat(model,
+                model= model['model_name'],
+                messages = [
+                    {"role": "system","content": sys_content},
+                    {"role": "user", "content": user_content},
+                ],
+                timeout=timeout,
+                stream=False,
+                temperature=0.2,
+                top_p=0.4,
+                n=n,
+            )
+        except BadRequestError as e:
+            current_app.logger.info_module(f"模型{model['model_name']}不支持n参数，改为并发请求：{e}", "model")
+            Ai.n_unsupported.add(key)
+            return None
+        if len(response.choices) < n:
+            current_app.logger.info_module(f"模型{model['model_name']}不支持n参数，返回{len(response.choices)}个结果，改为并发请求", "model")
+            Ai.n_unsupported.add(key)
+            return None
+        results = []
+        for choice in response.choices:
+            result = dict(data)
+            try:
+                Ai.parse_score_content(result, choice.message.content)
+                result['state'] = 1
+            except Exception as e:
+                current_app.logger.info_module(f"评估失败异常-get_score_suggestions_n:{e},返回内容：{choice.message.content}", 'model')
+                result['state'] = -4
+                result['error_message'] = "返回数据错误：" + str(choice.message.content)
+            result['model_name'] = model['name']
+            results.append(result)
+        return results
+
+    @staticmethod
+    def set_step_result(data, step, result):
+        data['ai_'+step] = f"""<b>评估依据：</b>
+                {result["evaluate"]}<br>
+                <b>改进建议：</b>
+                {result["suggestion"]}
+                """
+        data[step+'_score'] = result["score"]
+
+    @staticmethod
+    def get_score_suggestion_stream(record_type, data, model, on_step=None):
+        """
+        流式评估：边接收边解析，每个步骤的结果一闭合就写入data并回调on_step(step, data)
+        结构错误时立即中断，只有部分步骤成功时只针对缺少的步骤再请求一次
+        返回的data和 get_score_suggestion 一致
+        """
+        print(f"model_name:{model['model_name']}")
+        sys_content, user_content = Ai.get_score_messages(record_type, data)
+        data['model_name'] = model['name']
+        done = {}
+        error_message = ""
+        request_failed = False
+        for attempt in range(2):
+            missing = [step for step in AiSugScore.columnStep if step not in done]
+            if len(missing) == 0:
+                break
+            content = user_content
+            if attempt > 0:
+                content = f"""{user_content}
+                ######
+                只需要返回{','.join(missing)}的评估结果，格式不变
+                """
+            parser = StreamStepParser(missing)
+            try:
+                for delta in AiClient.chat_stream(model,
+                    model= model['model_name'],
+                    messages = [
+                        {"role": "system","content": sys_content},
+                        {"role": "user", "content": content},
+                    ],
+                    timeout=600,
+                    temperature=0.2,
+                    top_p=0.4,
+                ):
+                    for step, result in parser.feed(delta):
+                        done[step] = result
+                        Ai.set_step_result(data, step, result)
+                        if on_step is not None:
+                            on_step(step, data)
+                request_failed = False
+            except StreamStepParseError as e:
+                current_app.logger.info_module(f"评估失败异常-get_score_suggestion_stream-{model['model_name']}：结构错误，提前中断：{e}", "model")
+                error_message = f"返回数据错误：{e}"
+            except Exception as e:
+                current_app.logger.info_module(f"评估失败异常-get_score_suggestion_stream-{model['model_name']}：{e}", "model")
+                error_message = "请求超时"
+                request_failed = True
+                data['limited'] = isinstance(e, AiLimiterTimeout)
+            else:
+                if len(parser.get_missing()) > 0:
+                    error_message = f"返回数据错误：缺少{','.join(parser.get_missing())}"
+            if request_failed and len(done) == 0:
+                break
+        if len(done) == len(AiSugScore.columnStep):
+            data['state'] = 1
+        else:
+            data['state'] = -3 if request_failed else -4
+            data['error_message'] = error_message
+        return data
+
     @staticmethod
     def get_xjqw_score_suggestion(data, model=None, record_type=0):
         data['model_name'] = model['name']
@@ -134,12 +269,13 @@ class Ai():
                 "Authorization": "Bearer token123"
             }
             response = None
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=600
-            )
+            with AiLimiter.limit(model):
+                response = requests.post(
+                    url,
+                    json=payload,
+                    headers=headers,
+                    timeout=600
+                )
             dic_result = response.json()
         except Exception as e:
             current_app.logger.info_module(f"评估失败异常-get_xjqw_score_suggestion-1：{e},文件：{e.__traceback__.tb_frame.f_globals['__file__']};行数：{e.__traceback__.tb_lineno}","model")
@@ -147,6 +283,7 @@ class Ai():
                 current_app.logger.info_module(f"respones:{response.content.decode('utf-8')}","model")
             data['state'] = -3
             data['error_message'] =  f"请求接口失败"
+            data['limited'] = isinstance(e, AiLimiterTimeout)
             return data
         try:
             if dic_result['erro_code']== 0:
@@ -172,17 +309,18 @@ class Ai():
 
     @staticmethod
     def get_lx_content_score_suggestion(record_type, data,model, t=0, error_mess="")->{}:
-        client = OpenAI(api_key=model['api_key'], base_url= model['base_url'])
         standard_file = DocFiles.getStandarFile(record_type, data['child_type_1'], data['child_type_2'], data['stepNum'])#总结
         content0 = standard_file.markdown_content #内容
         content1 = standard_file.markdown #评估
         command = standard_file.cammand
         print("大模型请求中getLxContentScoreSuggestion。。")
+        # 超长文档先分块压缩
+        markdown = LxMapReduceService.condense(data['markdown'], model)
         user_content = f"""
         {command}
         ###
         附件1内容：
-        {data['markdown']}
+        {markdown}
         ###
         附件2的内容：
         {content0}
@@ -196,7 +334,7 @@ class Ai():
         ai_return = {}
         response = None
         try:
-            response = client.chat.completions.create(
+            response = AiClient.chat(model,
                 model= model['model_name'],
                 messages = [
                     {"role": "user", "content": user_content},
@@ -236,10 +374,10 @@ class Ai():
     @staticmethod
     def get_summarize(ArticelContent, t=0):
         usingModel = Models.getUsingModel()
-        client = OpenAI(api_key=usingModel['api_key'], base_url= usingModel['base_url'])
         StandarFile = DocFiles.getStandarFile("2", 100, 1)
         cammand = StandarFile.cammand
         print("大模型请求中getSummarize。。")
+        ArticelContent = LxMapReduceService.condense(ArticelContent, usingModel)
         user_content = f"""
         {cammand}
         ####
@@ -250,7 +388,7 @@ class Ai():
         state = 1
         response = None
         try:
-            response = client.chat.completions.create(
+            response = AiClient.chat(usingModel,
                 model= usingModel['model_name'],
                 messages = [
                     {"role": "user", "content": user_content},
@@ -278,10 +416,10 @@ class Ai():
     @staticmethod
     def get_xmind(ArticelContent, error_mess='', t=0):
         usingModel = Models.getQwPlus()
-        client = OpenAI(api_key=usingModel['api_key'], base_url= usingModel['base_url'])
         StandarFile = DocFiles.getStandarFile("2", 100, 2)
         cammand = StandarFile.cammand
         print(f"大模型请求中xmind{t}。。")
+        ArticelContent = LxMapReduceService.condense(ArticelContent, usingModel)
         system_content = f"""
             {cammand}
         """
@@ -293,7 +431,7 @@ class Ai():
         state = 1
         response = None
         try:
-            response = client.chat.completions.create(
+            response = AiClient.chat(usingModel,
                 model= usingModel['model_name'],
                 messages = [
                     {"role": "system", "content": system_content},
@@ -354,12 +492,11 @@ class Ai():
                         {user_content}
                         """
         usingModel = Models.getUsingModel()
-        client = OpenAI(api_key=usingModel['api_key'], base_url= usingModel['base_url'])
         state = 1
         response = None
         aiReturn = {}
         try:
-            response = client.chat.completions.create(
+            response = AiClient.chat(usingModel,
                 model= usingModel['model_name'],
                 messages = [
                     {"role": "user", "content": user_content},
@@ -407,8 +544,7 @@ class Ai():
         {question}
         '''
         usingModel = Models.getUsingModel()
-        client = OpenAI(api_key=usingModel['api_key'], base_url= usingModel['base_url'])
-        response = client.chat.completions.create(
+        response = AiClient.chat(usingModel,
             model= usingModel['model_name'],
             messages = [
                 {"role": "system", "content":sys_content},
@@ -453,9 +589,8 @@ class Ai():
         {command}
         """
         using_model = Models.getUsingModel()
-        client = OpenAI(api_key=using_model['api_key'], base_url= using_model['base_url'])
         try:
-            response = client.chat.completions.create(
+            response = AiClient.chat(using_model,
                 model= using_model['model_name'],
                 messages = [
                     {"role": "user", "content": user_content},
@@ -0,0 +1,163 @@
+import math
+import threading
+import time
+from collections import deque
+
+from conf.config import app_config
+
+
+class AiBreaker():
+    """
+    按模型统计最近的请求耗时和失败情况，用于对冲请求的延迟计算和熔断
+    最近 ai_breaker_window 次请求里失败率达到 ai_breaker_error_rate，
+    或者p95耗时超过 ai_breaker_slow_seconds 时熔断 ai_breaker_open_seconds 秒，
+    熔断结束后先放行一个探测请求，成功才恢复；探测请求超过 ai_breaker_probe_seconds 秒没有结果时再放行一个
+    调用方 allow 返回True后必须调用 record 或 release，否则半开状态会一直等待探测结果
+    统计在每个进程内单独计算
+    """
+    _lock = threading.Lock()
+    _states = {}
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    @staticmethod
+    def get_config():
+        return {
+            'window': int(app_config.get('ai_breaker_window', 20)),
+            'min_calls': int(app_config.get('ai_breaker_min_calls', 5)),
+            'error_rate': float(app_config.get('ai_breaker_error_rate', 0.5)),
+            'slow_seconds': float(app_config.get('ai_breaker_slow_seconds', 300)),
+            'open_seconds': float(app_config.get('ai_breaker_open_seconds', 60)),
+            'probe_seconds': float(app_config.get('ai_breaker_probe_seconds', 660)),
+        }
+
+    @staticmethod
+    def get_key(model):
+        if model.get('id'):
+            return str(model['id'])
+        return f"{model.get('base_url', '')}|{model.get('model_name', '')}"
+
+    @staticmethod
+    def get_state(model):
+        key = AiBreaker.get_key(model)
+        with AiBreaker._lock:
+            state = AiBreaker._states.get(key)
+            if state is None:
+                state = {
+                    'name': model.get('name', key),
+                    'calls': deque(maxlen=AiBreaker.get_config()['window']),
+                    'status': AiBreaker.CLOSED,
+                    'open_until': 0,
+                    'probing': False,
+                    'probe_time': 0,
+                }
+                AiBreaker._states[key] = state
+        return state
+
+    @staticmethod
+    def allow(model):
+        """
+        是否允许向该模型发请求，半开状态只放行一个探测请求
+        """
+        state = AiBreaker.get_state(model)
+        with AiBreaker._lock:
+            if state['status'] == AiBreaker.CLOSED:
+                return True
+            if state['status'] == AiBreaker.OPEN:
+                if time.time() < state['open_until']:
+                    return False
+                state['status'] = AiBreaker.HALF_OPEN
+                state['probing'] = False
+            if state['probing'] and time.time() - state['probe_time'] < AiBreaker.get_config()['probe_seconds']:
+                return False
+            state['probing'] = True
+            state['probe_time'] = time.time()
+            return True
+
+    @staticmethod
+    def is_closed(model):
+        """
+        是否正常状态，只查看状态，不占用半开状态的探测名额
+        """
+        state = AiBreaker.get_state(model)
+        with AiBreaker._lock:
+            return state['status'] == AiBreaker.CLOSED
+
+    @staticmethod
+    def release(model):
+        """
+        allow 之后请求没有真正发到模型(如本进程排队超时)，不记录结果，只交还探测名额
+        """
+        state = AiBreaker.get_state(model)
+        with AiBreaker._lock:
+            if state['status'] == AiBreaker.HALF_OPEN:
+                state['probing'] = False
+
+    @staticmethod
+    def record(model, ok, seconds):
+        """
+        记录一次请求结果
+        :param ok: 是否成功
+        :param seconds: 耗时
+        """
+        config = AiBreaker.get_config()
+        state = AiBreaker.get_state(model)
+        with AiBreaker._lock:
+            state['calls'].append((ok, seconds))
+            if state['status'] == AiBreaker.HALF_OPEN:
+                state['probing'] = False
+                if ok:
+                    state['status'] = AiBreaker.CLOSED
+                    state['calls'].clear()
+                else:
+                    AiBreaker.trip(state, config)
+                return
+            calls = list(state['calls'])
+            if len(calls) < config['min_calls']:
+                return
+            errors = len([call for call in calls if not call[0]])
+            if errors / len(calls) >= config['error_rate'] or AiBreaker.percentile([call[1] for call in calls], 95) > config['slow_seconds']:
+                AiBreaker.trip(state, config)
+
+    @staticmethod
+    def trip(state, config):
+        state['status'] = AiBreaker.OPEN
+        state['open_until'] = time.time() + config['open_seconds']
+        print(f"模型{state['name']}熔断{config['open_seconds']}秒")
+
+    @staticmethod
+    def percentile(values, p):
+        if len(values) == 0:
+            return 0
+        values = sorted(values)
+        index = max(0, math.ceil(len(values) * p / 100) - 1)
+        return values[index]
+
+    @staticmethod
+    def get_p95(model):
+        """
+        最近成功请求耗时的p95，没有记录时返回None
+        """
+        state = AiBreaker.get_state(model)
+        with AiBreaker._lock:
+            seconds = [call[1] for call in state['calls'] if call[0]]
+        if len(seconds) == 0:
+            return None
+        return AiBreaker.percentile(seconds, 95)
+
+    @staticmethod
+    def get_stats():
+        stats = []
+        with AiBreaker._lock:
+            for key, state in AiBreaker._states.items():
+                calls = list(state['calls'])
+                stats.append({
+                    'key': key,
+                    'name': state['name'],
+                    'status': state['status'],
+                    'calls': len(calls),
+                    'errors': len([call for call in calls if not call[0]]),
+                    'p95_seconds': round(AiBreaker.percentile([call[1] for call in calls if call[0]], 95), 3),
+                })
+        return stats
@@ -0,0 +1,99 @@
+import threading
+
+import httpx
+from openai import OpenAI
+
+from common.aiLimiter import AiLimiter
+from conf.config import app_config
+
+
+class AiClient():
+    """
+    进程级的大模型客户端注册表
+    按模型配置(base_url, api_key, model_name)缓存 OpenAI 客户端，客户端底层共用一个 keep-alive 的 httpx 连接池，
+    避免每次评估都重新建立 TLS 连接；模型配置修改后调用 invalidate 让客户端失效
+    """
+    _lock = threading.Lock()
+    _clients = {}
+    # 失效的客户端延迟关闭，让正在进行中的请求(最长600秒)可以正常结束
+    CLOSE_DELAY = 660
+
+    @staticmethod
+    def get_key(model):
+        return model['base_url'], model['api_key'], model['model_name']
+
+    @staticmethod
+    def get_http_client():
+        limits = httpx.Limits(
+            max_connections=int(app_config.get('ai_pool_max_connections', 100)),
+            max_keepalive_connections=int(app_config.get('ai_pool_max_keepalive', 20)),
+            keepalive_expiry=float(app_config.get('ai_pool_keepalive_expiry', 120)),
+        )
+        return httpx.Client(limits=limits)
+
+    @staticmethod
+    def get_client(model) -> OpenAI:
+        """
+        获取模型对应的长连接客户端
+        :param model: Models 配置字典，至少包含 base_url, api_key, model_name
+        :return:
+        """
+        key = AiClient.get_key(model)
+        client = AiClient._clients.get(key)
+        if client is not None:
+            return client
+        with AiClient._lock:
+            client = AiClient._clients.get(key)
+            if client is None:
+                client = OpenAI(api_key=model['api_key'], base_url=model['base_url'], http_client=AiClient.get_http_client())
+                AiClient._clients[key] = client
+        return client
+
+    @staticmethod
+    def chat(model, **kwargs):
+        """
+        经过 AiLimiter 限流的 chat.completions.create
+        :param model: Models 配置字典
+        :param kwargs: chat.completions.create 的参数
+        :return:
+        """
+        tokens = AiLimiter.estimate_tokens(kwargs.get('messages', []), kwargs.get('n', 1))
+        with AiLimiter.limit(model, tokens) as usage:
+            response = AiClient.get_client(model).chat.completions.create(**kwargs)
+            if getattr(response, 'usage', None) is not None:
+                usage['tokens'] = response.usage.total_tokens
+            return response
+
+    @staticmethod
+    def chat_stream(model, **kwargs):
+        """
+        流式的 chat.completions.create，逐段返回回复内容，接收期间一直占用限流名额
+        """
+        tokens = AiLimiter.estimate_tokens(kwargs.get('messages', []))
+        with AiLimiter.limit(model, tokens):
+            response = AiClient.get_client(model).chat.completions.create(stream=True, **kwargs)
+            try:
+                for chunk in response:
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                response.close()
+
+    @staticmethod
+    def invalidate(model=None):
+        """
+        让客户端失效，model为None时全部失效
+        :param model:
+        :return:
+        """
+        with AiClient._lock:
+            if model is None:
+                clients = list(AiClient._clients.values())
+                AiClient._clients.clear()
+            else:
+                client = AiClient._clients.pop(AiClient.get_key(model), None)
+                clients = [client] if client is not None else []
+        for client in clients:
+            timer = threading.Timer(AiClient.CLOSE_DELAY, client.close)
+            timer.daemon = True
+            timer.start()
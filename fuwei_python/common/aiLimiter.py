@@ -0,0 +1,216 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from conf.config import app_config
+
+
+class AiLimiterTimeout(TimeoutError):
+    """本进程内排队超时，请求没有发到模型接口，不算模型故障"""
+
+
+class AiLimiter():
+    """
+    按模型限制大模型请求：最大并发数、每分钟请求数(rpm)、每分钟token数(tpm)
+    限额取 Models 表的 max_concurrency / rpm / tpm，为0时不限制
+    超出限额的请求按到达顺序排队，排队超过 ai_limiter_wait_timeout 秒抛出异常
+    令牌桶和排队在每个进程(web进程、ai_worker进程)内，配置的限额是所有进程共用的总额，
+    按 get_processes 的进程数平均分给每个进程，各进程合计不超过配置值
+    限额在后台“模型选择”页面修改，下一次请求即按新配置生效
+    """
+    _lock = threading.Lock()
+    _states = {}
+    # 单次请求的输出token预估，请求结束后按实际用量修正
+    COMPLETION_TOKENS = 2000
+
+    @staticmethod
+    def get_key(model):
+        if model.get('id'):
+            return str(model['id'])
+        return f"{model.get('base_url', '')}|{model.get('model_name', '')}"
+
+    @staticmethod
+    def get_processes():
+        """
+        共用模型限额的进程数：ai_limiter_processes，
+        没有配置时是 ai_worker_processes(worker进程数) + web_processes(web进程数)
+        """
+        processes = app_config.get('ai_limiter_processes')
+        if processes is None:
+            processes = int(app_config.get('ai_worker_processes', 2)) + int(app_config.get('web_processes', 1))
+        return max(1, int(processes))
+
+    @staticmethod
+    def get_limits(model):
+        """
+        本进程分到的限额，配置了限额的每个进程至少分到1
+        """
+        processes = AiLimiter.get_processes()
+
+        def share(value):
+            value = int(value or 0)
+            return 0 if value <= 0 else max(1, value // processes)
+        return {
+            'max_concurrency': share(model.get('max_concurrency')),
+            'rpm': share(model.get('rpm')),
+            'tpm': share(model.get('tpm')),
+        }
+
+    @staticmethod
+    def get_state(model):
+        key = AiLimiter.get_key(model)
+        state = AiLimiter._states.get(key)
+        if state is not None:
+            return state
+        with AiLimiter._lock:
+            state = AiLimiter._states.get(key)
+            if state is None:
+                state = {
+                    'name': model.get('name', key),
+                    'cond': threading.Condition(),
+                    'queue': deque(),
+                    'in_flight': 0,
+                    'request_bucket': None,
+                    'token_bucket': None,
+                    'refill_time': time.monotonic(),
+                    'limits': AiLimiter.get_limits(model),
+                    'total': 0,
+                    'timeout': 0,
+                    'wait_seconds': 0.0,
+                    'max_wait_seconds': 0.0,
+                }
+                AiLimiter._states[key] = state
+        return state
+
+    @staticmethod
+    def estimate_tokens(messages, n=1):
+        """
+        按字符数粗略估算token数，中文一个字约一个token
+        :param n: 一次请求返回的结果数(chat.completions 的 n 参数)，每个结果都要输出
+        """
+        length = 0
+        for message in messages:
+            length = length + len(str(message.get('content', '')))
+        return length + AiLimiter.COMPLETION_TOKENS * max(1, int(n or 1))
+
+    @staticmethod
+    def refill(state):
+        """
+        令牌桶按每分钟的额度匀速补充，桶容量就是每分钟的额度
+        """
+        limits = state['limits']
+        now = time.monotonic()
+        elapsed = now - state['refill_time']
+        state['refill_time'] = now
+        if limits['rpm'] > 0:
+            if state['request_bucket'] is None:
+                state['request_bucket'] = float(limits['rpm'])
+            state['request_bucket'] = min(float(limits['rpm']), state['request_bucket'] + elapsed * limits['rpm'] / 60)
+        if limits['tpm'] > 0:
+            if state['token_bucket'] is None:
+                state['token_bucket'] = float(limits['tpm'])
+            state['token_bucket'] = min(float(limits['tpm']), state['token_bucket'] + elapsed * limits['tpm'] / 60)
+
+    @staticmethod
+    def get_wait(state, tokens):
+        """
+        返回还需要等待的秒数，0表示现在就可以发起请求
+        """
+        limits = state['limits']
+        wait = 0.0
+        if limits['max_concurrency'] > 0 and state['in_flight'] >= limits['max_concurrency']:
+            # 等待其他请求结束时的唤醒
+            wait = 1.0
+        if limits['rpm'] > 0 and state['request_bucket'] < 1:
+            wait = max(wait, (1 - state['request_bucket']) * 60 / limits['rpm'])
+        if limits['tpm'] > 0:
+            need = min(tokens, limits['tpm'])
+            if state['token_bucket'] < need:
+                wait = max(wait, (need - state['token_bucket']) * 60 / limits['tpm'])
+        return wait
+
+    @staticmethod
+    def acquire(model, tokens=0):
+        state = AiLimiter.get_state(model)
+        timeout = float(app_config.get('ai_limiter_wait_timeout', 600))
+        ticket = object()
+        start = time.monotonic()
+        with state['cond']:
+            state['limits'] = AiLimiter.get_limits(model)
+            state['queue'].append(ticket)
+            try:
+                while True:
+                    AiLimiter.refill(state)
+                    wait = AiLimiter.get_wait(state, tokens)
+                    if state['queue'][0] is ticket and wait == 0:
+                        break
+                    if time.monotonic() - start > timeout:
+                        state['timeout'] = state['timeout'] + 1
+                        raise AiLimiterTimeout(f"模型{state['name']}排队超时")
+                    # 不是队首时等待前面的请求被放行
+                    state['cond'].wait(min(wait, 1.0) if wait > 0 else 1.0)
+            finally:
+                state['queue'].remove(ticket)
+                state['cond'].notify_all()
+            state['in_flight'] = state['in_flight'] + 1
+            if state['request_bucket'] is not None:
+                state['request_bucket'] = state['request_bucket'] - 1
+            if state['token_bucket'] is not None:
+                state['token_bucket'] = state['token_bucket'] - min(tokens, state['limits']['tpm'])
+            wait_seconds = time.monotonic() - start
+            state['total'] = state['total'] + 1
+            state['wait_seconds'] = state['wait_seconds'] + wait_seconds
+            state['max_wait_seconds'] = max(state['max_wait_seconds'], wait_seconds)
+
+    @staticmethod
+    def release(model, tokens=0, used_tokens=None):
+        """
+        :param tokens: acquire时预估的token数
+        :param used_tokens: 实际用量，有的话按差额修正令牌桶
+        """
+        state = AiLimiter.get_state(model)
+        with state['cond']:
+            state['in_flight'] = state['in_flight'] - 1
+            if used_tokens is not None and state['token_bucket'] is not None:
+                state['token_bucket'] = state['token_bucket'] - (used_tokens - min(tokens, state['limits']['tpm']))
+            state['cond'].notify_all()
+
+    @staticmethod
+    @contextmanager
+    def limit(model, tokens=0):
+        """
+        with AiLimiter.limit(model, tokens) as usage:
+            ...
+            usage['tokens'] = 实际用量
+        """
+        AiLimiter.acquire(model, tokens)
+        usage = {'tokens': None}
+        try:
+            yield usage
+        finally:
+            AiLimiter.release(model, tokens, usage['tokens'])
+
+    @staticmethod
+    def get_stats():
+        """
+        当前进程各模型的排队情况，limits 是本进程分到的限额
+        """
+        stats = []
+        for key, state in list(AiLimiter._states.items()):
+            with state['cond']:
+                stats.append({
+                    'key': key,
+                    'name': state['name'],
+                    'in_flight': state['in_flight'],
+                    'queue_depth': len(state['queue']),
+                    'limits': dict(state['limits']),
+                    'processes': AiLimiter.get_processes(),
+                    'request_bucket': None if state['request_bucket'] is None else round(state['request_bucket'], 2),
+                    'token_bucket': None if state['token_bucket'] is None else round(state['token_bucket']),
+                    'total': state['total'],
+                    'timeout': state['timeout'],
+                    'avg_wait_seconds': round(state['wait_seconds'] / state['total'], 3) if state['total'] > 0 else 0,
+                    'max_wait_seconds': round(state['max_wait_seconds'], 3),
+                })
+        return stats
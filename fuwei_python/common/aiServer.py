@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from conf.config import app_config
+
+
+class AiServer():
+    """
+    ai_server(写作助手AI服务)的共享HTTP传输层
+    所有请求共用一个带连接池的 requests.Session，按接口配置超时，
+    只在请求肯定没有被处理时重试：建立连接失败、429/503，按指数退避+随机抖动，不再递归重试
+    生成类接口不是幂等的，读超时和其他5xx不重试，避免同一个请求被重复生成
+    """
+    _lock = threading.Lock()
+    _session = None
+    DEFAULT_TIMEOUT = 600
+    # 各接口的超时时间(秒)，没有配置的用 DEFAULT_TIMEOUT
+    TIMEOUTS = {
+        '/api/i-can/chat/message': 900,
+    }
+    RETRY_STATUS = [429, 503]
+    HEADERS = {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer token123"
+    }
+
+    @staticmethod
+    def get_session() -> requests.Session:
+        if AiServer._session is not None:
+            return AiServer._session
+        with AiServer._lock:
+            if AiServer._session is None:
+                pool_size = int(app_config.get('ai_server_pool_size', 50))
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(AiServer.HEADERS)
+                AiServer._session = session
+        return AiServer._session
+
+    @staticmethod
+    def get_timeout(path):
+        return AiServer.TIMEOUTS.get(path, AiServer.DEFAULT_TIMEOUT)
+
+    @staticmethod
+    def get_backoff(attempt):
+        """
+        第attempt次重试前的等待时间：指数退避，上限 ai_server_backoff_max 秒，带随机抖动
+        """
+        base = float(app_config.get('ai_server_backoff_base', 1))
+        cap = float(app_config.get('ai_server_backoff_max', 30))
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+    @staticmethod
+    def sleep_backoff(attempt):
+        time.sleep(AiServer.get_backoff(attempt))
+
+    @staticmethod
+    def post(path, json=None, headers=None, stream=False, timeout=None, retries=None) -> requests.Response:
+        """
+        向 ai_server 发送POST请求
+        :param path: 接口路径，如 /api/project-outline
+        :param json: 请求体
+        :param headers: 额外的请求头
+        :param stream: 是否流式接收
+        :param timeout: 超时时间，默认按接口配置
+        :param retries: 连接失败及429/503时的重试次数，默认 ai_server_retries
+        :return:
+        """
+        if timeout is None:
+            timeout = AiServer.get_timeout(path)
+        if retries is None:
+            retries = int(app_config.get('ai_server_retries', 2))
+        url = f"{app_config['ai_server']}{path}"
+        session = AiServer.get_session()
+        attempt = 0
+        while True:
+            try:
+                response = session.post(url, json=json, headers=headers, stream=stream, timeout=timeout)
+            except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError):
+                if attempt >= retries:
+                    raise
+            else:
+                if response.status_code not in AiServer.RETRY_STATUS or attempt >= retries:
+                    return response
+                response.close()
+            AiServer.sleep_backoff(attempt)
+            attempt = attempt + 1
@@ -1,4 +1,8 @@
+import hashlib
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import oss2
 from conf.config import app_config
@@ -9,29 +13,137 @@ from  datetime import datetime
 import requests
 import shutil
 from pathlib import PurePath
+from common.ossCache import OssCache
 
 class aliOss():
     auth = oss2.Auth(app_config['ali_access_key'], app_config['ali_access_key_secret'])
     bucket = oss2.Bucket(auth, app_config['ali_endpoint'], app_config['ali_bucket'])
+    _lock = threading.Lock()
+    _part_executor = None
+    # 签名url缓存 key -> (url, 过期时间)
+    _url_cache = OrderedDict()
+    URL_EXPIRES = 600
+    URL_CACHE_SIZE = 10000
+    # 分片上传的最小分片，OSS要求除最后一片外不小于100KB
+    MIN_PART_SIZE = 100 * 1024
+    # <img>的src，分组是 (src前缀, src, 结束引号)
+    IMG_SRC_RE = re.compile(r'(<img[^>]*src=["\'])(.*?)(["\'])', re.DOTALL)
     @staticmethod
     def uploadFile(local_file=""):
-        with open(local_file, mode="rb") as file:
-            data = file.read()
         key = os.path.basename(local_file)
-        aliOss.bucket.put_object(key, data)
+        with open(local_file, mode="rb") as file:
+            aliOss.upload_stream(key, file)
         return key,aliOss.getUrl(key)
 
     @staticmethod
     def uploadSignDoc(local_file):
-        with open(local_file, mode="rb") as file:
-            data = file.read()
         headers = dict()
         headers["x-oss-storage-class"] = "Standard"
         headers["x-oss-object-acl"] = oss2.OBJECT_ACL_PRIVATE
         key ='docs/'+os.path.basename(local_file)
-        aliOss.bucket.put_object(key, data, headers=headers)
+        with open(local_file, mode="rb") as file:
+            aliOss.upload_stream(key, file, headers=headers)
         return key,aliOss.getUrl(key)
 
+    @staticmethod
+    def uploadPrivateFile(key, local_file):
+        """
+        上传私有文件(如批量导入的zip)，只给worker下载，不对外访问
+        """
+        headers = dict()
+        headers["x-oss-storage-class"] = "Standard"
+        headers["x-oss-object-acl"] = oss2.OBJECT_ACL_PRIVATE
+        with open(local_file, mode="rb") as file:
+            aliOss.upload_stream(key, file, headers=headers)
+        return key
+
+    @staticmethod
+    def get_part_executor():
+        if aliOss._part_executor is None:
+            with aliOss._lock:
+                if aliOss._part_executor is None:
+                    aliOss._part_executor = ThreadPoolExecutor(max_workers=int(app_config.get('oss_part_workers', 8)), thread_name_prefix="oss-part")
+        return aliOss._part_executor
+
+    @staticmethod
+    def read_part(stream, size):
+        '''
+        读满一个分片，流可能一次返回不足 size 的数据
+        '''
+        buffers = []
+        length = 0
+        while length < size:
+            data = stream.read(size - length)
+            if not data:
+                break
+            buffers.append(data)
+            length = length + len(data)
+        return b''.join(buffers)
+
+    @staticmethod
+    def upload_stream(key, stream, headers=None):
+        '''
+        边读边上传，不把整个文件读进内存
+        小于一个分片(oss_part_size)的文件直接put_object，否则分片上传，
+        每个文件同时在内存里的分片不超过 oss_part_parallel 个，分片失败重试 oss_part_retry 次
+        :param stream: 可读的文件对象，如 open() 或 request.files 的 stream
+        :return: {'key', 'size', 'sha256', 'head': 前16个字节，用于判断文件类型}
+        '''
+        part_size = max(aliOss.MIN_PART_SIZE, int(app_config.get('oss_part_size', 8 * 1024 * 1024)))
+        sha256 = hashlib.sha256()
+        data = aliOss.read_part(stream, part_size)
+        sha256.update(data)
+        info = {'key': key, 'size': len(data), 'head': data[:16]}
+        if len(data) < part_size:
+            aliOss.bucket.put_object(key, data, headers=headers)
+            info['sha256'] = sha256.hexdigest()
+            return info
+        upload_id = aliOss.bucket.init_multipart_upload(key, headers=headers).upload_id
+        slots = threading.BoundedSemaphore(int(app_config.get('oss_part_parallel', 4)))
+        future_list = []
+        part_number = 1
+        try:
+            while data:
+                slots.acquire()
+                future_list.append(aliOss.get_part_executor().submit(aliOss.upload_part, key, upload_id, part_number, data, slots))
+                for future in future_list:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                part_number = part_number + 1
+                data = aliOss.read_part(stream, part_size)
+                sha256.update(data)
+                info['size'] = info['size'] + len(data)
+            parts = [future.result() for future in future_list]
+            aliOss.bucket.complete_multipart_upload(key, upload_id, parts)
+        except Exception as e:
+            for future in future_list:
+                future.cancel()
+            # 等正在上传的分片结束后再取消分片上传，否则之后完成的分片会留在OSS里成为碎片
+            wait(future_list)
+            try:
+                aliOss.bucket.abort_multipart_upload(key, upload_id)
+            except Exception as abort_e:
+                print(f"取消分片上传{key}失败：{abort_e}")
+            raise e
+        info['sha256'] = sha256.hexdigest()
+        return info
+
+    @staticmethod
+    def upload_part(key, upload_id, part_number, data, slots):
+        try:
+            retry = int(app_config.get('oss_part_retry', 3))
+            for t in range(retry + 1):
+                try:
+                    result = aliOss.bucket.upload_part(key, upload_id, part_number, data)
+                    return oss2.models.PartInfo(part_number, result.etag, size=len(data))
+                except oss2.exceptions.OssError as e:
+                    if t >= retry:
+                        raise e
+                    print(f"分片{key}-{part_number}上传失败，重试：{e}")
+                    time.sleep(2 ** t)
+        finally:
+            slots.release()
+
 
     @staticmethod
     def deleteFile(key):
@@ -44,13 +156,45 @@ class aliOss():
 
     @staticmethod
     def getUrl(key):
-        url = aliOss.bucket.sign_url('GET', key, 600, slash_safe=True)
+        '''
+        签名url在过期前 oss_url_margin 秒内一直复用
+        '''
+        now = time.time()
+        margin = int(app_config.get('oss_url_margin', 120))
+        with aliOss._lock:
+            cached = aliOss._url_cache.get(key)
+            if cached is not None and cached[1] - margin > now:
+                aliOss._url_cache.move_to_end(key)
+                return cached[0]
+        url = aliOss.bucket.sign_url('GET', key, aliOss.URL_EXPIRES, slash_safe=True)
+        with aliOss._lock:
+            aliOss._url_cache[key] = (url, now + aliOss.URL_EXPIRES)
+            aliOss._url_cache.move_to_end(key)
+            while len(aliOss._url_cache) > aliOss.URL_CACHE_SIZE:
+                aliOss._url_cache.popitem(last=False)
         return url
     @staticmethod
     def uploadPicData(key="",data=""):
         aliOss.bucket.put_object(key, data)
         return aliOss.getPicUrl(key)
 
+    @staticmethod
+    def get_image_ext(data):
+        '''
+        根据文件头判断图片类型
+        :param data: 图片数据(至少前8个字节)
+        :return: 扩展名，无法识别时返回空字符串
+        '''
+        if data.startswith(b'\xff\xd8\xff'):
+            return '.jpg'
+        elif data.startswith(b'\x89PNG\r\n\x1a\n'):
+            return '.png'
+        elif data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+            return '.gif'
+        elif data.startswith(b'BM'):
+            return '.bmp'
+        return ''
+
     @staticmethod
     def extract_and_upload_base64_images(htmlContent,userId):
     # 正则表达式匹配Base64图片数据
@@ -180,59 +324,155 @@ class aliOss():
                 notExistsSrc.append(src)
         return notExistsSrc
     @staticmethod
-    def extract_local_images(html_content, userId,tmpIdPath):
-        pattern = re.compile(r'<img[^>]*src=["\'](.*?)["\']', re.DOTALL)
-        matches = pattern.findall(html_content)
+    def extract_local_images(html_content, userId,tmpIdPath, url_map=None):
+        '''
+        把html里引用zip中本地图片的src换成OSS地址
+        :param url_map: upload_local_images 的结果，多段html一起导入时先统一上传再逐段替换；不传时只上传本段的图片
+        :return: (替换后的html, 本段用到的图片url, 有图片上传失败时为0否则为1)
+        '''
+        if url_map is None:
+            url_map = aliOss.upload_local_images(aliOss.find_local_images(html_content), tmpIdPath)
         urls = []
-        for src in matches:
-            try:
-                local_file = f"./{tmpIdPath}/{src}"
-                if os.path.exists(local_file):
-                    with open(local_file, mode="rb") as file:
-                        image_data = file.read()
-                else:
-                    print('图片不存在')
-                    continue
-                ext = ''
-                if image_data.startswith(b'\xff\xd8\xff'):
-                    ext = '.jpg'
-                elif image_data.startswith(b'\x89PNG\r\n\x1a\n'):
-                    ext = '.png'
-                elif image_data.startswith(b'GIF87a') or image_data.startswith(b'GIF89a'):
-                    ext = '.gif'
-                elif image_data.startswith(b'BM'):
-                    ext = '.bmp'
-                # 生成OSS对象键（文件名）
-                object_key = datetime.now().strftime("%Y%m%d%H%M%S%f") + str(userId)+ ext
-                image_url = aliOss.uploadPicData(object_key,image_data)
-                urls.append(image_url)
-                html_content = re.sub(rf'(<img[^>]*src=["|\']){src}(["|\'][^>]*>)', rf'\g<1>{image_url}\g<2>',html_content)
-            except Exception as e:
-                print(f"上传图片时出错: {e}")
-                return html_content,urls,0
-        return html_content,urls,1
+        code = 1
+        for src in aliOss.find_local_images(html_content):
+            url = url_map.get(src)
+            if url == "":
+                code = 0
+            elif url is not None and url not in urls:
+                urls.append(url)
+
+        def replace(match):
+            url = url_map.get(match.group(2))
+            if not url:
+                return match.group(0)
+            return match.group(1) + url + match.group(3)
+        return aliOss.IMG_SRC_RE.sub(replace, html_content),urls,code
+
     @staticmethod
-    def batch_download_images_from_oss(object_names, local_dir):
-        try:
-            pic_dicts ={}
-            i = 0
-            for object_name in object_names:
-                i = i+1
-                file_name =  f'{i}.'+os.path.basename(object_name).split('.')[-1]
-                local_file_path = os.path.join(local_dir,file_name)
+    def find_local_images(html_content):
+        return [match.group(2) for match in aliOss.IMG_SRC_RE.finditer(html_content)]
+
+    @staticmethod
+    def upload_local_images(srcs, tmpIdPath):
+        '''
+        分两步并发上传zip里的本地图片：先算出每个文件内容的sha256，再把不重复的内容上传到以sha256命名的对象
+        同一个文件、内容相同的不同文件只上传一次，OSS里已有的直接复用
+        src 解析(包括符号链接)后必须在 tmpIdPath 目录里，防止用 ../ 或绝对路径读取服务器上的其他文件
+        :return: {src: 图片url}，上传失败或者在目录外的是空字符串，文件不存在的没有对应项
+        '''
+        files = {}
+        rejected = {}
+        root = os.path.realpath(tmpIdPath)
+        for src in srcs:
+            if src in files or src in rejected:
+                continue
+            local_file = os.path.realpath(os.path.join(root, src))
+            if os.path.commonpath([root, local_file]) != root:
+                print(f'图片不在导入目录里{src}')
+                rejected[src] = ""
+            elif os.path.isfile(local_file):
+                files[src] = local_file
+            else:
+                print(f'图片不存在{src}')
+        url_map = dict(rejected)
+        if len(files) == 0:
+            return url_map
+        start_time = time.time()
+        max_workers = int(app_config.get('oss_image_workers', 8))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="oss-image") as executor:
+            local_files = list(set(files.values()))
+            keys = {}
+            for local_file, future in zip(local_files, [executor.submit(aliOss.get_local_image_key, local_file) for local_file in local_files]):
                 try:
-                    aliOss.bucket.get_object_to_file(os.path.basename(object_name),local_file_path)
-                    pic_dicts[object_name] = [file_name,os.path.basename(object_name)]
-                    # object_stream = aliOss.bucket.get_object(os.path.basename(object_name))
-                    # with open(local_file_path, 'wb') as local_fileobj:
-                    #     shutil.copyfileobj(object_stream, local_fileobj)
-                    print(f"成功下载: {object_name} -> {local_file_path}")
-                except oss2.exceptions.OssError as e:
-                    print(f"下载 {object_name} 失败: {e}")
-            return pic_dicts
-        except oss2.exceptions.OssError as e:
-            print(f"批量下载失败: {e}")
-            return False
+                    keys[local_file] = future.result()
+                except Exception as e:
+                    print(f"读取图片{local_file}出错: {e}")
+            # 内容相同的文件只上传一个
+            uploads = {}
+            for local_file, key in keys.items():
+                uploads.setdefault(key, local_file)
+            future_list = {key: executor.submit(aliOss.upload_local_image, key, local_file) for key, local_file in uploads.items()}
+            urls = {}
+            for key, future in future_list.items():
+                try:
+                    urls[key] = future.result()
+                except Exception as e:
+                    print(f"上传图片{uploads[key]}出错: {e}")
+                    urls[key] = ""
+        for src, local_file in files.items():
+            url_map[src] = urls.get(keys.get(local_file), "")
+        print(f"上传本地图片：引用{len(files)}个，文件{len(local_files)}个，上传{len(uploads)}个，耗时{round(time.time() - start_time, 2)}秒")
+        return url_map
+
+    @staticmethod
+    def get_local_image_key(local_file):
+        sha256 = hashlib.sha256()
+        head = b''
+        with open(local_file, mode="rb") as file:
+            for chunk in iter(lambda: file.read(64 * 1024), b''):
+                if len(head) < 16:
+                    head = head + chunk[:16]
+                sha256.update(chunk)
+        return sha256.hexdigest() + aliOss.get_image_ext(head)
+
+    @staticmethod
+    def upload_local_image(key, local_file):
+        if not aliOss.bucket.object_exists(key):
+            with open(local_file, mode="rb") as file:
+                aliOss.bucket.put_object(key, file)
+        return aliOss.getPicUrl(key)
+    @staticmethod
+    def get_export_pic_dicts(object_names):
+        '''
+        导出时图片在zip里的文件名
+        :return: {对象url: [zip里的文件名, 对象名]}
+        '''
+        pic_dicts = {}
+        i = 0
+        for object_name in object_names:
+            i = i+1
+            pic_dicts[object_name] = [f'{i}.'+os.path.basename(object_name).split('.')[-1], os.path.basename(object_name)]
+        return pic_dicts
+
+    @staticmethod
+    def iter_objects(object_names, max_workers=8):
+        '''
+        并发读取多个对象的内容(经过 OssCache，导出过的图片不再下载)，按读取完成的顺序返回 (对象名, 内容)，读取失败的返回 (对象名, None)
+        同时在内存里的对象不超过 max_workers*2 个，客户端接收慢时不会无限堆积
+        '''
+        pending = list(object_names)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="oss-export") as executor:
+            while pending or running:
+                while pending and len(running) < max_workers * 2:
+                    object_name = pending.pop(0)
+                    running[executor.submit(aliOss.get_object_data, object_name)] = object_name
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    object_name = running.pop(future)
+                    if future.exception() is not None:
+                        print(f"下载 {object_name} 失败: {future.exception()}")
+                        yield object_name, None
+                        continue
+                    yield object_name, future.result()
+
+    @staticmethod
+    def restore_export_images(data, pic_dicts, failed_names):
+        '''
+        下载失败的图片不在zip里，表格里 extract_export_data_images 换成的zip文件名改回原来的url
+        :param failed_names: 下载失败的对象名
+        '''
+        replaces = {f'<img src="{value[0]}">': f'<img src="{url}">' for url, value in pic_dicts.items() if value[1] in failed_names}
+        if len(replaces) == 0:
+            return data
+        pattern = re.compile("|".join([re.escape(key) for key in replaces]))
+        for column, values in data.items():
+            data[column] = [pattern.sub(lambda match: replaces[match.group(0)], value) if isinstance(value, str) else value for value in values]
+        return data
+
+    @staticmethod
+    def get_object_data(object_name):
+        return OssCache.read(aliOss.bucket, object_name)
 
     @staticmethod
     def checkUrlOk(html_content):
@@ -274,7 +514,7 @@ class aliOss():
                 os.mkdir(local_path)
             local_file_path = local_path +datetime.now().strftime("%Y%m%d%H%M%S%f")+"-"+os.path.basename(object_name)
             filename = datetime.now().strftime("%Y%m%d%H%M%S%f") +os.path.basename(object_name)
-            aliOss.bucket.get_object_to_file(object_name, local_file_path)
+            OssCache.download(aliOss.bucket, object_name, local_file_path)
             return local_file_path,filename
         except Exception as e:
             print(e)
@@ -0,0 +1,127 @@
+import hashlib
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import requests
+
+from common.aliOss import aliOss
+from conf.config import app_config
+
+
+class DocImageRehoster():
+    """
+    把文档解析结果里的图片转存到自己的OSS，一个文档一个实例
+    图片在共用的有界线程池(doc_image_workers)里并发转存，下载时边读边算sha256，
+    小图片留在内存，大图片落到临时文件，不整张读进内存
+    对象名是内容的sha256，同一文档里相同的图片只上传一次，OSS里已有的图片直接复用
+
+    用法：
+        rehoster = DocImageRehoster(user_id)
+        future = rehoster.submit(src)
+        ...
+        url = future.result()
+        rehoster.get_log()
+    """
+    _lock = threading.Lock()
+    _executor = None
+    CHUNK_SIZE = 64 * 1024
+    # 超过这个大小的图片落到临时文件
+    SPOOL_SIZE = 1024 * 1024
+
+    @staticmethod
+    def get_executor():
+        if DocImageRehoster._executor is None:
+            with DocImageRehoster._lock:
+                if DocImageRehoster._executor is None:
+                    DocImageRehoster._executor = ThreadPoolExecutor(max_workers=int(app_config.get('doc_image_workers', 8)), thread_name_prefix="doc-image")
+        return DocImageRehoster._executor
+
+    def __init__(self, user_id=1):
+        self.user_id = user_id
+        self.lock = threading.Lock()
+        self.by_src = {}
+        self.by_hash = {}
+        self.start_time = time.time()
+        self.metrics = {
+            'images': 0,
+            'downloads': 0,
+            'uploads': 0,
+            'reused': 0,
+            'failed': 0,
+            'bytes': 0,
+            'download_seconds': 0.0,
+            'upload_seconds': 0.0,
+        }
+
+    def submit(self, src):
+        """
+        :return: Future，结果是转存后的图片url，失败时是空字符串
+        """
+        with self.lock:
+            self.metrics['images'] = self.metrics['images'] + 1
+            future = self.by_src.get(src)
+            if future is None:
+                future = DocImageRehoster.get_executor().submit(self.rehost, src)
+                self.by_src[src] = future
+            return future
+
+    def add_metric(self, name, value):
+        with self.lock:
+            self.metrics[name] = self.metrics[name] + value
+
+    def rehost(self, src):
+        try:
+            start_time = time.time()
+            sha256 = hashlib.sha256()
+            head = b''
+            size = 0
+            with tempfile.SpooledTemporaryFile(max_size=DocImageRehoster.SPOOL_SIZE) as file:
+                with requests.get(src, stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(DocImageRehoster.CHUNK_SIZE):
+                        if len(head) < 16:
+                            head = head + chunk[:16]
+                        sha256.update(chunk)
+                        file.write(chunk)
+                        size = size + len(chunk)
+                self.add_metric('downloads', 1)
+                self.add_metric('bytes', size)
+                self.add_metric('download_seconds', time.time() - start_time)
+                object_key = sha256.hexdigest() + aliOss.get_image_ext(head)
+                with self.lock:
+                    future = self.by_hash.get(object_key)
+                    is_owner = future is None
+                    if is_owner:
+                        future = Future()
+                        self.by_hash[object_key] = future
+                if not is_owner:
+                    # 同一文档里内容相同的图片
+                    self.add_metric('reused', 1)
+                    return future.result()
+                try:
+                    start_time = time.time()
+                    if aliOss.bucket.object_exists(object_key):
+                        self.add_metric('reused', 1)
+                    else:
+                        file.seek(0)
+                        aliOss.uploadPicData(object_key, file)
+                        self.add_metric('uploads', 1)
+                        self.add_metric('upload_seconds', time.time() - start_time)
+                    url = aliOss.getPicUrl(object_key)
+                    future.set_result(url)
+                    return url
+                except Exception as e:
+                    future.set_result("")
+                    raise e
+        except Exception as e:
+            print(f"转存图片失败{src}：{e}")
+            self.add_metric('failed', 1)
+            return ""
+
+    def get_log(self):
+        metrics = self.metrics
+        return (f"图片{metrics['images']}张，下载{metrics['downloads']}张({round(metrics['bytes'] / 1024 / 1024, 2)}MB，{round(metrics['download_seconds'], 2)}秒)，"
+                f"上传{metrics['uploads']}张({round(metrics['upload_seconds'], 2)}秒)，复用{metrics['reused']}张，失败{metrics['failed']}张，"
+                f"总耗时{round(time.time() - self.start_time, 2)}秒")
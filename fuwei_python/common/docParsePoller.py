@@ -0,0 +1,161 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+from common.aliDocAnalysis import aliDocAnalysis
+from conf.config import app_config
+
+
+class DocParseError(Exception):
+    """文档解析任务失败或超时"""
+
+
+class DocParsePoller():
+    """
+    用一个后台线程轮询所有未完成的阿里云文档解析任务，代替每个上传线程各自每秒查询一次
+    解析进度(NumberOfSuccessfulParsing)有变化时按 doc_parse_poll_min 秒间隔查询，
+    没有变化时间隔翻倍，最长 doc_parse_poll_max 秒；每凑满一页就立即取回，不等整个文档解析完
+
+    用法：
+        for datas in DocParsePoller.pages(ali_id):
+            for data in datas:
+                data['markdownContent']
+    """
+    _cond = threading.Condition()
+    _heap = []
+    _counter = itertools.count()
+    _thread = None
+    PAGE = "page"
+    DONE = "done"
+    FAIL = "fail"
+
+    @staticmethod
+    def get_config():
+        return {
+            'min_interval': float(app_config.get('doc_parse_poll_min', 1)),
+            'max_interval': float(app_config.get('doc_parse_poll_max', 16)),
+            'timeout': float(app_config.get('doc_parse_timeout', 1800)),
+            'max_errors': int(app_config.get('doc_parse_max_errors', 5)),
+        }
+
+    @staticmethod
+    def submit(ali_id, per_page_num=3000):
+        """
+        登记一个解析任务
+        :return: 事件队列，依次收到 (PAGE, 一页结果)...，最后是 (DONE, None) 或 (FAIL, 原因)
+        """
+        config = DocParsePoller.get_config()
+        job = {
+            'ali_id': ali_id,
+            'per_page_num': per_page_num,
+            'page': 1,
+            'number': -1,
+            'interval': config['min_interval'],
+            'errors': 0,
+            'polls': 0,
+            'start_time': time.time(),
+            'events': queue.Queue(),
+        }
+        DocParsePoller.schedule(job, 0)
+        return job['events']
+
+    @staticmethod
+    def pages(ali_id, per_page_num=3000):
+        """
+        按顺序返回解析好的每一页，解析失败或超时抛出 DocParseError
+        """
+        events = DocParsePoller.submit(ali_id, per_page_num)
+        timeout = DocParsePoller.get_config()['timeout']
+        while True:
+            try:
+                event, value = events.get(timeout=timeout + 60)
+            except queue.Empty:
+                raise DocParseError(f"解析任务{ali_id}超时")
+            if event == DocParsePoller.PAGE:
+                yield value
+            elif event == DocParsePoller.DONE:
+                return
+            else:
+                raise DocParseError(value)
+
+    @staticmethod
+    def schedule(job, delay):
+        with DocParsePoller._cond:
+            heapq.heappush(DocParsePoller._heap, (time.monotonic() + delay, next(DocParsePoller._counter), job))
+            if DocParsePoller._thread is None or not DocParsePoller._thread.is_alive():
+                DocParsePoller._thread = threading.Thread(target=DocParsePoller.run, name="doc-parse-poller", daemon=True)
+                DocParsePoller._thread.start()
+            DocParsePoller._cond.notify()
+
+    @staticmethod
+    def run():
+        while True:
+            with DocParsePoller._cond:
+                while len(DocParsePoller._heap) == 0 or DocParsePoller._heap[0][0] > time.monotonic():
+                    wait = None if len(DocParsePoller._heap) == 0 else DocParsePoller._heap[0][0] - time.monotonic()
+                    DocParsePoller._cond.wait(wait)
+                _, _, job = heapq.heappop(DocParsePoller._heap)
+            try:
+                DocParsePoller.poll(job)
+            except Exception as e:
+                DocParsePoller.fail_or_retry(job, f"解析任务{job['ali_id']}查询异常：{e}")
+
+    @staticmethod
+    def poll(job):
+        config = DocParsePoller.get_config()
+        if time.time() - job['start_time'] > config['timeout']:
+            DocParsePoller.finish(job, DocParsePoller.FAIL, f"解析任务{job['ali_id']}超过{config['timeout']}秒未完成")
+            return
+        job['polls'] = job['polls'] + 1
+        d = aliDocAnalysis.QueryDocParserStatus(job['ali_id'])
+        if d is None:
+            DocParsePoller.fail_or_retry(job, f"解析任务{job['ali_id']}查询状态失败")
+            return
+        if d['Status'] == 'Fail':
+            DocParsePoller.finish(job, DocParsePoller.FAIL, f"解析任务{job['ali_id']}解析失败")
+            return
+        number = d['NumberOfSuccessfulParsing']
+        progressed = number > job['number']
+        job['number'] = max(number, job['number'])
+        # 已经凑满的页先取回
+        while job['number'] > job['page'] * job['per_page_num']:
+            datas = aliDocAnalysis.GetDocParserResult(job['ali_id'], job['page'], job['per_page_num'])
+            if datas is None:
+                DocParsePoller.fail_or_retry(job, f"解析任务{job['ali_id']}获取第{job['page']}页失败")
+                return
+            job['events'].put((DocParsePoller.PAGE, datas))
+            job['page'] = job['page'] + 1
+        if d['Status'] == 'success':
+            if job['number'] > 0:
+                datas = aliDocAnalysis.GetDocParserResult(job['ali_id'], job['page'], job['per_page_num'])
+                if datas is None:
+                    DocParsePoller.fail_or_retry(job, f"解析任务{job['ali_id']}获取第{job['page']}页失败")
+                    return
+                job['events'].put((DocParsePoller.PAGE, datas))
+            DocParsePoller.finish(job, DocParsePoller.DONE, None)
+            return
+        job['errors'] = 0
+        if progressed:
+            job['interval'] = config['min_interval']
+        else:
+            job['interval'] = min(job['interval'] * 2, config['max_interval'])
+        DocParsePoller.schedule(job, job['interval'])
+
+    @staticmethod
+    def fail_or_retry(job, message):
+        config = DocParsePoller.get_config()
+        job['errors'] = job['errors'] + 1
+        print(message)
+        if job['errors'] >= config['max_errors']:
+            DocParsePoller.finish(job, DocParsePoller.FAIL, message)
+            return
+        job['interval'] = min(job['interval'] * 2, config['max_interval'])
+        DocParsePoller.schedule(job, job['interval'])
+
+    @staticmethod
+    def finish(job, event, value):
+        print(f"解析任务{job['ali_id']}结束：{event}，查询{job['polls']}次，耗时{round(time.time() - job['start_time'], 1)}秒")
+        job['events'].put((event, value))
+
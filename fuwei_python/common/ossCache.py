@@ -0,0 +1,153 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from conf.config import app_config
+
+
+class OssCache():
+    """
+    OSS对象的本地磁盘缓存，文件名是 sha256(对象名)-ETag，对象内容变化后ETag不同自然不会命中
+    命中时只发一次HEAD请求取ETag，不再下载；总大小超过 oss_cache_max_bytes 时按最近访问时间淘汰
+    缓存文件以硬链接(不支持时复制)交给调用方，调用方删除自己的文件不影响缓存
+    多个进程共用同一个缓存目录，以文件系统为准，不维护进程内索引
+    下载先写到 .tmp 文件再改名，失败时删除；进程中途退出留下的 .tmp 超过 oss_cache_tmp_seconds 后在淘汰时删除
+    """
+    _lock = threading.Lock()
+    _size = None
+
+    @staticmethod
+    def get_config():
+        return {
+            'status': app_config.get('oss_cache_status', 'open'),
+            'dir': app_config.get('oss_cache_dir', './tmp/oss_cache/'),
+            'max_bytes': int(app_config.get('oss_cache_max_bytes', 2 * 1024 * 1024 * 1024)),
+            'tmp_seconds': int(app_config.get('oss_cache_tmp_seconds', 3600)),
+        }
+
+    @staticmethod
+    def get_cache_path(cache_dir, object_name, etag):
+        name = hashlib.sha256(object_name.encode('utf-8')).hexdigest()
+        etag = etag.strip('"')
+        return os.path.join(cache_dir, f"{name}-{etag}")
+
+    @staticmethod
+    def download(bucket, object_name, local_file_path):
+        """
+        把对象下载到 local_file_path，优先从本地缓存取
+        """
+        config = OssCache.get_config()
+        if config['status'] != "open":
+            bucket.get_object_to_file(object_name, local_file_path)
+            return local_file_path
+        cache_path = OssCache.fetch(bucket, object_name, config)
+        try:
+            OssCache.link(cache_path, local_file_path)
+        except FileNotFoundError:
+            # 刚好被其他进程淘汰
+            bucket.get_object_to_file(object_name, local_file_path)
+        return local_file_path
+
+    @staticmethod
+    def read(bucket, object_name):
+        """
+        读取对象的内容，优先从本地缓存取
+        """
+        config = OssCache.get_config()
+        if config['status'] != "open":
+            return bucket.get_object(object_name).read()
+        cache_path = OssCache.fetch(bucket, object_name, config)
+        try:
+            with open(cache_path, mode="rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            # 刚好被其他进程淘汰
+            return bucket.get_object(object_name).read()
+
+    @staticmethod
+    def fetch(bucket, object_name, config):
+        """
+        保证对象在缓存目录里，没有时下载
+        :return: 缓存文件路径
+        """
+        os.makedirs(config['dir'], exist_ok=True)
+        etag = bucket.head_object(object_name).etag
+        cache_path = OssCache.get_cache_path(config['dir'], object_name, etag)
+        if os.path.exists(cache_path):
+            try:
+                os.utime(cache_path)
+                return cache_path
+            except FileNotFoundError:
+                # 刚好被其他进程淘汰
+                pass
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            bucket.get_object_to_file(object_name, tmp_path)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        OssCache.add_size(config, size)
+        return cache_path
+
+    @staticmethod
+    def link(cache_path, local_file_path):
+        try:
+            os.link(cache_path, local_file_path)
+        except OSError:
+            shutil.copyfile(cache_path, local_file_path)
+
+    @staticmethod
+    def add_size(config, size):
+        with OssCache._lock:
+            if OssCache._size is None:
+                OssCache._size = OssCache.get_dir_size(config['dir'])
+            else:
+                OssCache._size = OssCache._size + size
+            if OssCache._size > config['max_bytes']:
+                OssCache._size = OssCache.evict(config['dir'], int(config['max_bytes'] * 0.9), config['tmp_seconds'])
+
+    @staticmethod
+    def get_dir_size(cache_dir):
+        size = 0
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                size = size + entry.stat().st_size
+        return size
+
+    @staticmethod
+    def evict(cache_dir, target_bytes, tmp_seconds=3600):
+        """
+        按最近访问时间从旧到新删除缓存文件，直到总大小不超过 target_bytes
+        同时删除超过 tmp_seconds 没有修改的 .tmp 文件(下载中途进程退出留下的)
+        :return: 淘汰后的总大小
+        """
+        files = []
+        now = time.time()
+        for entry in os.scandir(cache_dir):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+                if not entry.name.endswith(".tmp"):
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                elif now - stat.st_mtime > tmp_seconds:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        files.sort()
+        size = sum([file[1] for file in files])
+        for _, file_size, path in files:
+            if size <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                size = size - file_size
+            except FileNotFoundError:
+                size = size - file_size
+        return size
@@ -0,0 +1,64 @@
+import threading
+
+from conf.config import app_config
+
+
+class ProgressStore():
+    """
+    文档上传解析进度的存储，按(用户id, 记录id)保存当前阶段，每次更新 version 加1
+    upload_progress_store=db 时存数据库，多个web进程和worker进程都能看到同样的进度；
+    upload_progress_store=memory 时存在当前进程内，只适合单进程运行和调试，
+    这时上传的文档在web进程的线程里解析，不经过任务队列(worker进程写的进度web进程看不到)
+    """
+    _lock = threading.Lock()
+    _store = None
+
+    @staticmethod
+    def get_store():
+        store_type = app_config.get('upload_progress_store', 'db')
+        if ProgressStore._store is None or ProgressStore._store.store_type != store_type:
+            with ProgressStore._lock:
+                if ProgressStore._store is None or ProgressStore._store.store_type != store_type:
+                    ProgressStore._store = MemoryProgressStore() if store_type == "memory" else DbProgressStore()
+        return ProgressStore._store
+
+
+class MemoryProgressStore():
+    store_type = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._progress = {}
+
+    def set(self, user_id, record_id, stage, detail=""):
+        with self._lock:
+            key = (str(user_id), str(record_id))
+            version = self._progress.get(key, {}).get('version', 0)
+            self._progress[key] = {'stage': stage, 'detail': detail, 'version': version + 1}
+
+    def get(self, user_id, record_id):
+        """
+        :return: {'stage', 'detail', 'version'}，没有记录返回None
+        """
+        with self._lock:
+            progress = self._progress.get((str(user_id), str(record_id)))
+            return None if progress is None else dict(progress)
+
+
+class DbProgressStore():
+    store_type = "db"
+
+    def set(self, user_id, record_id, stage, detail=""):
+        from models.upload_files.model import UploadProgress
+        UploadProgress.set_stage(user_id, record_id, stage, detail)
+
+    def get(self, user_id, record_id):
+        from conf.db import db
+        from models.upload_files.model import UploadProgress
+        item = UploadProgress.get_one(user_id, record_id)
+        if item is None:
+            return None
+        progress = {'stage': item.stage, 'detail': item.detail, 'version': item.version}
+        # 轮询时结束只读事务，下次查询能看到其他进程的更新
+        db.session.commit()
+        return progress
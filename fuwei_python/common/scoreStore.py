@@ -0,0 +1,81 @@
+import threading
+
+from conf.config import app_config
+
+
+class ScoreStore():
+    """
+    立项评估防抖分数的汇总存储，追加一个分数的同时返回该步骤当前的全部分数
+    lx_score_store=db 时存数据库，评分任务可以分布在多个进程/机器上；
+    lx_score_store=memory 时存在当前进程内，只适合单进程运行和调试
+    """
+    _lock = threading.Lock()
+    _store = None
+    LOG_STEP = "log"
+
+    @staticmethod
+    def get_store():
+        store_type = app_config.get('lx_score_store', 'db')
+        if ScoreStore._store is None or ScoreStore._store.store_type != store_type:
+            with ScoreStore._lock:
+                if ScoreStore._store is None or ScoreStore._store.store_type != store_type:
+                    ScoreStore._store = MemoryScoreStore() if store_type == "memory" else DbScoreStore()
+        return ScoreStore._store
+
+
+class MemoryScoreStore():
+    store_type = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+
+    def append(self, record_id, step, score):
+        """
+        :return: 追加后该步骤的全部分数
+        """
+        with self._lock:
+            scores = self._records.setdefault(str(record_id), {}).setdefault(step, [])
+            scores.append(score)
+            return list(scores)
+
+    def get(self, record_id, step):
+        with self._lock:
+            return list(self._records.get(str(record_id), {}).get(step, []))
+
+    def append_log(self, record_id, content):
+        self.append(record_id, ScoreStore.LOG_STEP, content)
+
+    def get_log(self, record_id):
+        return "".join(self.get(record_id, ScoreStore.LOG_STEP))
+
+    def clear(self, record_id):
+        with self._lock:
+            self._records.pop(str(record_id), None)
+
+
+class DbScoreStore():
+    """
+    每个分数一行，插入和读取在同一个会话里完成，读到的列表一定包含刚追加的分数
+    """
+    store_type = "db"
+
+    def append(self, record_id, step, score):
+        from models.lx_ai_sug_score.model import LxStepScore
+        return [row.score for row in LxStepScore.append(record_id, step, score=score)]
+
+    def get(self, record_id, step):
+        from models.lx_ai_sug_score.model import LxStepScore
+        return [row.score for row in LxStepScore.get_list(record_id, step)]
+
+    def append_log(self, record_id, content):
+        from models.lx_ai_sug_score.model import LxStepScore
+        LxStepScore.append(record_id, ScoreStore.LOG_STEP, content=content)
+
+    def get_log(self, record_id):
+        from models.lx_ai_sug_score.model import LxStepScore
+        return "".join([row.content or "" for row in LxStepScore.get_list(record_id, ScoreStore.LOG_STEP)])
+
+    def clear(self, record_id):
+        from models.lx_ai_sug_score.model import LxStepScore
+        LxStepScore.clear(record_id)
@@ -0,0 +1,137 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from conf.config import app_config
+
+
+class TaskGraph():
+    """
+    按依赖关系执行一组任务，所有任务图共用一个有界线程池(全局并发 task_graph_workers)，
+    单个任务图同时运行的任务数不超过 max_workers，并记录每个任务的排队和执行耗时
+    依赖的任务失败或被跳过时，后续任务直接跳过
+    任务里不能再向线程池提交任务并等待，否则线程池占满时会互相等待
+
+    用法：
+        graph = TaskGraph("立项评估1", context=app.app_context)
+        graph.add("step_1", get_step, record_id, ...)
+        graph.add("average", set_average, deps=["step_1"])
+        graph.run()
+        graph.results["average"]
+    """
+    _lock = threading.Lock()
+    _executor = None
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    @staticmethod
+    def get_executor():
+        if TaskGraph._executor is None:
+            with TaskGraph._lock:
+                if TaskGraph._executor is None:
+                    TaskGraph._executor = ThreadPoolExecutor(max_workers=int(app_config.get('task_graph_workers', 32)), thread_name_prefix="task-graph")
+        return TaskGraph._executor
+
+    def __init__(self, name, max_workers=8, context=None):
+        """
+        :param name: 任务图名称，用于日志
+        :param max_workers: 本任务图同时运行的任务数
+        :param context: 每个任务运行时进入的上下文，如 app.app_context
+        """
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.context = context
+        self.nodes = {}
+        self.results = {}
+        self.errors = {}
+
+    def add(self, name, func, *args, deps=None, **kwargs):
+        """
+        :param deps: 依赖的任务名，必须先添加
+        """
+        if name in self.nodes:
+            raise ValueError(f"任务{name}重复")
+        deps = list(deps or [])
+        for dep in deps:
+            if dep not in self.nodes:
+                raise ValueError(f"任务{name}依赖的{dep}不存在")
+        self.nodes[name] = {
+            'func': func,
+            'args': args,
+            'kwargs': kwargs,
+            'deps': deps,
+            'state': TaskGraph.PENDING,
+            'submit_time': None,
+            'wait': 0.0,
+            'seconds': 0.0,
+        }
+        return name
+
+    def call(self, name):
+        node = self.nodes[name]
+        start = time.monotonic()
+        node['wait'] = start - node['submit_time']
+        try:
+            if self.context is None:
+                return node['func'](*node['args'], **node['kwargs'])
+            with self.context():
+                return node['func'](*node['args'], **node['kwargs'])
+        finally:
+            node['seconds'] = time.monotonic() - start
+
+    def run(self):
+        """
+        执行全部任务，返回 results，失败的任务异常在 errors 里
+        """
+        executor = TaskGraph.get_executor()
+        pending = list(self.nodes.keys())
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            # 任务按添加顺序排列，依赖一定在前面，一次遍历就能把跳过状态传递下去
+            for name in list(pending):
+                if len(running) >= self.max_workers:
+                    break
+                node = self.nodes[name]
+                states = [self.nodes[dep]['state'] for dep in node['deps']]
+                if TaskGraph.FAILED in states or TaskGraph.SKIPPED in states:
+                    node['state'] = TaskGraph.SKIPPED
+                    pending.remove(name)
+                elif all(state == TaskGraph.DONE for state in states):
+                    node['state'] = TaskGraph.RUNNING
+                    node['submit_time'] = time.monotonic()
+                    running[executor.submit(self.call, name)] = name
+                    pending.remove(name)
+            if len(running) == 0:
+                break
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    self.nodes[name]['state'] = TaskGraph.FAILED
+                    self.errors[name] = future.exception()
+                    print(f"{self.name}任务{name}失败：{future.exception()}")
+                else:
+                    self.nodes[name]['state'] = TaskGraph.DONE
+                    self.results[name] = future.result()
+        return self.results
+
+    def get_state(self, name):
+        return self.nodes[name]['state']
+
+    def get_timings(self):
+        return [{
+            'name': name,
+            'state': node['state'],
+            'wait_seconds': round(node['wait'], 3),
+            'seconds': round(node['seconds'], 3),
+        } for name, node in self.nodes.items()]
+
+    def get_timing_log(self):
+        """
+        各任务耗时，按执行耗时倒序，方便看出哪个阶段最慢
+        """
+        timings = sorted(self.get_timings(), key=lambda timing: timing['seconds'], reverse=True)
+        return ",".join([f"{timing['name']}[{timing['state']}]:{timing['seconds']}s(排队{timing['wait_seconds']}s)" for timing in timings])
@@ -1,3 +1,4 @@
+import io
 import zipfile
 import os
 import chardet
@@ -52,3 +53,70 @@ class zip():
                     zipf.write(file_path, arcname)
 
         print(f"成功创建 ZIP 文件: {zip_path}")
+
+
+class ZipBuffer():
+    """
+    只进不退的写入缓冲，zipfile 检测到不能 seek 时会用数据描述符格式边写边输出
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.offset = self.offset + len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ZipStream():
+    """
+    不落盘的流式zip，每写完一个文件就可以把已经生成的字节发给客户端
+
+    用法：
+        stream = ZipStream()
+        yield stream.add("1.png", data, zipfile.ZIP_STORED)
+        yield stream.add_workbook("export.xlsx", {"列名": [值...]})
+        yield stream.close()
+    """
+    def __init__(self):
+        self.buffer = ZipBuffer()
+        self.zip = zipfile.ZipFile(self.buffer, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, name, data, compress_type=zipfile.ZIP_DEFLATED):
+        """
+        :return: 本次新生成的zip字节
+        """
+        self.zip.writestr(name, data, compress_type=compress_type)
+        return self.buffer.pop()
+
+    def add_workbook(self, name, data):
+        """
+        把 {列名: [值...]} 用只写模式的 openpyxl 生成xlsx，作为zip里的一个文件
+        """
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        columns = list(data.keys())
+        sheet.append(columns)
+        rows = len(data[columns[0]]) if columns else 0
+        for i in range(rows):
+            sheet.append(['' if data[column][i] is None else str(data[column][i]) for column in columns])
+        output = io.BytesIO()
+        workbook.save(output)
+        return self.add(name, output.getvalue())
+
+    def close(self):
+        self.zip.close()
+        return self.buffer.pop()
@@ -3,10 +3,14 @@ from flask import session
 from common.aliOss import aliOss
 from conf.db import db
 from sqlalchemy import Column, Integer, String, Text, and_, DateTime, func, or_, ForeignKey, SmallInteger
+from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
 from flask_paginate import  get_page_args,Pagination
 from models.users.models import User
 import pandas as pd
 import re
+import threading
 class AiSugScore(db.Model):
     __tablename__ = 'ai_sug_score'
     id = Column(String(128), primary_key=True)
@@ -77,6 +81,36 @@ class AiSugScore(db.Model):
         db.session.add(AiSugScore(id=data['id'],step1=data['step1'],step2=data['step2'],step3=data['step3'],step4=data['step4'],user_id=data['user_id'],type=data['type'],state=state,admin_user_id=data['admin_user_id'],defect_id=defect_id))
         db.session.commit()
 
+    @staticmethod
+    def add_batch(datas, urls):
+        """
+        在一个事务里批量新增评估记录及其图片记录
+        :param datas: 记录列表
+        :param urls: 记录id => 图片url列表
+        """
+        from models.upload_files.model import UploadFiles
+        try:
+            for data in datas:
+                state = data['state'] if "state" in data else 0
+                defect_id = data['defect_id'] if 'defect_id' in data else None
+                db.session.add(AiSugScore(id=data['id'],step1=data['step1'],step2=data['step2'],step3=data['step3'],step4=data['step4'],user_id=data['user_id'],type=data['type'],state=state,admin_user_id=data['admin_user_id'],defect_id=defect_id))
+            files = []
+            for data in datas:
+                for url in urls.get(data['id'], []):
+                    files.append({"file_name":"","file_key_url":url,"ai_sug_score_id":data['id'],"user_id":data['user_id']})
+            db.session.flush()
+            if len(files) > 0:
+                db.session.bulk_insert_mappings(UploadFiles, files)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @staticmethod
+    def get_by_ids(user_id, ids):
+        items = AiSugScore.query.filter(and_(AiSugScore.user_id == user_id, AiSugScore.id.in_(ids), AiSugScore.is_delete==0)).all()
+        return items
+
     @staticmethod
     def get_list(user_id=1, record_type=0, state=1, search="",ai_sug_score_id=""):
         page, per_page, offset = get_page_args(page_parameter='page', per_page_parameter='per_page')
@@ -135,6 +169,15 @@ class AiSugScore(db.Model):
         record.state = 1
         db.session.commit()
     @staticmethod
+    def edit_ai_step(data, step):
+        """
+        流式评估时单个步骤解析完成就先入库
+        """
+        record = AiSugScore.get_one(user_id=data['user_id'], id=data['id'])
+        setattr(record, 'ai_'+step, data['ai_'+step])
+        setattr(record, step+'_score', data[step+'_score'])
+        db.session.commit()
+    @staticmethod
     def getAllExport(user_id=0,type=0,state=1):
         items  =  AiSugScore.query.filter(and_(AiSugScore.user_id == user_id, AiSugScore.type ==type,AiSugScore.state==state,AiSugScore.is_delete==0)).all()
         return items
@@ -297,3 +340,108 @@ class AntiShakeLog(db.Model):
         record = AntiShakeLog(val_id=data["val_id"],type=data["type"],content=data["content"])
         db.session.add(record)
         db.session.commit()
+
+
+class AiValCache(db.Model):
+    """
+    评估结果缓存，cache_key 是(记录类型、规范化后的步骤内容、标准文档版本、模型id、防抖模式)的sha256
+    超过 ttl 的缓存视为失效，总数超过上限时按最近命中时间淘汰
+    淘汰要统计总数，每个进程每写入 evict_every 条才执行一次
+    立项文档分块压缩结果(TYPE_LX_MAP_REDUCE)也存在这张表，和评估结果分开淘汰、分开清除
+    """
+    __tablename__ = 'ai_val_cache'
+    # 评估结果的type是记录类型(0:缺陷 1:需求)
+    TYPE_LX_MAP_REDUCE = 20
+    _evict_lock = threading.Lock()
+    # 评估结果和分块压缩结果分别计数 {是否分块压缩结果: 写入条数}
+    _insert_counts = {}
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), unique=True, nullable=False)
+    type = Column(SmallInteger, default=0)
+    model_id = Column(Integer, default=0)
+    result = Column(Text().with_variant(LONGTEXT(), "mysql"), default="")
+    hit_count = Column(Integer, default=0)
+    last_hit_time = Column(DateTime, server_default=func.now(), nullable=False)
+    create_time = Column(db.DateTime, server_default=func.now(),nullable=False)
+    update_time = Column(DateTime,server_default=func.now(), onupdate=func.now(),nullable=False)
+    def to_dict(self):
+        return {
+            column.name: getattr(self, column.name)for column in self.__table__.columns
+        }
+
+    @staticmethod
+    def get_by_key(cache_key, ttl):
+        """
+        :param cache_key:
+        :param ttl: 有效期(秒)
+        :return: 未命中或已过期返回None
+        """
+        item = AiValCache.query.filter(AiValCache.cache_key == cache_key).first()
+        if item is None:
+            return None
+        if item.create_time < datetime.now() - timedelta(seconds=ttl):
+            db.session.delete(item)
+            db.session.commit()
+            return None
+        item.hit_count = item.hit_count + 1
+        item.last_hit_time = datetime.now()
+        db.session.commit()
+        return item
+
+    @staticmethod
+    def add_one(data, ttl, max_rows, evict_every=100):
+        # 有效期和淘汰都按应用服务器时间比较，写入时间也用应用服务器时间，不依赖数据库的时钟和时区
+        now = datetime.now()
+        record = AiValCache(cache_key=data['cache_key'], type=data['type'], model_id=data['model_id'], result=data['result'], create_time=now, last_hit_time=now)
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 并发评估相同内容时已被其他进程写入
+            db.session.rollback()
+            return
+        group = data['type'] == AiValCache.TYPE_LX_MAP_REDUCE
+        with AiValCache._evict_lock:
+            count = AiValCache._insert_counts.get(group, 0) + 1
+            AiValCache._insert_counts[group] = count
+            due = count % max(1, evict_every) == 0
+        if due:
+            AiValCache.evict(ttl, max_rows, data['type'])
+
+    @staticmethod
+    def get_group_filter(cache_type):
+        """
+        和cache_type同一组的缓存：分块压缩结果一组，各类评估结果一组
+        """
+        if cache_type == AiValCache.TYPE_LX_MAP_REDUCE:
+            return AiValCache.type == AiValCache.TYPE_LX_MAP_REDUCE
+        return AiValCache.type != AiValCache.TYPE_LX_MAP_REDUCE
+
+    @staticmethod
+    def evict(ttl, max_rows, cache_type=0):
+        """
+        删除和cache_type同一组的过期缓存，该组超过max_rows时删除最久未命中的缓存
+        """
+        group_filter = AiValCache.get_group_filter(cache_type)
+        AiValCache.query.filter(group_filter, AiValCache.create_time < datetime.now() - timedelta(seconds=ttl)).delete(synchronize_session=False)
+        db.session.commit()
+        total = AiValCache.query.filter(group_filter).count()
+        if total > max_rows:
+            ids = [row.id for row in db.session.query(AiValCache.id).filter(group_filter).order_by(AiValCache.last_hit_time.asc()).limit(total - max_rows).all()]
+            AiValCache.query.filter(AiValCache.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+    @staticmethod
+    def purge(record_type=None):
+        """
+        清除评估缓存
+        :param record_type: None时清除全部评估结果，不包括分块压缩结果；传 TYPE_LX_MAP_REDUCE 时只清除分块压缩结果
+        :return: 清除的条数
+        """
+        if record_type is None:
+            query = AiValCache.query.filter(AiValCache.get_group_filter(0))
+        else:
+            query = AiValCache.query.filter(AiValCache.type == record_type)
+        num = query.delete(synchronize_session=False)
+        db.session.commit()
+        return num
@@ -1,9 +1,14 @@
+import threading
+import time
+from types import SimpleNamespace
+
 from sqlalchemy.dialects.mysql import LONGTEXT
 
 from conf.db import db
-from sqlalchemy import  Column, Integer, String ,Float,and_,DateTime,delete, Text
+from sqlalchemy import  Column, Integer, String ,Float,and_,DateTime,delete, Text, func
 from datetime import datetime
 from flask_paginate import  get_page_args,Pagination
+from conf.config import app_config
 
 class DocFiles(db.Model):
 
@@ -22,13 +27,63 @@ class DocFiles(db.Model):
     child_type_1 = Column(Integer, default=0)
     child_type_2 = Column(Integer, default=0)
     step = Column(Integer, default=0)
-    create_time = Column(db.DateTime, default=datetime.now())
-    update_time = Column(DateTime, default=datetime.now(), onupdate=datetime.now())
+    # 每次修改+1，用于让各进程的标准文档缓存失效
+    version = Column(Integer, default=0, server_default="0", nullable=False)
+    create_time = Column(db.DateTime, default=datetime.now)
+    update_time = Column(DateTime, default=datetime.now, onupdate=datetime.now)
     standarFile= {"0":{"name":"","content":""},"1":{"name":"","content":""},"2":{"name":"","content":""}}
+    # 进程内标准文档缓存 (type, child_type_1, child_type_2, step) => 文档快照
+    _cache = {}
+    _cache_lock = threading.Lock()
+    _cache_stamp = None
+    _cache_check_time = 0
+
+    def to_dict(self):
+        return {
+            column.name: getattr(self, column.name)for column in self.__table__.columns
+        }
+
     @staticmethod
     def addOne(data):
-        db.session.add(DocFiles(file_name=data['file_name'], type=data['type'], markdown=data['markdown'], cammand=data['cammand'], step=data['step']))
+        db.session.add(DocFiles(file_name=data['file_name'], type=data['type'], markdown=data['markdown'], cammand=data['cammand'], step=data['step'], version=1))
         db.session.commit()
+        DocFiles.clear_cache()
+
+    @staticmethod
+    def bump_version(item):
+        item.version = (item.version or 0) + 1
+
+    @staticmethod
+    def clear_cache():
+        with DocFiles._cache_lock:
+            DocFiles._cache.clear()
+            DocFiles._cache_stamp = None
+            DocFiles._cache_check_time = 0
+
+    @staticmethod
+    def get_version_stamp():
+        """
+        整表的版本戳：记录数、最大id、最近修改时间、版本号之和
+        删除后再新增时记录数和版本号之和可能不变，但自增id一定变大，修改时修改时间和版本号变大
+        """
+        row = db.session.query(func.count(DocFiles.id), func.max(DocFiles.id), func.max(DocFiles.update_time), func.coalesce(func.sum(DocFiles.version), 0)).first()
+        return int(row[0]), row[1], row[2], int(row[3])
+
+    @staticmethod
+    def check_cache_version():
+        """
+        每隔 doc_files_cache_interval 秒检查一次版本戳，有变化就清空缓存
+        """
+        interval = float(app_config.get('doc_files_cache_interval', 5))
+        now = time.time()
+        if now - DocFiles._cache_check_time < interval:
+            return
+        stamp = DocFiles.get_version_stamp()
+        with DocFiles._cache_lock:
+            if stamp != DocFiles._cache_stamp:
+                DocFiles._cache.clear()
+                DocFiles._cache_stamp = stamp
+            DocFiles._cache_check_time = now
 
     @staticmethod
     def getList(type=0,child_type_1=0,child_type_2=0,file_name=""):
@@ -64,6 +119,7 @@ class DocFiles(db.Model):
         txDocId = item.tx_doc_id
         DocFiles.query.filter(and_(DocFiles.id == id)).delete()
         db.session.commit()
+        DocFiles.clear_cache()
         return txDocId
 
     @staticmethod
@@ -77,14 +133,18 @@ class DocFiles(db.Model):
             item.markdown_content = markdown
             item.html_content = html
             item.file_key = key
+        DocFiles.bump_version(item)
         db.session.commit()
+        DocFiles.clear_cache()
 
     @staticmethod
     def editOne01(data):
         item =  DocFiles.getOneById(data['id'])
         item.markdown = data['markdown']
         item.cammand = data['cammand']
+        DocFiles.bump_version(item)
         db.session.commit()
+        DocFiles.clear_cache()
 
     @staticmethod
     def editOne2(data):
@@ -97,13 +157,17 @@ class DocFiles(db.Model):
         item.title_show = data['title_show']
         item.big_title_show = data['big_title_show']
         item.file_name = data['file_name']
+        DocFiles.bump_version(item)
         db.session.commit()
+        DocFiles.clear_cache()
 
     @staticmethod
     def editOneCammand(data):
         item =  DocFiles.getOneById(data['id'])
         item.cammand = data['cammand']
+        DocFiles.bump_version(item)
         db.session.commit()
+        DocFiles.clear_cache()
 
 
 
@@ -126,8 +190,19 @@ class DocFiles(db.Model):
     def getStandarFile(type:str,child_type_1=0,child_type_2=0,step=0):
         '''
         获取缺陷管理/产品管理的标准文档
+        返回的是只读快照，按版本戳缓存在进程内，后台修改后各进程最多 doc_files_cache_interval 秒内重新加载
         '''
-        item = DocFiles.getOne(type, child_type_1, child_type_2, step)
+        DocFiles.check_cache_version()
+        key = (str(type), int(child_type_1), int(child_type_2), int(step))
+        item = DocFiles._cache.get(key)
+        if item is not None:
+            return item
+        record = DocFiles.getOne(type, child_type_1, child_type_2, step)
+        if record is None:
+            return None
+        item = SimpleNamespace(**record.to_dict())
+        with DocFiles._cache_lock:
+            DocFiles._cache[key] = item
         return item
 
     @staticmethod
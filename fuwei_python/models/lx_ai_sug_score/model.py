@@ -272,4 +272,35 @@ class LxAntiShakeLog(db.Model):
     def add_one(data):
         record = LxAntiShakeLog(lx_id=data["lx_id"],content=data["content"])
         db.session.add(record)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+class LxStepScore(db.Model):
+    """
+    立项评估过程中各步骤的防抖分数和采样日志，多个进程的评分任务往同一张表追加
+    step='log' 的行存采样日志
+    """
+    __tablename__ = 'lx_step_score'
+    id = Column(Integer, primary_key=True)
+    lx_id = Column(Integer, ForeignKey('lx_ai_sug_score.id', ondelete='CASCADE'), nullable=True, index=True, comment="")
+    step = Column(String(20), default="")
+    score = Column(Integer, default=None)
+    content = Column(Text, default=None)
+    create_time = Column(db.DateTime, server_default=func.now(), nullable=False)
+
+    @staticmethod
+    def append(lx_id, step, score=None, content=None):
+        """
+        追加一条记录并返回该步骤当前所有记录(含刚追加的)，按写入顺序
+        """
+        db.session.add(LxStepScore(lx_id=lx_id, step=step, score=score, content=content))
+        db.session.commit()
+        return LxStepScore.get_list(lx_id, step)
+
+    @staticmethod
+    def get_list(lx_id, step):
+        return LxStepScore.query.filter(and_(LxStepScore.lx_id == lx_id, LxStepScore.step == step)).order_by(LxStepScore.id.asc()).all()
+
+    @staticmethod
+    def clear(lx_id):
+        LxStepScore.query.filter(LxStepScore.lx_id == lx_id).delete(synchronize_session=False)
+        db.session.commit()
@@ -2,6 +2,8 @@ from conf.db import db
 from sqlalchemy import Column, Integer, String, Float, and_, DateTime, SmallInteger, func, ForeignKey, Enum
 import enum
 
+from common.aiClient import AiClient
+
 class AntiShakeStatus(enum.Enum):
     """缺陷整体状态枚举"""
     OPEN = 'open'
@@ -17,6 +19,10 @@ class Models(db.Model):
     base_url = Column(String(256), default="")
     model_name = Column(String(128), default="")
     api_key = Column(String(256), default="")
+    # 限流配置，0为不限制，每个进程单独计算，见 common/aiLimiter.py
+    max_concurrency = Column(Integer, default=0, server_default="0", nullable=False)
+    rpm = Column(Integer, default=0, server_default="0", nullable=False)
+    tpm = Column(Integer, default=0, server_default="0", nullable=False)
     aiConfig = {"base_url":"","api_key":"","model_name":"","name":""}
     def to_dict(self):
         return {
@@ -33,7 +39,26 @@ class Models(db.Model):
         Models.aiConfig['api_key'] = ""
         Models.aiConfig['model_name'] = ""
         Models.aiConfig['model_name'] = ""
+        AiClient.invalidate()
+
 
+    @staticmethod
+    def edit_limits(id, limits):
+        """
+        修改限流配置，AiLimiter 每次请求按最新配置计算
+        :param limits: {'max_concurrency', 'rpm', 'tpm'}
+        :return: 模型不存在返回False
+        """
+        record = Models.query.filter(and_(Models.id == id)).first()
+        if record is None:
+            return False
+        record.max_concurrency = limits['max_concurrency']
+        record.rpm = limits['rpm']
+        record.tpm = limits['tpm']
+        db.session.commit()
+        Models.aiConfig['base_url'] = ""
+        AiClient.invalidate()
+        return True
 
     @staticmethod
     def getAll():
@@ -47,6 +72,10 @@ class Models(db.Model):
             Models.aiConfig['api_key'] = record.api_key
             Models.aiConfig['model_name'] = record.model_name
             Models.aiConfig['name'] = record.name
+            Models.aiConfig['id'] = record.id
+            Models.aiConfig['max_concurrency'] = record.max_concurrency
+            Models.aiConfig['rpm'] = record.rpm
+            Models.aiConfig['tpm'] = record.tpm
             return Models.aiConfig
         else:
             return Models.aiConfig
@@ -54,13 +83,15 @@ class Models(db.Model):
     @staticmethod
     def getQwPlus():
         record = Models.query.filter(and_(Models.key_name == 'ali-qwen-plus')).first()
-        config = {"base_url":record.base_url,"api_key":record.api_key,"model_name":record.model_name,"name":record.name}
+        config = {"base_url":record.base_url,"api_key":record.api_key,"model_name":record.model_name,"name":record.name,
+                  "id":record.id,"max_concurrency":record.max_concurrency,"rpm":record.rpm,"tpm":record.tpm}
         return config
 
     @staticmethod
     def getModuleModel(model_id):
         record = Models.query.filter(and_(Models.id == model_id)).first()
-        config = {"base_url": record.base_url, "api_key": record.api_key, "model_name": record.model_name,"name":record.name}
+        config = {"base_url": record.base_url, "api_key": record.api_key, "model_name": record.model_name,"name":record.name,
+                  "id":record.id,"max_concurrency":record.max_concurrency,"rpm":record.rpm,"tpm":record.tpm}
         return config
 
 class ModuleToModel(db.Model):
@@ -69,9 +100,14 @@ class ModuleToModel(db.Model):
     module = Column(Integer, default=0)
     model_id = Column(Integer,ForeignKey('models.id', ondelete='CASCADE'), default=0)
     anti_shake_status = Column(String(20), Enum(AntiShakeStatus), nullable=False, default=AntiShakeStatus.CLOSED)
+    # 防抖时是否一次请求返回全部采样(n参数)，模型不支持时自动改为并发请求
+    multi_sample_status = Column(String(20), nullable=False, default="closed", server_default="closed")
+    # 备用模型：主模型响应慢时对冲请求，主模型熔断时改用
+    hedge_model_id = Column(Integer,ForeignKey('models.id', ondelete='SET NULL'), nullable=True, default=None)
     create_time = Column(db.DateTime, server_default=func.now(), nullable=False)
     update_time = Column(db.DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
-    model = db.relationship('Models', backref='ModuleToModel', lazy=True)
+    model = db.relationship('Models', foreign_keys=[model_id], backref='ModuleToModel', lazy=True)
+    hedge_model = db.relationship('Models', foreign_keys=[hedge_model_id], lazy=True)
 
     def to_dict(self):
         return {
@@ -90,7 +126,12 @@ class ModuleToModel(db.Model):
         record = ModuleToModel.get_module_model(data['module'])
         record.model_id = data['model']
         record.anti_shake_status = data['shake']
+        if 'multi' in data:
+            record.multi_sample_status = data['multi']
+        if 'hedge' in data:
+            record.hedge_model_id = None if str(data['hedge']) in ["", "0"] or str(data['hedge']) == str(data['model']) else data['hedge']
         db.session.commit()
+        AiClient.invalidate()
 
     @staticmethod
     def get_all():
@@ -100,6 +141,8 @@ class ModuleToModel(db.Model):
             data[str(item.module)] = {}
             data[str(item.module)]['id'] = item.model_id
             data[str(item.module)]['anti_shake_status'] = item.anti_shake_status
+            data[str(item.module)]['hedge_model_id'] = item.hedge_model_id
+            data[str(item.module)]['multi_sample_status'] = item.multi_sample_status
 
         return data
 
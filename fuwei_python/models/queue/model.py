@@ -1,4 +1,7 @@
-from sqlalchemy import Column, Integer, String, func, DateTime, and_
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Integer, String, Text, func, DateTime, and_, or_
+from sqlalchemy.dialects.mysql import LONGTEXT
 
 from conf.db import db
 
@@ -74,3 +77,124 @@ class Smsqueue(db.Model):
             Smsqueue.query.filter(and_(Smsqueue.id == item.id)).update({"e1":e1, "e2":e2, "send_num":item.send_num})
             db.session.commit()
             return None
+
+
+class AiJobQueue(db.Model):
+    """
+    AI评估任务队列，由 ai_worker.py 的worker进程消费
+    state: pending 等待执行, running 执行中, done 完成, failed 失败
+    """
+    __tablename__ = 'ai_job_queue'
+    id = Column(Integer, primary_key=True)
+    job_type = Column(String(64), default="")
+    # 同时兼容MySQL和SQLite
+    payload = Column(Text().with_variant(LONGTEXT(), "mysql"), default="")
+    admin_user_id = Column(Integer, default=0, index=True)
+    state = Column(String(20), default="pending", index=True)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    run_after = Column(DateTime, nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+    worker = Column(String(128), default="")
+    error_mess = Column(Text, default="")
+    create_time = Column(db.DateTime, server_default=func.now(),nullable=False)
+    update_time = Column(DateTime,server_default=func.now(), onupdate=func.now(),nullable=False)
+
+    def to_dict(self):
+        return {
+            column.name: getattr(self, column.name)for column in self.__table__.columns
+        }
+
+    @staticmethod
+    def add_one(data):
+        record = AiJobQueue(job_type=data['job_type'], payload=data['payload'], admin_user_id=data['admin_user_id'], max_attempts=data['max_attempts'], state="pending")
+        db.session.add(record)
+        db.session.commit()
+        return record.id
+
+    @staticmethod
+    def bulk_add(datas):
+        objects = []
+        for data in datas:
+            objects.append(AiJobQueue(job_type=data['job_type'], payload=data['payload'], admin_user_id=data['admin_user_id'], max_attempts=data['max_attempts'], state="pending"))
+        db.session.bulk_save_objects(objects)
+        db.session.commit()
+
+    @staticmethod
+    def claimable_filter(now):
+        """
+        可以被领取的任务：等待中且到了执行时间的，或者执行中但可见性超时(worker已失联)的
+        """
+        return or_(
+            and_(AiJobQueue.state == "pending", or_(AiJobQueue.run_after.is_(None), AiJobQueue.run_after <= now)),
+            and_(AiJobQueue.state == "running", AiJobQueue.locked_until < now),
+        )
+
+    @staticmethod
+    def claim(worker, visibility_timeout):
+        """
+        按租户(admin_user_id)公平领取一个任务：优先领取正在执行任务最少的租户的最早任务
+        :param worker: worker名称
+        :param visibility_timeout: 可见性超时(秒)，超时没有心跳的任务会被重新领取
+        :return: 领取到的任务，没有任务返回None
+        """
+        now = datetime.now()
+        # 超过最大重试次数且worker已失联的任务直接置为失败
+        AiJobQueue.query.filter(and_(AiJobQueue.state == "running", AiJobQueue.locked_until < now, AiJobQueue.attempts >= AiJobQueue.max_attempts)).update({"state": "failed", "error_mess": "worker执行超时"}, synchronize_session=False)
+        db.session.commit()
+        candidates = db.session.query(AiJobQueue.admin_user_id, func.min(AiJobQueue.id)).filter(AiJobQueue.claimable_filter(now)).group_by(AiJobQueue.admin_user_id).all()
+        if len(candidates) == 0:
+            return None
+        running = dict(db.session.query(AiJobQueue.admin_user_id, func.count(AiJobQueue.id)).filter(and_(AiJobQueue.state == "running", AiJobQueue.locked_until >= now)).group_by(AiJobQueue.admin_user_id).all())
+        candidates.sort(key=lambda c: (running.get(c[0], 0), c[1]))
+        for admin_user_id, job_id in candidates:
+            # 条件更新保证多个worker同时领取时只有一个成功
+            num = AiJobQueue.query.filter(and_(AiJobQueue.id == job_id, AiJobQueue.claimable_filter(now))).update({
+                "state": "running",
+                "worker": worker,
+                "attempts": AiJobQueue.attempts + 1,
+                "locked_until": now + timedelta(seconds=visibility_timeout),
+            }, synchronize_session=False)
+            db.session.commit()
+            if num == 1:
+                return AiJobQueue.query.filter(AiJobQueue.id == job_id).first()
+        return None
+
+    @staticmethod
+    def heartbeat(job_id, worker, visibility_timeout):
+        AiJobQueue.query.filter(and_(AiJobQueue.id == job_id, AiJobQueue.worker == worker, AiJobQueue.state == "running")).update({"locked_until": datetime.now() + timedelta(seconds=visibility_timeout)}, synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def owned_filter(job_id, worker):
+        """
+        还由worker持有的任务：可见性超时后被其他worker重新领取的，原来的worker不能再更新
+        """
+        return and_(AiJobQueue.id == job_id, AiJobQueue.worker == worker, AiJobQueue.state == "running")
+
+    @staticmethod
+    def set_done(job_id, worker):
+        """
+        :return: 更新的条数，任务已被其他worker领取时为0
+        """
+        num = AiJobQueue.query.filter(AiJobQueue.owned_filter(job_id, worker)).update({"state": "done", "locked_until": None}, synchronize_session=False)
+        db.session.commit()
+        return num
+
+    @staticmethod
+    def set_error(job, worker, error_mess, retry_delay):
+        """
+        任务执行异常：没到最大次数的延迟retry_delay秒后重试，否则置为失败
+        :return: 更新的条数，任务已被其他worker领取时为0
+        """
+        if job.attempts < job.max_attempts:
+            data = {"state": "pending", "locked_until": None, "run_after": datetime.now() + timedelta(seconds=retry_delay), "error_mess": error_mess}
+        else:
+            data = {"state": "failed", "locked_until": None, "error_mess": error_mess}
+        num = AiJobQueue.query.filter(AiJobQueue.owned_filter(job.id, worker)).update(data, synchronize_session=False)
+        db.session.commit()
+        return num
+
+    @staticmethod
+    def get_state_count():
+        return dict(db.session.query(AiJobQueue.state, func.count(AiJobQueue.id)).group_by(AiJobQueue.state).all())
@@ -1,5 +1,9 @@
+from datetime import datetime, timedelta
+
 from conf.db import db
-from sqlalchemy import  Column, Integer, String ,Float,and_,DateTime,func
+from sqlalchemy import  Column, Integer, String ,Float,and_,DateTime,func,Text,UniqueConstraint
+from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.exc import IntegrityError
 class UploadFiles(db.Model):
     __tablename__ = 'upload_files'
     id = Column(Integer, primary_key=True)
@@ -26,3 +30,83 @@ class UploadFiles(db.Model):
         for item in items:
             pics.append(item.file_key_url)
         return pics
+
+
+class DocParseCache(db.Model):
+    """
+    文档解析结果缓存，file_hash 是上传文件内容的sha256
+    保存解析出的markdown和其中 [IMAGE_xxx] 占位符对应的图片url，相同文件再次上传时不再提交阿里云解析
+    """
+    __tablename__ = 'doc_parse_cache'
+    id = Column(Integer, primary_key=True)
+    file_hash = Column(String(64), unique=True, nullable=False)
+    markdown = Column(Text().with_variant(LONGTEXT(), "mysql"), default="")
+    image_urls = Column(Text().with_variant(LONGTEXT(), "mysql"), default="")
+    hit_count = Column(Integer, default=0)
+    last_hit_time = Column(DateTime, server_default=func.now(), nullable=False)
+    create_time = Column(db.DateTime, server_default=func.now(),nullable=False)
+
+    @staticmethod
+    def get_by_hash(file_hash, ttl):
+        """
+        :param ttl: 有效期(秒)
+        :return: 未命中或已过期返回None
+        """
+        item = DocParseCache.query.filter(DocParseCache.file_hash == file_hash).first()
+        if item is None:
+            return None
+        if item.create_time < datetime.now() - timedelta(seconds=ttl):
+            db.session.delete(item)
+            db.session.commit()
+            return None
+        item.hit_count = item.hit_count + 1
+        item.last_hit_time = datetime.now()
+        db.session.commit()
+        return item
+
+    @staticmethod
+    def add_one(data):
+        record = DocParseCache(file_hash=data['file_hash'], markdown=data['markdown'], image_urls=data['image_urls'])
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 相同文件同时上传时已被其他进程写入
+            db.session.rollback()
+
+
+class UploadProgress(db.Model):
+    """
+    文档上传解析进度，web进程和worker进程共用，每次更新 version 加1，SSE接口按 version 判断是否有变化
+    """
+    __tablename__ = 'upload_progress'
+    __table_args__ = (UniqueConstraint('user_id', 'record_id', name='uq_upload_progress_user_record'),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, default=0)
+    record_id = Column(String(64), default="")
+    stage = Column(String(32), default="")
+    detail = Column(String(255), default="")
+    version = Column(Integer, default=0)
+    create_time = Column(db.DateTime, server_default=func.now(),nullable=False)
+    update_time = Column(DateTime,server_default=func.now(), onupdate=func.now(),nullable=False)
+
+    @staticmethod
+    def get_one(user_id, record_id):
+        return UploadProgress.query.filter(and_(UploadProgress.user_id == int(user_id), UploadProgress.record_id == str(record_id))).first()
+
+    @staticmethod
+    def set_stage(user_id, record_id, stage, detail=""):
+        item = UploadProgress.get_one(user_id, record_id)
+        if item is None:
+            db.session.add(UploadProgress(user_id=int(user_id), record_id=str(record_id), stage=stage, detail=detail, version=1))
+            try:
+                db.session.commit()
+                return
+            except IntegrityError:
+                # 其他进程同时写入了第一条进度
+                db.session.rollback()
+                item = UploadProgress.get_one(user_id, record_id)
+        item.stage = stage
+        item.detail = detail
+        item.version = item.version + 1
+        db.session.commit()
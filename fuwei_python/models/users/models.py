@@ -483,6 +483,18 @@ class MobileUserRight(db.Model):
         setattr(item,key,val)
         db.session.commit()
 
+    @staticmethod
+    def reserve_request_num(item, num):
+        """
+        一次性预占num次提问次数，剩余次数不足时不预占
+        :return: 是否预占成功
+        """
+        rs = MobileUserRight.query.filter(and_(MobileUserRight.id == item.id, MobileUserRight.requested_num + num <= MobileUserRight.request_num)).update(
+            {'requested_num': MobileUserRight.requested_num + num}, synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(item)
+        return rs == 1
+
     @staticmethod
     def check_request_right(mobileUserRightRecord, type="request",invite_num =None):
         if type =="request":
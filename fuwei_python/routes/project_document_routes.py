@@ -6,9 +6,9 @@ import re
 import time
 from datetime import datetime
 
-import requests
 from flask import Blueprint, request, jsonify, current_app, g, render_template, Response, stream_with_context
 
+from common.aiServer import AiServer
 from common.aliOss import aliOss
 from conf.config import app_config
 from models.project_document.model import ProjectDocument, DocumentAttachment, ImprovementDraft, DocumentNode, \
@@ -2087,11 +2087,10 @@ def material_delete_file():
                 "Authorization": "Bearer token123"
             }
             response = None
-            response = requests.post(
-                f"{app_config['ai_server']}/api/kb/documents",
+            response = AiServer.post(
+                "/api/kb/documents",
                 json=payload,
-                headers=headers,
-                timeout=600
+                headers=headers
             )
             data = response.json()
             print(data)
@@ -2504,9 +2503,8 @@ def ai_deal_file():
         g.user_id = 0
         file_keys = ['README202601141708330.md']
         for file_key in  file_keys:
-            cache = current_app.extensions.get('cache')
-            cache.setdefault(str(g.user_id) + "upload_state" + str(record_id), "uploading")
-            mark_down_text = UploadFileService.ai_deal(g.user_id, file_key, cache, record_id, from_type="project_document")
+            UploadFileService.set_progress(g.user_id, record_id, "uploaded")
+            mark_down_text = UploadFileService.ai_deal(g.user_id, file_key, None, record_id)
             print(mark_down_text)
             return mark_down_text
     except Exception as e:
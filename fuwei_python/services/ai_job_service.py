@@ -0,0 +1,173 @@
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+from flask import current_app
+
+from conf.config import app_config
+from conf.db import db
+from models.queue.model import AiJobQueue
+
+
+class AiJobService:
+    """
+    持久化的AI评估任务队列(表ai_job_queue)
+    web进程只负责入队，ai_worker.py 启动的worker进程负责领取执行，任务在重启后不会丢失
+    """
+    # 任务类型 => 处理函数(模块:函数)，worker里按需导入，避免循环引用
+    HANDLERS = {
+        'api_ai_val': 'user.api:done_ai_job',
+        'ai_val_batch': 'user.aiVal:threadBatchValDone',
+        'ai_val_zip_import': 'user.aiVal:threadZipBatchImport',
+        'ai_val_batch_eval': 'user.aiVal:batchValDone',
+        'lx_ai_done': 'user.lxAiVal:ai_done_thread',
+        'lx_upload_parse': 'user.lxAiVal:lx_upload_parse',
+    }
+    # 任务类型 => 重试次数用完仍失败时的处理函数，参数是任务参数加上错误信息
+    FAIL_HANDLERS = {
+        'api_ai_val': 'user.api:done_ai_failed',
+        'ai_val_zip_import': 'user.aiVal:zipBatchImportFailed',
+    }
+
+    @staticmethod
+    def get_config():
+        return {
+            'visibility_timeout': int(app_config.get('ai_job_visibility_timeout', 300)),
+            'max_attempts': int(app_config.get('ai_job_max_attempts', 3)),
+            'retry_delay': int(app_config.get('ai_job_retry_delay', 30)),
+            'poll_interval': float(app_config.get('ai_job_poll_interval', 1)),
+            'chunk_size': int(app_config.get('ai_job_chunk_size', 10)),
+        }
+
+    @staticmethod
+    def enqueue(job_type, args, admin_user_id=0, max_attempts=None):
+        """
+        任务入队
+        :param job_type: HANDLERS里的任务类型
+        :param args: 处理函数的参数列表，必须可以json序列化
+        :param admin_user_id: 租户id，用于公平调度
+        :param max_attempts:
+        :return: 任务id
+        """
+        if job_type not in AiJobService.HANDLERS:
+            raise ValueError(f"未知的任务类型：{job_type}")
+        if max_attempts is None:
+            max_attempts = AiJobService.get_config()['max_attempts']
+        return AiJobQueue.add_one({
+            'job_type': job_type,
+            'payload': json.dumps(args, ensure_ascii=False),
+            'admin_user_id': admin_user_id,
+            'max_attempts': max_attempts,
+        })
+
+    @staticmethod
+    def enqueue_many(job_type, args_list, admin_user_id=0):
+        """
+        批量入队，每组参数一个任务
+        """
+        max_attempts = AiJobService.get_config()['max_attempts']
+        jobs = []
+        for args in args_list:
+            jobs.append({
+                'job_type': job_type,
+                'payload': json.dumps(args, ensure_ascii=False),
+                'admin_user_id': admin_user_id,
+                'max_attempts': max_attempts,
+            })
+        if len(jobs) > 0:
+            AiJobQueue.bulk_add(jobs)
+        return len(jobs)
+
+    @staticmethod
+    def enqueue_chunks(job_type, datas, admin_user_id=0, extra_args=()):
+        """
+        把记录列表按 ai_job_chunk_size 切块，每块一个任务批量入队
+        """
+        config = AiJobService.get_config()
+        size = config['chunk_size']
+        jobs = []
+        for i in range(0, len(datas), size):
+            jobs.append({
+                'job_type': job_type,
+                'payload': json.dumps([datas[i:i + size]] + list(extra_args), ensure_ascii=False),
+                'admin_user_id': admin_user_id,
+                'max_attempts': config['max_attempts'],
+            })
+        if len(jobs) > 0:
+            AiJobQueue.bulk_add(jobs)
+        return len(jobs)
+
+    @staticmethod
+    def get_handler(job_type, handlers=None):
+        if handlers is None:
+            handlers = AiJobService.HANDLERS
+        module_name, func_name = handlers[job_type].split(':')
+        return getattr(importlib.import_module(module_name), func_name)
+
+    @staticmethod
+    def run_job(job, worker, config):
+        """
+        执行一个任务，执行期间定时续期可见性超时
+        """
+        stop = threading.Event()
+
+        def heartbeat():
+            from app import app
+            with app.app_context():
+                while not stop.wait(config['visibility_timeout'] / 3):
+                    try:
+                        AiJobQueue.heartbeat(job.id, worker, config['visibility_timeout'])
+                    except Exception as e:
+                        print(f"任务心跳失败{job.id}:{e}")
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            handler = AiJobService.get_handler(job.job_type)
+            handler(*json.loads(job.payload))
+            if AiJobQueue.set_done(job.id, worker) == 0:
+                current_app.logger.error(f"AI任务已被其他worker重新领取-{job.job_type}-{job.id}")
+        except Exception as e:
+            current_app.logger.error(f"AI任务执行失败-{job.job_type}-{job.id}：{e}\n{traceback.format_exc()}")
+            # 处理函数里数据库出错时会话处于待回滚状态，先回滚才能更新任务状态
+            db.session.rollback()
+            num = AiJobQueue.set_error(job, worker, f"{e}", config['retry_delay'] * job.attempts)
+            # 任务已被其他worker重新领取时由那个worker处理最终失败
+            if num == 1 and job.attempts >= job.max_attempts and job.job_type in AiJobService.FAIL_HANDLERS:
+                try:
+                    AiJobService.get_handler(job.job_type, AiJobService.FAIL_HANDLERS)(*json.loads(job.payload), f"{e}")
+                except Exception as fail_e:
+                    current_app.logger.error(f"AI任务失败处理异常-{job.job_type}-{job.id}：{fail_e}")
+        finally:
+            stop.set()
+
+    @staticmethod
+    def run_worker(name=None):
+        """
+        worker主循环：不断领取任务执行，没有任务时按 ai_job_poll_interval 休眠
+        """
+        from app import app
+        config = AiJobService.get_config()
+        if name is None:
+            name = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+        while True:
+            with app.app_context():
+                job = None
+                try:
+                    job = AiJobQueue.claim(name, config['visibility_timeout'])
+                except Exception as e:
+                    print(f"领取任务失败：{e}")
+                if job is not None:
+                    job_id = job.id
+                    try:
+                        AiJobService.run_job(job, name, config)
+                    except Exception as e:
+                        # 更新任务状态失败时不能让worker线程退出，任务在可见性超时后会被重新领取
+                        print(f"任务{job_id}状态更新失败：{e}")
+                        db.session.rollback()
+                    continue
+            time.sleep(config['poll_interval'])
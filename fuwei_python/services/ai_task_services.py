@@ -12,6 +12,7 @@ import requests
 from flask import current_app, jsonify
 from sqlalchemy import and_, func
 
+from common.aiServer import AiServer
 from common.aliOss import aliOss
 from conf.config import app_config
 from models.project_document.model import (
@@ -73,11 +74,10 @@ class AITaskService:
         }
         try:
             response = None
-            response = requests.post(
-                f"{app_config['ai_server']}/api/industry",
+            response = AiServer.post(
+                "/api/industry",
                 json=payload,
-                headers=headers,
-                timeout=600
+                headers=headers
             )
             data = response.json()
             print(f"industry_data:{data}")
@@ -117,19 +117,19 @@ class AITaskService:
             thread.start()
             all_thread.append(thread)
             for payload in level1_payloads:
-                thread = threading.Thread(target=AITaskService.done_level1_key_point, args=(payload,0))
+                thread = threading.Thread(target=AITaskService.done_level1_key_point, args=(payload,))
                 thread.start()
                 all_thread.append(thread)
             now_exec_leve2_payload = level2_payloads[0:1]
             next_exec_leve2_payload = level2_payloads[1:]
             for payload in now_exec_leve2_payload:
-                thread = threading.Thread(target=AITaskService.done_level2_key_point,  args=(payload,0))
+                thread = threading.Thread(target=AITaskService.done_level2_key_point,  args=(payload,))
                 thread.start()
                 all_thread.append(thread)
             for thread in all_thread:
                 thread.join()
             for payload in next_exec_leve2_payload:
-                thread = threading.Thread(target=AITaskService.done_level2_key_point,  args=(payload,0))
+                thread = threading.Thread(target=AITaskService.done_level2_key_point,  args=(payload,))
                 thread.start()
             #AITaskService.handle_keypoints(document_id, industry, project_data.get('title'), project_data.get('idea'),outline_full_text_rule)
             return {
@@ -188,7 +188,7 @@ class AITaskService:
                         "prompt": {"chapterKeypointPrompt": level_one_chapter_prompt}
                     }
                     level1_payload.append(payload)
-                    #thread = threading.Thread(target=AITaskService.done_level1_key_point, args=(payload,0))
+                    #thread = threading.Thread(target=AITaskService.done_level1_key_point, args=(payload,))
                     #thread.start()
                     #chapter_threads.append(thread)
                 else:
@@ -266,11 +266,10 @@ class AITaskService:
             }
             try:
                 response = None
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/project-outline",
+                response = AiServer.post(
+                    "/api/project-outline",
                     json=payload,
-                    headers=headers,
-                    timeout=600
+                    headers=headers
                 )
                 data = response.json()
                 print(data)
@@ -344,10 +343,33 @@ class AITaskService:
             with ThreadPoolExecutor(max_workers=10) as executor:
                 for payload in payload_list:
                     # submit返回Future对象，用于获取结果/设置回调
-                    executor.submit(AITaskService.done_level2_key_point, payload,0)
+                    executor.submit(AITaskService.done_level2_key_point, payload)
+
+    @staticmethod
+    def post_key_point(path, payload, headers):
+        """
+        请求写作要点接口，返回解析后的json
+        连接失败和429/503由 AiServer.post 重试；ai_server返回5xx或者返回的不是合法json时
+        按退避再请求，最多重试 ai_keypoint_retries 次，超过后抛出异常
+        """
+        retries = int(app_config.get('ai_keypoint_retries', 2))
+        attempt = 0
+        while True:
+            response = AiServer.post(path, json=payload, headers=headers)
+            try:
+                if response.status_code < 500:
+                    return response.json()
+                error = f"HTTP {response.status_code}"
+            except ValueError as e:
+                error = f"返回的不是json：{e}"
+            if attempt >= retries:
+                raise Exception(f"{path}请求失败：{error}")
+            current_app.logger.info_module(f"{path}请求失败，第{attempt + 1}次重试：{error}", "model")
+            AiServer.sleep_backoff(attempt)
+            attempt = attempt + 1
 
     @staticmethod
-    def done_level1_key_point(payload,tag=0):
+    def done_level1_key_point(payload):
         from app import app
         with app.app_context():
             current_app.logger.info(f"调用AI生成一级章节写作要点: {payload}")
@@ -356,25 +378,18 @@ class AITaskService:
                 "Authorization": "Bearer token123"
             }
             try:
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/project-outline/chapterKeyPoint",
-                    json=payload,
-                    headers=headers,
-                    timeout=600
-                )
+                result = AITaskService.post_key_point("/api/project-outline/chapterKeyPoint", payload, headers)
                 print("章节写作要点返回：")
-                print(response.json())
+                print(result)
 
-                DocumentNode.query.filter_by(document_id=payload['projectId'], node_id=payload['chapterId']).update({"key_point": convert_markdown_to_html(response.json().get('keyPoint', '').replace("\\n", "\n")), "updated_at": datetime.now()})
+                DocumentNode.query.filter_by(document_id=payload['projectId'], node_id=payload['chapterId']).update({"key_point": convert_markdown_to_html(result.get('keyPoint', '').replace("\\n", "\n")), "updated_at": datetime.now()})
                 db.session.commit()
             except Exception as e:
-                if tag<3:
-                    AITaskService.done_level1_key_point(payload, tag=tag+1)
-                else:
-                    raise Exception(f"章节生成失败{(json.dumps(payload, ensure_ascii=False))}")
+                db.session.rollback()
+                raise Exception(f"章节生成失败{(json.dumps(payload, ensure_ascii=False))}") from e
 
     @staticmethod
-    def done_level2_key_point(payload,tag=0):
+    def done_level2_key_point(payload):
         from app import app
         with app.app_context():
             print("小节写作要点调用")
@@ -384,26 +399,18 @@ class AITaskService:
                 "Authorization": "Bearer token123"
             }
             try:
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/project-outline/sectionKeyPoint",
-                    json=payload,
-                    headers=headers,
-                    timeout=600
-                )
+                result = AITaskService.post_key_point("/api/project-outline/sectionKeyPoint", payload, headers)
                 print("章节接口返回数据：")
-                print(response.json())
-                child_node_id = response.json().get('sectionId')
+                print(result)
+                child_node_id = result.get('sectionId')
                 DocumentNode.query.filter_by(
                     document_id=payload['projectId'],
                     node_id=child_node_id,
-                ).update({"key_point": convert_markdown_to_html(response.json().get('keyPoint', '').replace("\\n", "\n")), "updated_at": datetime.now()})
+                ).update({"key_point": convert_markdown_to_html(result.get('keyPoint', '').replace("\\n", "\n")), "updated_at": datetime.now()})
                 db.session.commit()
             except Exception as e:
-                if tag<3:
-                    tag = tag+1
-                    AITaskService.done_level2_key_point(payload, tag)
-                else:
-                    raise Exception(f"小节要点生成失败{(json.dumps(payload, ensure_ascii=False))}")
+                db.session.rollback()
+                raise Exception(f"小节要点生成失败{(json.dumps(payload, ensure_ascii=False))}") from e
 
     # =========== 2.1 生成二级章节写作要点 ===========
     @staticmethod
@@ -515,12 +522,11 @@ class AITaskService:
             }
             print(json.dumps(data, ensure_ascii=False))
             # 发送请求，stream=True 表示流式接收
-            response = requests.post(
-                f"{app_config['ai_server']}/api/heuristic-writing",
+            response = AiServer.post(
+                "/api/heuristic-writing",
                 headers=headers,
                 json=data,
                 stream=True,  # 关键：开启流式模式
-                timeout=600
             )
             response.raise_for_status()  # 检查 HTTP 状态码
             messages = ""
@@ -622,12 +628,11 @@ class AITaskService:
         print(json.dumps(data, ensure_ascii=False))
         try:
             # 发送请求，stream=True 表示流式接收
-            response = requests.post(
-                f"{app_config['ai_server']}/api/heuristic-writing/message",
+            response = AiServer.post(
+                "/api/heuristic-writing/message",
                 headers=headers,
                 json=data,
                 stream=True,  # 关键：开启流式模式
-                timeout=600
             )
             response.raise_for_status()  # 检查 HTTP 状态码
 
@@ -695,13 +700,13 @@ class AITaskService:
         # 3. 准备评审数据
         text_list, history_text_list, now_node, write_rule, review_rule, headers,project_doc = AITaskService.get_public_data(document_id, node_id)
         if now_node.level == 1:
-            url = f"{app_config['ai_server']}/api/chapter-review"
+            url = "/api/chapter-review"
             prompt = {"chapterReviewPrompt":AITaskService.get_prompt('chapterReviewPrompt')}
             write_rule_key = "chapterWriteRule"
             review_rule_key = "chapterReviewRule"
             title_key = "chapterTitle"
         else:
-            url = f"{app_config['ai_server']}/api/section-review"
+            url = "/api/section-review"
             prompt = {"sectionReviewPrompt":AITaskService.get_prompt('sectionReviewPrompt')}
             write_rule_key = "sectionWriteRule"
             review_rule_key = "sectionReviewRule"
@@ -726,12 +731,11 @@ class AITaskService:
         # 发送请求，stream=True 表示流式接收
         try:
             response = None
-            response = requests.post(
+            response = AiServer.post(
                 url,
                 headers=headers,
                 json=data,
                 stream=True,  # 关键：开启流式模式
-                timeout=600
             )
             data = response.json()
             current_app.logger.info_module(f"刘豪那边返回的数据：\n {json.dumps(data, indent=4, ensure_ascii=False)}", "admin_view")
@@ -831,12 +835,11 @@ class AITaskService:
                 print(data)
                 # 发送请求，stream=True 表示流式接收
                 response = None
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/i-can/chat",
+                response = AiServer.post(
+                    "/api/i-can/chat",
                     headers=headers,
                     json=data,
                     stream=True,  # 关键：开启流式模式
-                    timeout=600
                 )
                 response.raise_for_status()  # 检查 HTTP 状态码
 
@@ -950,12 +953,11 @@ class AITaskService:
                 }
                 # 发送请求，stream=True 表示流式接收
                 response = None
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/i-can/chat/message",
+                response = AiServer.post(
+                    "/api/i-can/chat/message",
                     headers=headers,
                     json=data,
                     stream=True,  # 关键：开启流式模式
-                    timeout=900
                 )
                 response.raise_for_status()  # 检查 HTTP 状态码
 
@@ -1069,12 +1071,11 @@ class AITaskService:
                 print(json.dumps(data,ensure_ascii=False))
                 # 发送请求，stream=True 表示流式接收
                 response = None
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/merge",
+                response = AiServer.post(
+                    "/api/merge",
                     headers=headers,
                     json=data,
                     stream=True,  # 关键：开启流式模式
-                    timeout=600
                 )
                 json_data = response.json()
                 print("返回的json：")
@@ -1255,12 +1256,11 @@ class AITaskService:
                 "Content-Type": "application/json",
                 "Authorization": "Bearer token123"
             }
-            response = requests.post(
-                f"{app_config['ai_server']}/api/full-review",
+            response = AiServer.post(
+                "/api/full-review",
                 headers=headers,
                 json=data,
                 stream=True,  # 关键：开启流式模式
-                timeout=600
             )
             json_data = response.json()
             # 5. 更新任务状态
@@ -1321,12 +1321,11 @@ class AITaskService:
             #print(json.dumps(data, ensure_ascii=False))
             # 发送请求，stream=True 表示流式接收
             response = None
-            response = requests.post(
-                f"{app_config['ai_server']}/api/full-polish",
+            response = AiServer.post(
+                "/api/full-polish",
                 headers=headers,
                 json=data,
                 stream=True,  # 关键：开启流式模式
-                timeout=600
             )
             json_data = response.json()
             for chapter in json_data.get('newFullText', []):
@@ -1441,11 +1440,10 @@ class AITaskService:
                     "Authorization": "Bearer token123"
                 }
                 response = None
-                response = requests.post(
-                    f"{app_config['ai_server']}/api/kb/documents",
+                response = AiServer.post(
+                    "/api/kb/documents",
                     json=payload,
-                    headers=headers,
-                    timeout=600
+                    headers=headers
                 )
                 data = response.json()
                 print(data)
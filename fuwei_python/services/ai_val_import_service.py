@@ -0,0 +1,172 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from conf.config import app_config
+
+
+class AiValImportService:
+    """
+    批量导入EXCEL的校验和读取，xlsx用 openpyxl 只读模式逐行读取，每 ai_val_import_chunk_rows 行
+    组成一个DataFrame做整列校验(必填、长度)，内存只和块大小有关，和文件行数无关
+    校验和读取分两遍：先校验整个文件，一次返回所有错误的行号和列名，全部通过后再逐块生成记录入队
+    """
+    # 记录类型 => 模板列名，依次对应 step1-step4，第一列必填
+    COLUMNS = {
+        0: ['产品缺陷描述', '原因分析', '解决措施实施', '回归测试'],
+        1: ['需求描述', '需求分析', '需求决策', '验证结果'],
+    }
+    STEPS = ['step1', 'step2', 'step3', 'step4']
+
+    @staticmethod
+    def get_config():
+        return {
+            'chunk_rows': int(app_config.get('ai_val_import_chunk_rows', 1000)),
+            # step字段是TEXT，utf8mb4下中文最多约21000字
+            'max_chars': int(app_config.get('ai_val_import_max_chars', 20000)),
+            'max_errors': int(app_config.get('ai_val_import_max_errors', 1000)),
+        }
+
+    @staticmethod
+    def iter_frames(file_path, columns, chunk_rows):
+        """
+        按块读取模板列，yield 的DataFrame列名是 step1-step4，index 是EXCEL里的行号，空单元格是空字符串
+        缺少模板列时抛出 ValueError
+        """
+        if os.path.splitext(file_path)[-1].lower() == ".xls":
+            # openpyxl 不支持xls，xls最多65536行，整表读入后再分块
+            df = pd.read_excel(file_path, dtype=str)
+            if any(column not in df for column in columns):
+                raise ValueError("请下载标准模板")
+            df = df[columns].fillna('')
+            df.columns = AiValImportService.STEPS
+            df.index = df.index + 2
+            for i in range(0, len(df), chunk_rows):
+                yield df.iloc[i:i + chunk_rows]
+            return
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.active
+            # 只读模式按文件里记录的尺寸读取，有些工具生成的文件尺寸不对，重新计算
+            worksheet.reset_dimensions()
+            rows = worksheet.iter_rows(values_only=True)
+            header = [str(value).strip() if value is not None else "" for value in next(rows, [])]
+            if any(column not in header for column in columns):
+                raise ValueError("请下载标准模板")
+            indexes = [header.index(column) for column in columns]
+            chunk = []
+            row_numbers = []
+            for row_number, row in enumerate(rows, start=2):
+                chunk.append([row[i] if i < len(row) else None for i in indexes])
+                row_numbers.append(row_number)
+                if len(chunk) >= chunk_rows:
+                    yield AiValImportService.to_frame(chunk, row_numbers)
+                    chunk = []
+                    row_numbers = []
+            if len(chunk) > 0:
+                yield AiValImportService.to_frame(chunk, row_numbers)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def to_frame(chunk, row_numbers):
+        df = pd.DataFrame(chunk, columns=AiValImportService.STEPS, index=row_numbers, dtype=object)
+        return df.fillna('').astype(str)
+
+    @staticmethod
+    def check_frame(df, columns, config):
+        """
+        整列校验一块数据，全部为空的行跳过
+        :return: (有效行的DataFrame, [{'row': 行号, 'column': 列名, 'msg': 错误}], 每行是否全部为空的Series)
+        """
+        blank = df.apply(lambda col: col.str.strip() == "")
+        blank_rows = blank.all(axis=1)
+        df = df[~blank_rows]
+        blank = blank.loc[df.index]
+        errors = []
+        masks = [(blank['step1'], columns[0], "不能为空")]
+        for step, column in zip(AiValImportService.STEPS, columns):
+            masks.append((df[step].str.len() > config['max_chars'], column, f"不能超过{config['max_chars']}字"))
+        invalid = pd.Series(False, index=df.index)
+        for mask, column, msg in masks:
+            invalid = invalid | mask
+            for row in df.index[mask]:
+                errors.append({'row': int(row), 'column': column, 'msg': msg})
+        return df[~invalid], errors, blank_rows
+
+    @staticmethod
+    def validate(file_path, record_type):
+        """
+        校验整个文件
+        :return: (有效记录数, 错误列表, 跳过的空行数)，错误按行号排序，
+                 空行数不包括最后一条记录之后的空行(设置过格式的空白行)
+        """
+        config = AiValImportService.get_config()
+        columns = AiValImportService.COLUMNS[int(record_type)]
+        total = 0
+        errors = []
+        skipped = 0
+        # 最后一条记录之后连续的空行数，后面又有记录时才算跳过
+        pending = 0
+        for df in AiValImportService.iter_frames(file_path, columns, config['chunk_rows']):
+            df, chunk_errors, blank_rows = AiValImportService.check_frame(df, columns, config)
+            total = total + len(df)
+            errors.extend(chunk_errors)
+            if (~blank_rows).any():
+                last_row = blank_rows.index[~blank_rows.values][-1]
+                trailing = int(blank_rows[blank_rows.index > last_row].sum())
+                skipped = skipped + pending + int(blank_rows.sum()) - trailing
+                pending = trailing
+            else:
+                pending = pending + len(blank_rows)
+        errors.sort(key=lambda error: (error['row'], columns.index(error['column'])))
+        return total, errors, skipped
+
+    @staticmethod
+    def get_error_response(errors):
+        """
+        校验失败时返回给前端的内容，errors 最多 ai_val_import_max_errors 条，error_num 是总数
+        """
+        return {
+            'msg': AiValImportService.get_error_msg(errors),
+            'code': -1,
+            'errors': errors[:AiValImportService.get_config()['max_errors']],
+            'error_num': len(errors),
+        }
+
+    @staticmethod
+    def get_error_msg(errors, limit=5):
+        msg = "；".join([f"第{error['row']}行[{error['column']}]{error['msg']}" for error in errors[:limit]])
+        if len(errors) > limit:
+            msg = msg + f"……共{len(errors)}处错误"
+        return f"EXCEL数据校验失败：{msg}"
+
+    @staticmethod
+    def iter_records(file_path, record_type, user_id, admin_user_id):
+        """
+        按块生成校验通过的记录，和 validate 用同样的规则
+        """
+        config = AiValImportService.get_config()
+        columns = AiValImportService.COLUMNS[int(record_type)]
+        base_id = int(datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        i = 0
+        for df in AiValImportService.iter_frames(file_path, columns, config['chunk_rows']):
+            df, _, _ = AiValImportService.check_frame(df, columns, config)
+            datas = []
+            for step1, step2, step3, step4 in zip(df['step1'], df['step2'], df['step3'], df['step4']):
+                datas.append({
+                    'step1': step1,
+                    'step2': step2,
+                    'step3': step3,
+                    'step4': step4,
+                    'type': int(record_type),
+                    'user_id': user_id,
+                    'id': str(user_id) + str(base_id + i),
+                    'state': -1,
+                    'admin_user_id': admin_user_id,
+                })
+                i = i + 1
+            if len(datas) > 0:
+                yield datas
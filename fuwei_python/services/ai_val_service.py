@@ -1,12 +1,20 @@
+import hashlib
 import json
+import re
 
 from flask import current_app
 
 from models.ai_sug_score.model import AiSugScore
 from models.ai_sug_score.model import AntiShakeLog
+from models.ai_sug_score.model import AiValCache
+from models.doc_files.model import DocFiles
+from conf.config import app_config
 from models.model.model import ModuleToModel
 from common.Ai import Ai
-from concurrent.futures import ThreadPoolExecutor
+from common.aiBreaker import AiBreaker
+from common.aiLimiter import AiLimiterTimeout
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import threading
 from services.lx_ai_val_service import LxAiValSrvice
 import sys
 import time
@@ -14,41 +22,75 @@ import time
 
 
 class AiValSrvice:
+    # 对冲请求用的线程池，被放弃的慢请求在这里自然结束
+    _executor = None
+    _executor_lock = threading.Lock()
+
     @staticmethod
     def get_score_suggestion(record_type,data):
         module= ModuleToModel.get_module_model(record_type)
         model = module.model.to_dict()
+        hedge_model = module.hedge_model.to_dict() if module.hedge_model is not None else None
         module = module.to_dict()
         content_logs = ""
         res = {}
+        cache_key = None
+        if AiValSrvice.get_cache_config()['status'] == "open":
+            cache_key = AiValSrvice.get_cache_key(record_type, data, model, module)
+            cache_res = AiValSrvice.get_cache(cache_key, data)
+            if cache_res is not None:
+                return cache_res
         if module['anti_shake_status'] == "closed" and  model['key_name'] !="xj-qianwen":
-            result = Ai.get_score_suggestion(record_type,data,model)
+            result = AiValSrvice.call_model(record_type,data,model,hedge_model)
             if result['state'] < 0:
                 AiSugScore.edit_ai_false_state(data, result['error_message'])
                 raise Exception(result['error_message'])
             res = result
         elif module['anti_shake_status'] == "open" and model['key_name'] !="xj-qianwen":
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                future_list = [executor.submit(AiValSrvice.ai_get_score_suggestion, record_type,data,model) for step in  range(1,6)]
-            # 等待所有任务完成，并获取结果
-                results = [future.result() for future in future_list]
-                res = results[0]
-                score_lists = {}
-                step_average_score = {}
-                for step in AiSugScore.columnStep:
-                    score_lists[step] = []
-                    for result in results:
-                        if step+'_score' in result and int(result[step+'_score'])>=0:
-                            score_lists[step].append(int(result[step+'_score']))
-                        else:
-                            AiSugScore.edit_ai_false_state(data, result['error_message'])
-                            raise Exception(result['error_message'])
-                    step_average_score[step] = LxAiValSrvice.get_step_average_score(score_lists[step])
-                    content_logs = f"{content_logs}{AiSugScore.pageShowConfig[int(record_type)][step]}5次分数:{score_lists[step]},平均分：{step_average_score[step]}<br>"
-                    res[step+"_score"] = step_average_score[step]
+            config = LxAiValSrvice.get_anti_shake_config()
+            results = None
+            # 只在熔断正常时尝试，不占用半开状态的探测名额，探测交给下面的单次请求
+            if module['multi_sample_status'] == "open" and AiBreaker.is_closed(model):
+                # 一次请求返回全部首轮采样，不支持或失败时改为并发请求
+                start_time = time.time()
+                try:
+                    results = Ai.get_score_suggestions_n(record_type, data, model, config['min_samples'], config['multi_sample_timeout'])
+                    AiBreaker.record(model, True, time.time() - start_time)
+                except AiLimiterTimeout:
+                    # 本进程排队超时，没有请求模型，不记入熔断
+                    pass
+                except Exception as e:
+                    AiBreaker.record(model, False, time.time() - start_time)
+                    current_app.logger.info_module(f"多采样请求失败，改为并发请求-{model['model_name']}：{e}", "model")
+            if results is None:
+                # 每次采样用data的副本，模型调用会把结果写进传入的dict，共用一个dict时各次采样的分数相同
+                with ThreadPoolExecutor(max_workers=config['min_samples']) as executor:
+                    future_list = [executor.submit(AiValSrvice.ai_get_score_suggestion, record_type,dict(data),model,hedge_model) for i in  range(config['min_samples'])]
+                # 等待所有任务完成，并获取结果
+                    results = [future.result() for future in future_list]
+            score_lists = AiValSrvice.get_score_lists(results, data)
+            # 各步骤分数分歧超过容忍度时才追加采样
+            converged = AiValSrvice.is_converged(score_lists, config)
+            while len(results) < config['max_samples'] and not converged:
+                results.append(AiValSrvice.ai_get_score_suggestion(record_type, dict(data), model, hedge_model))
+                score_lists = AiValSrvice.get_score_lists(results, data)
+                converged = AiValSrvice.is_converged(score_lists, config)
+            # 第一次采样的评估内容加上平均分写回data
+            data.update(results[0])
+            res = data
+            step_average_score = {}
+            for step in AiSugScore.columnStep:
+                step_average_score[step] = LxAiValSrvice.get_step_average_score(score_lists[step])
+                content_logs = f"{content_logs}{AiSugScore.pageShowConfig[int(record_type)][step]}{len(score_lists[step])}次分数:{score_lists[step]},平均分：{step_average_score[step]}<br>"
+                res[step+"_score"] = step_average_score[step]
+            if converged:
+                stop_rule = f"各步骤分数差均不超过{config['tolerance']}分，提前停止"
+            else:
+                stop_rule = f"分数分歧较大，达到最大采样次数{config['max_samples']}次"
+            content_logs = f"{content_logs}防抖采样{len(results)}次：{stop_rule}<br>"
         elif model['key_name'] =="xj-qianwen":
             start_time = time.time()
-            result = Ai.get_xjqw_score_suggestion(data,model,record_type)
+            result = AiValSrvice.call_model(record_type,data,model,hedge_model)
             end_time = time.time()
             if (end_time-start_time)>60:
                 current_app.logger.error(f"Ai.get_xjqw_score_suggestion-新疆千问请求超一两分钟，请求时间：{end_time-start_time}")
@@ -57,7 +99,9 @@ class AiValSrvice:
                 raise Exception(result['error_message'])
             res = result
             try:
-                content_logs = AiValSrvice.get_xj_qianwen_log(result,record_type)
+                # 对冲到其他模型时没有新疆千问的防抖日志
+                if 'LLM_print' in result:
+                    content_logs = AiValSrvice.get_xj_qianwen_log(result,record_type)
                 print(content_logs)
             except Exception as e:
                 data['state'] = -4
@@ -67,12 +111,218 @@ class AiValSrvice:
                 raise Exception("AI接口没按约定的格式返回数据")
         if content_logs != "":
             AntiShakeLog.add_one({"val_id":data['id'],"type":record_type,"content":content_logs})
+        AiValSrvice.set_cache(cache_key, record_type, model, res)
         return res
+
+    @staticmethod
+    def get_score_suggestion_stream(record_type, data, on_step=None):
+        """
+        流式评估，每个步骤解析完成就入库并回调on_step(step, data)
+        防抖、新疆千问、主模型熔断时不支持流式，按 get_score_suggestion 评估完再一起返回
+        """
+        module= ModuleToModel.get_module_model(record_type)
+        model = module.model.to_dict()
+        module = module.to_dict()
+        if module['anti_shake_status'] != "closed" or model['key_name'] == "xj-qianwen":
+            return AiValSrvice.get_score_suggestion(record_type, data)
+        cache_key = None
+        if AiValSrvice.get_cache_config()['status'] == "open":
+            cache_key = AiValSrvice.get_cache_key(record_type, data, model, module)
+            cache_res = AiValSrvice.get_cache(cache_key, data)
+            if cache_res is not None:
+                return cache_res
+
+        def step_done(step, result):
+            AiSugScore.edit_ai_step(result, step)
+            if on_step is not None:
+                on_step(step, result)
+        # 先查缓存再占用熔断的探测名额，命中缓存时不请求模型
+        if not AiBreaker.allow(model):
+            return AiValSrvice.get_score_suggestion(record_type, data)
+        start_time = time.time()
+        result = None
+        try:
+            result = Ai.get_score_suggestion_stream(record_type, data, model, step_done)
+        finally:
+            AiValSrvice.record_breaker(model, result, time.time() - start_time)
+        if result['state'] < 0:
+            AiSugScore.edit_ai_false_state(data, result['error_message'])
+            raise Exception(result['error_message'])
+        AiValSrvice.set_cache(cache_key, record_type, model, result)
+        return result
+
+    @staticmethod
+    def get_cache_config():
+        return {
+            'status': app_config.get('ai_val_cache_status', 'open'),
+            'ttl': int(app_config.get('ai_val_cache_ttl', 7 * 24 * 3600)),
+            'max_rows': int(app_config.get('ai_val_cache_max_rows', 20000)),
+            'evict_every': int(app_config.get('ai_val_cache_evict_every', 100)),
+        }
+
+    @staticmethod
+    def get_cache_key(record_type, data, model, module):
+        """
+        评估结果缓存的key：记录类型、规范化后的步骤内容、标准文档版本、模型id、防抖模式
+        """
+        steps = [re.sub(r'\s+', ' ', str(data.get(step, ''))).strip() for step in AiSugScore.columnStep]
+        standard_file = DocFiles.getStandarFile(str(record_type))
+        standard_version = ""
+        if standard_file is not None:
+            standard_version = f"{standard_file.id}-{standard_file.version}"
+        anti_shake = module['anti_shake_status']
+        if anti_shake == "open":
+            # 超时不影响评估结果，不放进缓存键
+            config = LxAiValSrvice.get_anti_shake_config()
+            config.pop('multi_sample_timeout')
+            anti_shake = f"{anti_shake}-{json.dumps(config, sort_keys=True)}"
+        key = json.dumps([int(record_type), steps, standard_version, model['id'], anti_shake], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_cache(cache_key, data):
+        """
+        命中缓存时把缓存的评估结果写入data并返回，未命中返回None
+        """
+        config = AiValSrvice.get_cache_config()
+        if config['status'] != "open" or cache_key is None:
+            return None
+        item = AiValCache.get_by_key(cache_key, config['ttl'])
+        if item is None:
+            return None
+        data.update(json.loads(item.result))
+        data['state'] = 1
+        print(f"评估结果命中缓存：{data['id']}")
+        return data
+
+    @staticmethod
+    def set_cache(cache_key, record_type, model, res):
+        config = AiValSrvice.get_cache_config()
+        if config['status'] != "open" or cache_key is None:
+            return
+        try:
+            result = {'model_name': res.get('model_name', model['name'])}
+            for step in AiSugScore.columnStep:
+                result['ai_' + step] = res['ai_' + step]
+                result[step + '_score'] = res[step + '_score']
+            AiValCache.add_one({'cache_key': cache_key, 'type': int(record_type), 'model_id': model['id'], 'result': json.dumps(result, ensure_ascii=False)}, config['ttl'], config['max_rows'], config['evict_every'])
+        except Exception as e:
+            current_app.logger.error(f"评估结果写入缓存失败：{e}")
     @staticmethod
-    def ai_get_score_suggestion(record_type,data,model):
+    def get_score_lists(results, data):
+        """
+        按步骤整理每次采样的分数，有一次采样失败则整条评估失败
+        """
+        score_lists = {}
+        for step in AiSugScore.columnStep:
+            score_lists[step] = []
+            for result in results:
+                if step+'_score' in result and int(result[step+'_score'])>=0:
+                    score_lists[step].append(int(result[step+'_score']))
+                else:
+                    AiSugScore.edit_ai_false_state(data, result['error_message'])
+                    raise Exception(result['error_message'])
+        return score_lists
+    @staticmethod
+    def is_converged(score_lists, config):
+        for step in AiSugScore.columnStep:
+            if not LxAiValSrvice.is_scores_converged(score_lists[step], config['tolerance']):
+                return False
+        return True
+    @staticmethod
+    def ai_get_score_suggestion(record_type,data,model,hedge_model=None):
         from app import app
         with app.app_context():
-            return Ai.get_score_suggestion(record_type,data,model)
+            return AiValSrvice.call_model(record_type,data,model,hedge_model)
+
+    @staticmethod
+    def get_executor():
+        if AiValSrvice._executor is None:
+            with AiValSrvice._executor_lock:
+                if AiValSrvice._executor is None:
+                    AiValSrvice._executor = ThreadPoolExecutor(max_workers=int(app_config.get('ai_hedge_workers', 64)))
+        return AiValSrvice._executor
+
+    @staticmethod
+    def get_hedge_delay(model):
+        """
+        对冲延迟：主模型最近成功请求耗时的p95，没有记录时用 ai_hedge_default_delay
+        """
+        p95 = AiBreaker.get_p95(model)
+        if p95 is None:
+            return float(app_config.get('ai_hedge_default_delay', 60))
+        delay = p95 * float(app_config.get('ai_hedge_factor', 1))
+        return min(max(delay, float(app_config.get('ai_hedge_min_delay', 5))), float(app_config.get('ai_hedge_max_delay', 120)))
+
+    @staticmethod
+    def timed_call(record_type, data, model):
+        """
+        按模型类型调用评估接口，并把结果和耗时记到熔断统计里
+        """
+        from app import app
+        with app.app_context():
+            start_time = time.time()
+            result = None
+            try:
+                if model['key_name'] == "xj-qianwen":
+                    result = Ai.get_xjqw_score_suggestion(data, model, record_type)
+                else:
+                    result = Ai.get_score_suggestion(record_type, data, model)
+                return result
+            finally:
+                AiValSrvice.record_breaker(model, result, time.time() - start_time)
+
+    @staticmethod
+    def record_breaker(model, result, seconds):
+        """
+        把一次请求结果记到熔断统计：解析失败(-4)是模型输出的问题，不算接口故障；
+        本进程排队超时没有请求模型，只交还探测名额；没有结果(抛出异常)算失败
+        """
+        limited = result.pop('limited', False) if result is not None else False
+        if limited and result['state'] == -3:
+            AiBreaker.release(model)
+            return
+        AiBreaker.record(model, result is not None and result['state'] != -3, seconds)
+
+    @staticmethod
+    def call_model(record_type, data, model, hedge_model=None):
+        """
+        调用评估模型：主模型熔断时直接改用备用模型，
+        主模型超过对冲延迟还没返回时向备用模型再发一次，取先返回的有效结果
+        每个请求用data的副本，避免两个请求互相覆盖结果
+        """
+        if not AiBreaker.allow(model):
+            if hedge_model is None or not AiBreaker.allow(hedge_model):
+                result = dict(data)
+                result['state'] = -3
+                result['error_message'] = f"模型{model['name']}熔断中"
+                return result
+            print(f"模型{model['name']}熔断中，改用备用模型{hedge_model['name']}")
+            return AiValSrvice.timed_call(record_type, dict(data), hedge_model)
+        if hedge_model is None:
+            return AiValSrvice.timed_call(record_type, data, model)
+        executor = AiValSrvice.get_executor()
+        futures = [executor.submit(AiValSrvice.timed_call, record_type, dict(data), model)]
+        done, not_done = wait(futures, timeout=AiValSrvice.get_hedge_delay(model))
+        if len(done) > 0:
+            result = futures[0].result()
+            if result['state'] == 1 or not AiBreaker.allow(hedge_model):
+                return result
+            # 主模型失败，用备用模型再试一次
+            return AiValSrvice.timed_call(record_type, dict(data), hedge_model)
+        if not AiBreaker.allow(hedge_model):
+            return futures[0].result()
+        print(f"模型{model['name']}响应慢，对冲请求备用模型{hedge_model['name']}")
+        futures.append(executor.submit(AiValSrvice.timed_call, record_type, dict(data), hedge_model))
+        result = None
+        while len(futures) > 0:
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result['state'] == 1:
+                    return result
+            futures = list(not_done)
+        return result
     '''
     @staticmethod
     def get_xj_qianwen_log(result,record_type):
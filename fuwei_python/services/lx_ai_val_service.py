@@ -4,6 +4,7 @@ import json
 from models.lx_ai_sug_score.model import LxAntiShakeLog
 from models.model.model import ModuleToModel
 from common.Ai import Ai
+from conf.config import app_config
 
 
 class LxAiValSrvice:
@@ -133,8 +134,14 @@ class LxAiValSrvice:
 
     @staticmethod
     def get_step_average_score(score_list):
+        """
+        防抖平均分：过半数的分数及格(>=6)时取及格分数的平均分，否则取不及格分数的平均分
+        5次采样时与原来的"及格次数>=3"一致
+        """
         qualified = []
         not_qualified = []
+        if len(score_list) == 0:
+            return -1
         for score in score_list:
             if score>=6:
                 qualified.append(score)
@@ -142,11 +149,48 @@ class LxAiValSrvice:
                 if score<0:
                     return -1
                 not_qualified.append(score)
-        if len(qualified)>=3:
+        if len(qualified)*2 > len(score_list):
             return round(sum(qualified)/len(qualified))
         else:
             return round(sum(not_qualified)/len(not_qualified))
 
+    @staticmethod
+    def get_anti_shake_config():
+        """
+        防抖自适应采样配置：先采样 anti_shake_min_samples 次，
+        分数分歧超过 anti_shake_tolerance 时逐次追加，最多 anti_shake_max_samples 次
+        multi_sample_timeout 是一次请求多个采样(n参数)的超时，比单次请求短，
+        超时后还要并发请求一遍，避免总耗时翻倍
+        """
+        min_samples = max(1, int(app_config.get('anti_shake_min_samples', 2)))
+        return {
+            'min_samples': min_samples,
+            'max_samples': max(min_samples, int(app_config.get('anti_shake_max_samples', 5))),
+            'tolerance': int(app_config.get('anti_shake_tolerance', 1)),
+            'multi_sample_timeout': int(app_config.get('anti_shake_multi_sample_timeout', 180)),
+        }
+
+    @staticmethod
+    def is_scores_converged(score_list, tolerance):
+        """
+        分数是否已收敛：最高分与最低分相差不超过tolerance，且都在及格线(6分)的同一侧
+        """
+        if len(score_list) == 0:
+            return False
+        qualified = [score for score in score_list if score >= 6]
+        if 0 < len(qualified) < len(score_list):
+            return False
+        return max(score_list) - min(score_list) <= tolerance
+
+    @staticmethod
+    def get_stop_rule(score_list, config):
+        """
+        采样停止原因，写入防抖日志
+        """
+        if LxAiValSrvice.is_scores_converged(score_list, config['tolerance']):
+            return f"分数差不超过{config['tolerance']}分，提前停止"
+        return f"分数分歧较大，达到最大采样次数{config['max_samples']}次"
+
 
     @staticmethod
     def set_average_score(record_id, user_id, state, step_average_score, step_scores):
@@ -156,14 +200,14 @@ class LxAiValSrvice:
         :param user_id:
         :param state:
         :param step_average_score: 平均分list
-        :param step_scores: 所有的分数list
+        :param step_scores: 各步骤所有的分数 {step: list}
         :return:
         """
         item = LxAiSugScore.getOneById(record_id, user_id, state)
         content = ""
         for step,value in step_average_score.items():
             LxAiSugScore.set_score(item, step, value)
-            content = f"{content}{LxAiSugScore.drives[step]}5次分数:{step_scores[str(record_id)][step]},平均分：{step_average_score[step]}<br>"
+            content = f"{content}{LxAiSugScore.drives[step]}{len(step_scores[step])}次分数:{step_scores[step]},平均分：{step_average_score[step]}<br>"
         return content
 
     @staticmethod
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from flask import current_app
+
+from common.aiClient import AiClient
+from conf.config import app_config
+from models.ai_sug_score.model import AiValCache
+from utils.markdown_chunker import chunk_markdown, estimate_tokens
+
+
+class LxMapReduceService():
+    """
+    超长立项文档的分块压缩：按标题把文档切成不超过 lx_map_reduce_chunk_tokens 的块，
+    各块并发交给大模型压缩成要点(map)，按顺序拼接后代替原文交给评分、总结、脑图原有的提示词(reduce)
+    文档估算token数不超过 lx_map_reduce_tokens 时直接用原文
+    每块的压缩结果按(块内容、模型、提示词版本)的hash缓存在 ai_val_cache 表(type为 AiValCache.TYPE_LX_MAP_REDUCE)，
+    同一文档的五个步骤、多次防抖采样、总结和脑图共用压缩结果，有效期和条数上限和评估结果分开配置
+    """
+    # 修改压缩提示词时加1，旧缓存自然失效
+    MAP_VERSION = 1
+    _lock = threading.Lock()
+    _executor = None
+    # 正在压缩的块，相同的块并发请求时只调用一次大模型
+    _inflight = {}
+
+    @staticmethod
+    def get_config():
+        return {
+            'status': app_config.get('lx_map_reduce_status', 'open'),
+            'max_tokens': int(app_config.get('lx_map_reduce_tokens', 60000)),
+            'chunk_tokens': int(app_config.get('lx_map_reduce_chunk_tokens', 12000)),
+            'ratio': float(app_config.get('lx_map_reduce_ratio', 0.25)),
+            'max_rounds': int(app_config.get('lx_map_reduce_rounds', 2)),
+            'cache_ttl': int(app_config.get('lx_map_reduce_cache_ttl', 7 * 24 * 3600)),
+            'cache_max_rows': int(app_config.get('lx_map_reduce_cache_max_rows', 20000)),
+            'cache_evict_every': int(app_config.get('lx_map_reduce_cache_evict_every', 100)),
+        }
+
+    @staticmethod
+    def get_executor():
+        if LxMapReduceService._executor is None:
+            with LxMapReduceService._lock:
+                if LxMapReduceService._executor is None:
+                    LxMapReduceService._executor = ThreadPoolExecutor(max_workers=int(app_config.get('lx_map_reduce_workers', 8)), thread_name_prefix="lx-map")
+        return LxMapReduceService._executor
+
+    @staticmethod
+    def condense(markdown, model):
+        """
+        文档过长时返回分块压缩后的内容，否则原样返回
+        :param markdown: 立项文档全文
+        :param model: 用于压缩的模型配置字典，和后续评分/总结用同一个模型
+        """
+        config = LxMapReduceService.get_config()
+        if config['status'] != "open" or markdown is None:
+            return markdown
+        tokens = estimate_tokens(markdown)
+        rounds = 0
+        while tokens > config['max_tokens'] and rounds < config['max_rounds']:
+            rounds = rounds + 1
+            start_time = time.time()
+            chunks = chunk_markdown(markdown, config['chunk_tokens'])
+            limit = max(300, config['max_tokens'] // len(chunks))
+            app = current_app._get_current_object()
+            future_list = [LxMapReduceService.get_executor().submit(LxMapReduceService.map_chunk, app, chunk, i + 1, len(chunks), model, limit) for i, chunk in enumerate(chunks)]
+            markdown = "\n\n".join([future.result() for future in future_list])
+            new_tokens = estimate_tokens(markdown)
+            current_app.logger.info_module(f"立项文档分块压缩第{rounds}轮：{len(chunks)}块，{tokens}->{new_tokens} tokens，耗时{round(time.time() - start_time, 2)}秒", "model")
+            tokens = new_tokens
+        return markdown
+
+    @staticmethod
+    def get_chunk_key(chunk, model, limit):
+        key = json.dumps([LxMapReduceService.MAP_VERSION, chunk['path'], chunk['text'], model.get('id'), limit], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def map_chunk(app, chunk, index, total, model, limit):
+        """
+        压缩一个块，先查缓存；压缩失败时用原文，保证后续评分不缺内容
+        """
+        with app.app_context():
+            config = LxMapReduceService.get_config()
+            key = LxMapReduceService.get_chunk_key(chunk, model, limit)
+            item = AiValCache.get_by_key(key, config['cache_ttl'])
+            if item is not None:
+                return json.loads(item.result)['content']
+            with LxMapReduceService._lock:
+                future = LxMapReduceService._inflight.get(key)
+                is_owner = future is None
+                if is_owner:
+                    future = Future()
+                    LxMapReduceService._inflight[key] = future
+            if not is_owner:
+                return future.result()
+            try:
+                content = LxMapReduceService.condense_chunk(chunk, index, total, model, limit)
+                if content is None:
+                    content = chunk['text']
+                else:
+                    AiValCache.add_one({'cache_key': key, 'type': AiValCache.TYPE_LX_MAP_REDUCE, 'model_id': model.get('id') or 0, 'result': json.dumps({'content': content}, ensure_ascii=False)}, config['cache_ttl'], config['cache_max_rows'], config['cache_evict_every'])
+                future.set_result(content)
+                return content
+            except Exception as e:
+                current_app.logger.info_module(f"立项文档分块压缩异常{index}/{total}：{e}", "model")
+                future.set_result(chunk['text'])
+                return chunk['text']
+            finally:
+                with LxMapReduceService._lock:
+                    LxMapReduceService._inflight.pop(key, None)
+
+    @staticmethod
+    def condense_chunk(chunk, index, total, model, limit, t=0):
+        """
+        :return: 压缩后的内容，重试后仍失败返回None
+        """
+        path = f"(所在章节：{chunk['path']})" if chunk['path'] else ""
+        user_content = f"""
+        下面是一份立项文档的第{index}/{total}部分{path}。
+        请把这部分内容压缩成要点：保留原有的标题层级，保留项目背景、目标、需求、技术方案、创新点、关键数据和指标、进度、预算、团队、风险等事实信息，
+        不要评价，不要编造原文没有的内容，使用Markdown输出，不超过{limit}字。
+        ###
+        {chunk['text']}
+        """
+        try:
+            response = AiClient.chat(model,
+                model=model['model_name'],
+                messages=[
+                    {"role": "user", "content": user_content},
+                ],
+                stream=False,
+                temperature=0.2,
+                top_p=0.4,
+            )
+            content = response.choices[0].message.content
+            if content is None or content.strip() == "":
+                raise Exception("压缩结果为空")
+            return content.strip()
+        except Exception as e:
+            current_app.logger.info_module(f"立项文档分块压缩失败{index}/{total}：{e}", "model")
+            if t < 2:
+                return LxMapReduceService.condense_chunk(chunk, index, total, model, limit, t + 1)
+            return None
@@ -1,5 +1,5 @@
+import json
 import os
-import re
 import time
 from datetime import datetime
 
@@ -7,103 +7,161 @@ import requests
 from flask import request, g, current_app, jsonify
 
 from common.aliDocAnalysis import aliDocAnalysis
+from common.docParsePoller import DocParsePoller
+from common.docImageRehoster import DocImageRehoster
+from common.progressStore import ProgressStore
 from common.aliOss import aliOss
 from conf.config import app_config
 from conf.db import db
 from models.lx_ai_sug_score.model import LxAiSugScore
 from models.project_document.model import DocumentAttachment
+from models.upload_files.model import DocParseCache
+from utils.doc_markdown_builder import DocMarkdownBuilder
 from utils.file_handler import FileHandler
 
 
 class UploadFileService:
+    # 上传解析阶段 => (进度百分比, 提示)，百分比为-1表示失败
+    UPLOAD_STAGES = {
+        'uploaded': (50, '上传服务器本地'),
+        'parse_submitted': (75, '阿里云oss上传成功'),
+        'pages_parsed': (80, '阿里云解析中'),
+        'images_rehosted': (90, '图片转存完成'),
+        'done': (100, '阿里云解析完成'),
+        'empty_file': (-1, '文件内容为空，请检查上传文件，重新上传'),
+        'failed': (-1, '服务器错误'),
+    }
     @staticmethod
     def upload_files(file,user_id=""):
+        """
+        上传文件直接从请求流分片上传到OSS，不在本地落盘，文件大小和sha256边传边算
+        """
         name_ext = file.filename
         extension = os.path.splitext(name_ext)[-1]
         file_name = os.path.splitext(name_ext)[0]
-        tmp_id_path = f'./tmp/upload/{g.user_id}/'
-        if not os.path.exists(tmp_id_path):
-            os.mkdir(tmp_id_path)
         tmp_file_name =file_name+ datetime.now().strftime("%Y%m%d%H%M%S%f")+str(g.user_id)+extension
-        file.save(f'{tmp_id_path}{tmp_file_name}')
-        key,url = aliOss.uploadFile(f'./tmp/upload/{user_id}/{tmp_file_name}')
-        file_info = FileHandler.get_file_info(f'{tmp_id_path}{tmp_file_name}')
-        os.remove(f'{tmp_id_path}{tmp_file_name}')
+        info = aliOss.upload_stream(tmp_file_name, file.stream)
+        key,url = tmp_file_name, aliOss.getUrl(tmp_file_name)
+        file_info = {
+            'filename': tmp_file_name,
+            'file_path': key,
+            'file_size': info['size'],
+            'mime_type': FileHandler.get_mime_type(tmp_file_name),
+            'sha256': info['sha256'],
+        }
         return key,url,file_info
     @staticmethod
-    def ai_deal(user_id, ali_key, cache, record_id):
+    def ai_deal(user_id, ali_key, cache, record_id, file_hash=None):
+        """
+        解析上传的文档，返回markdown和其中图片占位符对应的url，各阶段进度写入 ProgressStore
+        :param cache: 已不再使用，保留参数兼容原有调用
+        :param file_hash: 文件内容的sha256，没有时下载后计算；相同文件解析过时直接用缓存的结果
+        """
         from app import app
         with app.app_context():
+            if file_hash is not None:
+                result = UploadFileService.get_parse_cache(user_id, record_id, file_hash)
+                if result is not None:
+                    return result
             try:
                 download_tmp_path = f"./tmp/download/{user_id}/"
                 tmp_id_path_file,_ = aliOss.downLoadOne(ali_key, download_tmp_path)
+                if file_hash is None:
+                    file_hash = FileHandler.get_file_sha256(tmp_id_path_file)
+                    result = UploadFileService.get_parse_cache(user_id, record_id, file_hash)
+                    if result is not None:
+                        os.remove(tmp_id_path_file)
+                        return result
                 ali_id, key = aliDocAnalysis.SubmitDocParserJob(tmp_id_path_file)
             except:
-                cache.update({str(user_id) + "upload_state" + str(record_id): "upload_failed"})
+                UploadFileService.set_progress(user_id, record_id, "failed")
                 return "" , {}
-            cache.update({str(user_id) + "upload_state" + str(record_id): "aliOss_finish"})
-            mark_down_text = ""
+            UploadFileService.set_progress(user_id, record_id, "parse_submitted")
             image_url = {}
-            page = 1
             per_page_num = 3000
-            last_number_of_successful_parsing = -1
-            pattern = r'!\[(.*?)\]\((http://docmind-api-cn-hangzhou.oss-cn-hangzhou.aliyuncs.com.+?)\)'
-            tag = 0
+            tag_prefix = str(int(time.time() * 100000)) + str(user_id)
+            image_futures = {}
+            rehoster = DocImageRehoster(user_id)
+
+            def on_image(src):
+                img_tag = f'[IMAGE_{tag_prefix}{len(image_futures)}]'
+                image_futures[img_tag] = rehoster.submit(src)
+                return img_tag
+
+            builder = DocMarkdownBuilder(on_image)
             try:
-                while (True):
-                    d = aliDocAnalysis.QueryDocParserStatus(ali_id)
-                    if d['Status'] == 'Fail':
-                        cache.update({str(user_id) + "upload_state" + str(record_id): "upload_failed"})
-                        break
-                    if last_number_of_successful_parsing < d['NumberOfSuccessfulParsing']:
-                        last_number_of_successful_parsing = d['NumberOfSuccessfulParsing']
-                    else:
-                        if last_number_of_successful_parsing == 0 and d['Status'] == "success":
-                            break
-                        time.sleep(1)
-                        continue
-                    datas = aliDocAnalysis.GetDocParserResult(ali_id, page, per_page_num)
-                    if last_number_of_successful_parsing <= page * per_page_num and d['Status'] == 'success':
-                        for data in datas:
-                            match = re.match(pattern, data['markdownContent'])
-                            if match:
-                                img_tag = str(int(time.time() * 100000))+str(user_id)+str(tag)
-                                object_key = UploadFileService.download_upload(match.group(2))
-                                image_url[f'[IMAGE_{img_tag}]'] = object_key
-                                data['markdownContent'] = f'[IMAGE_{img_tag}]'
-                                tag = tag+1
-                            mark_down_text = mark_down_text + data['markdownContent']
-                        break
-                    elif last_number_of_successful_parsing <= page * per_page_num and d['Status'] == 'Processing':
-                        time.sleep(1)
-                        continue
-                    elif last_number_of_successful_parsing > page * per_page_num and (
-                            d['Status'] == 'Processing' or d['Status'] == 'success'):
-                        for data in datas:
-                            match = re.match(pattern, data['markdownContent'])
-                            if match:
-                                img_tag = str(int(time.time() * 100000))+str(user_id)+str(tag)
-                                object_key = UploadFileService.download_upload(match.group(2))
-                                image_url[f'[IMAGE_{img_tag}]'] = object_key
-                                data['markdownContent'] = f'[IMAGE_{img_tag}]'
-                                tag = tag+1
-                            mark_down_text = mark_down_text + data['markdownContent']
-                        page = page + 1
+                # 解析进度由 DocParsePoller 统一轮询，这里按页处理，图片边解析边并发转存
+                for datas in DocParsePoller.pages(ali_id, per_page_num):
+                    builder.add_page(datas)
+                    UploadFileService.set_progress(user_id, record_id, "pages_parsed", f"已解析{builder.pages}页")
+                mark_down_text = builder.build()
+                for img_tag, future in image_futures.items():
+                    image_url[img_tag] = future.result()
+                current_app.logger.info_module(f"文档{ali_key}图片转存：{rehoster.get_log()}", "model")
+                if len(image_futures) > 0:
+                    UploadFileService.set_progress(user_id, record_id, "images_rehosted", f"{len(image_futures)}张图片")
                 if mark_down_text == "":
-                    cache.update({str(user_id) + "upload_state" + str(record_id): "empty_file"})
+                    UploadFileService.set_progress(user_id, record_id, "empty_file")
                 else:
-                    cache.update({str(user_id) + "upload_state" + str(record_id): "all_finish"})
+                    UploadFileService.set_progress(user_id, record_id, "done")
+                    # 有图片转存失败时不缓存，下次上传重新解析
+                    if "" not in image_url.values():
+                        UploadFileService.set_parse_cache(file_hash, mark_down_text, image_url)
                 os.remove(f'{tmp_id_path_file}')
                 return mark_down_text,image_url
             except Exception as e:
                 print('upload_failed')
                 print(str(e))
-                cache.update({str(user_id) + "upload_state" + str(record_id): "upload_failed"})
+                UploadFileService.set_progress(user_id, record_id, "failed")
                 return "" , {}
 
     @staticmethod
-    def lx_deal_markdown(user_id, key, cache, record_id):
-        mark_down_text,_ =UploadFileService.ai_deal(user_id, key, cache, record_id)
+    def get_parse_cache(user_id, record_id, file_hash):
+        """
+        命中解析缓存时直接把上传状态置为完成
+        :return: (markdown, 图片url)，未命中返回None
+        """
+        if app_config.get('doc_parse_cache_status', 'open') != "open":
+            return None
+        item = DocParseCache.get_by_hash(file_hash, int(app_config.get('doc_parse_cache_ttl', 30 * 24 * 3600)))
+        if item is None:
+            return None
+        print(f"文档解析命中缓存：{file_hash}")
+        UploadFileService.set_progress(user_id, record_id, "done", "命中解析缓存")
+        return item.markdown, json.loads(item.image_urls)
+
+    @staticmethod
+    def set_parse_cache(file_hash, mark_down_text, image_url):
+        if app_config.get('doc_parse_cache_status', 'open') != "open":
+            return
+        try:
+            DocParseCache.add_one({'file_hash': file_hash, 'markdown': mark_down_text, 'image_urls': json.dumps(image_url, ensure_ascii=False)})
+        except Exception as e:
+            current_app.logger.error(f"文档解析结果写入缓存失败：{e}")
+
+    @staticmethod
+    def set_progress(user_id, record_id, stage, detail=""):
+        try:
+            ProgressStore.get_store().set(user_id, record_id, stage, detail)
+        except Exception as e:
+            current_app.logger.error(f"上传进度写入失败：{e}")
+
+    @staticmethod
+    def get_progress(user_id, record_id):
+        """
+        :return: {'stage', 'detail', 'version', 'msg', 'percent'}，没有进度时返回None
+        """
+        progress = ProgressStore.get_store().get(user_id, record_id)
+        if progress is None:
+            return None
+        percent, msg = UploadFileService.UPLOAD_STAGES.get(progress['stage'], UploadFileService.UPLOAD_STAGES['failed'])
+        progress['percent'] = percent
+        progress['msg'] = msg
+        return progress
+
+    @staticmethod
+    def lx_deal_markdown(user_id, key, cache, record_id, file_hash=None):
+        mark_down_text,_ =UploadFileService.ai_deal(user_id, key, cache, record_id, file_hash)
         if mark_down_text == "":
             LxAiSugScore.delEmpty(record_id, user_id)
         else:
@@ -126,46 +184,44 @@ class UploadFileService:
             db.session.add(doc_attachment)
             db.session.flush()
             record_id = doc_attachment.id
-            cache.setdefault(str(user_id) + "upload_state" + str(record_id), "uploading")
+            UploadFileService.set_progress(user_id, record_id, "uploaded")
             mark_down_text,image_urls = UploadFileService.ai_deal(user_id, attachment.get('key'), cache, record_id)
             DocumentAttachment.query.filter_by(id=record_id).update({"content":mark_down_text,"img_urls":image_urls})
             db.session.commit()
 
     @staticmethod
     def get_upload_state():
-        cache = current_app.extensions.get('cache')
         record_id = request.values.get('id', 0)
-        state = cache.get(str(g.user_id) + "upload_state" + str(record_id))
-        if state == 'aliOss_finish':
-            return jsonify({'msg': '阿里云oss上传成功', "percent": 75, 'code': 1}), 200
-        elif state == 'all_finish':
-            return jsonify({'msg': '阿里云解析完成', "percent": 100, 'code': 1}), 200
-        elif state == 'uploading':
-            return jsonify({'msg': '上传服务器本地', "percent": 50, 'code': 1}), 200
-        elif state == 'empty_file':
-            return jsonify({'msg': '文件内容为空，请检查上传文件，重新上传', "percent": -1, 'code': 1}), 200
-        else:
+        progress = UploadFileService.get_progress(g.user_id, record_id)
+        if progress is None:
             return jsonify({'msg': '服务器错误', "percent": -1, 'code': 1}), 200
+        return jsonify({'msg': progress['msg'], "percent": progress['percent'], 'stage': progress['stage'], 'detail': progress['detail'], 'code': 1}), 200
 
     @staticmethod
-    def download_upload(src, user_id=1):
-        try:
-            response = requests.get(src)
-            response.raise_for_status()
-            image_data = response.content
-        except Exception as e:
-            print("下载图片失败")
-            error_tag = 2
-        ext = ''
-        if image_data.startswith(b'\xff\xd8\xff'):
-            ext = '.jpg'
-        elif image_data.startswith(b'\x89PNG\r\n\x1a\n'):
-            ext = '.png'
-        elif image_data.startswith(b'GIF87a') or image_data.startswith(b'GIF89a'):
-            ext = '.gif'
-        elif image_data.startswith(b'BM'):
-            ext = '.bmp'
-        object_key = datetime.now().strftime("%Y%m%d%H%M%S%f") + str(user_id) + ext
-        aliOss.uploadPicData(object_key, image_data)
-        return f"https://{app_config['ali_bucket']}.{app_config['ali_endpoint']}/{object_key}"
-
+    def stream_upload_state(user_id, record_id):
+        """
+        SSE推送上传解析进度：阶段有变化时推送 progress 事件，完成或失败后推送 end 事件并结束
+        服务端每 upload_progress_interval 秒查一次进度，期间每15秒发一行注释保持连接
+        每个连接在解析期间一直占用一个web线程，部署时要用多线程或gevent等异步worker，
+        同步worker下连接数不能超过worker数
+        """
+        interval = float(app_config.get('upload_progress_interval', 2))
+        timeout = float(app_config.get('upload_progress_timeout', 1800))
+        from app import app
+        start_time = time.time()
+        last_version = -1
+        last_send = time.time()
+        while time.time() - start_time < timeout:
+            with app.app_context():
+                progress = UploadFileService.get_progress(user_id, record_id)
+            if progress is not None and progress['version'] != last_version:
+                last_version = progress['version']
+                last_send = time.time()
+                yield f"event: progress\ndata: {json.dumps(progress, ensure_ascii=False)}\n\n"
+                if progress['stage'] in ['done', 'empty_file', 'failed']:
+                    return
+            elif time.time() - last_send >= 15:
+                last_send = time.time()
+                yield ": heartbeat\n\n"
+            time.sleep(interval)
+        yield f"event: progress\ndata: {json.dumps({'stage': 'failed', 'msg': '获取进度超时', 'percent': -1}, ensure_ascii=False)}\n\n"
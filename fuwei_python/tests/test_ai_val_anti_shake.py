@@ -0,0 +1,54 @@
+"""
+防抖自适应采样：在 fuwei_python 目录下运行 python -m pytest tests
+"""
+import itertools
+
+from services import ai_val_service
+from services.ai_val_service import AiValSrvice
+from services.lx_ai_val_service import LxAiValSrvice
+
+
+class FakeModule():
+    def __init__(self):
+        self.model = self
+        self.hedge_model = None
+
+    def to_dict(self):
+        return {
+            'id': 1,
+            'name': 'test',
+            'key_name': 'test',
+            'anti_shake_status': 'open',
+            'multi_sample_status': 'closed',
+        }
+
+
+def test_anti_shake_requests_extra_samples_when_scores_diverge(monkeypatch):
+    scores = itertools.cycle([3, 9])
+    calls = []
+    logs = []
+
+    def fake_call(record_type, data, model, hedge_model=None):
+        # 和 Ai.get_score_suggestion 一样，把结果写进传入的dict再返回
+        score = next(scores)
+        calls.append(data)
+        data['state'] = 1
+        for step in ['step1', 'step2', 'step3', 'step4']:
+            data['ai_' + step] = f"score {score}"
+            data[step + '_score'] = score
+        return data
+
+    monkeypatch.setattr(ai_val_service.ModuleToModel, 'get_module_model', staticmethod(lambda record_type: FakeModule()))
+    monkeypatch.setattr(AiValSrvice, 'get_cache_config', staticmethod(lambda: {'status': 'closed'}))
+    monkeypatch.setattr(AiValSrvice, 'ai_get_score_suggestion', staticmethod(fake_call))
+    monkeypatch.setattr(LxAiValSrvice, 'get_anti_shake_config', staticmethod(lambda: {'min_samples': 2, 'max_samples': 5, 'tolerance': 1, 'multi_sample_timeout': 180}))
+    monkeypatch.setattr(ai_val_service.AntiShakeLog, 'add_one', staticmethod(logs.append))
+
+    data = {'id': '1', 'user_id': 1, 'step1': 'a', 'step2': 'b', 'step3': 'c', 'step4': 'd'}
+    res = AiValSrvice.get_score_suggestion(0, data)
+
+    assert len(calls) == 5
+    # 首轮和追加的每次采样拿到的都是不同的dict
+    assert len(set([id(call) for call in calls])) == 5
+    assert res is data
+    assert "防抖采样5次" in logs[0]['content']
@@ -1,4 +1,5 @@
 import shutil
+import uuid
 
 from flask import Blueprint, render_template, request, redirect, jsonify, session, g, send_from_directory, \
     after_this_request, Response, current_app,send_file
@@ -6,16 +7,18 @@ from conf.config import app_config
 from models.ai_sug_score.model import AiSugScore
 from models.users.models import MobileUserRight
 from models.valAiaq import valAiaq
-import pandas as pd
 from common.Ai import Ai
 from datetime import datetime
 import os
 from common.aliOss import aliOss
 import threading
 from models.upload_files.model import UploadFiles
-from common.zip import zip
+from common.zip import zip, ZipStream
+import zipfile
 import subprocess
 from services.ai_val_service import AiValSrvice
+from services.ai_job_service import AiJobService
+from services.ai_val_import_service import AiValImportService
 import sys
 
 from services.user_image_service import UserImageService
@@ -184,51 +187,58 @@ def batchAdd():
     if file:
         # 保存文件到服务器（例如在当前目录下的uploads文件夹）
         extension = os.path.splitext( file.filename)[-1]
-        tmpIdPath = f'./tmp/upload/{g.user_id}/'
-        if not os.path.exists(tmpIdPath):
-            os.mkdir(tmpIdPath)
+        # 每次上传单独一个目录，请求结束时删除，zip里的图片在入队前已上传到OSS
+        tmpIdPath = f'./tmp/upload/{g.user_id}/{datetime.now().strftime("%Y%m%d%H%M%S%f")}/'
+        os.makedirs(tmpIdPath, exist_ok=True)
         file.save(f'{tmpIdPath}{file.filename}')
-        @after_this_request
-        def after_request_callback(response):
-            if  hasattr(g, 'current_threads'):
-                thread = threading.Thread(target=waitThreadEnd, args=(g.current_threads,))
-                thread.start()
-            return response
-        def waitThreadEnd(current_threads):
-            for thread in current_threads:
-                thread.join()
-                del thread
-            subprocess.run(f'rm -Rf {tmpIdPath}', shell=True)
         if extension==".xlsx" or extension==".xls":
-            return batchExecNoPic(file)
+            try:
+                return batchExecNoPic(file, f'{tmpIdPath}{file.filename}')
+            finally:
+                shutil.rmtree(tmpIdPath, ignore_errors=True)
         elif extension==".zip":
             return batchExecWithPic(file,tmpIdPath)
+        shutil.rmtree(tmpIdPath, ignore_errors=True)
+        return jsonify({'msg': '只支持上传xlsx,xls,zip文件', 'filename': "", 'code': -1}), 200
 
 
 def batchExecWithPic(file,tmpIdPath):
-    zip.extractWithEncoding(f'{tmpIdPath}/{file.filename}',tmpIdPath)
+    try:
+        rs, code = batchZipImport(file, tmpIdPath)
+    finally:
+        shutil.rmtree(tmpIdPath, ignore_errors=True)
+    return rs
+def batchZipImport(file,tmpIdPath):
+    zipPath = f'{tmpIdPath}/{file.filename}'
+    zip.extractWithEncoding(zipPath,tmpIdPath)
     excelFileWin = f"{tmpIdPath}/{AiSugScore.uploadFiles[int(g.type)][0]}"
     #苹果生成的zip文件与win的不同
     excelFileIos = f"{tmpIdPath}/{os.path.splitext(AiSugScore.uploadFiles[int(g.type)][0])[0]}/{AiSugScore.uploadFiles[int(g.type)][0]}"
     excelFile = ""
+    # 图片相对zip根目录的位置
+    imageDir = ""
     if os.path.exists(excelFileWin) :
         excelFile = excelFileWin
     if os.path.exists(excelFileIos):
         excelFile = excelFileIos
-        tmpIdPath = f"{tmpIdPath}/{os.path.splitext(AiSugScore.uploadFiles[int(g.type)][0])[0]}"
+        imageDir = os.path.splitext(AiSugScore.uploadFiles[int(g.type)][0])[0]
+        tmpIdPath = f"{tmpIdPath}/{imageDir}"
     if excelFile=='':
-        return jsonify({'msg': 'excel文件路径错误，请严格按照导入说明文档的规则上传打包文件', 'filename': "", 'code': -1}), 200
+        return (jsonify({'msg': 'excel文件路径错误，请严格按照导入说明文档的规则上传打包文件', 'filename': "", 'code': -1}), 200), -1
     rs,code,errorTag = excelCheck(excelFile)
     if code ==200:
-        return rs,code
-    datas = rs
+        return (rs,code), -1
+    # zip导入的记录要一起入库，放在一个任务里
+    datas = []
+    for chunk in AiValImportService.iter_records(excelFile, g.type, g.user_id, g.admin_user_id):
+        datas.extend(chunk)
     mobileUserRightRecord = MobileUserRight.get_one_right(g.admin_user_id, g.type)
     rs, code = mobileUserRightRecord.check_request_right(mobileUserRightRecord)
     if code < 0:
-        return jsonify(rs), 200
+        return (jsonify(rs), 200), -1
     if (mobileUserRightRecord.request_num - (mobileUserRightRecord.requested_num + len(datas))) < 0:
-        return jsonify({'msg': f'EXCEL文件中要提问的记录数量为{len(datas)}条，剩余提问次数的为{(mobileUserRightRecord.request_num - mobileUserRightRecord.requested_num)}次,剩余提问次数不足',"code": -2}), 200
-    for data in rs:
+        return (jsonify({'msg': f'EXCEL文件中要提问的记录数量为{len(datas)}条，剩余提问次数的为{(mobileUserRightRecord.request_num - mobileUserRightRecord.requested_num)}次,剩余提问次数不足',"code": -2}), 200), -1
+    for data in datas:
         src1 = aliOss.imgFileCheck(data['step1'], tmpIdPath)
         src2 = aliOss.imgFileCheck(data['step2'], tmpIdPath)
         src3 = aliOss.imgFileCheck(data['step3'], tmpIdPath)
@@ -236,81 +246,44 @@ def batchExecWithPic(file,tmpIdPath):
         srcAll = src1+src2+src3+src4
         if len(srcAll)>0:
             errorTag = 1
+    # web请求只校验，zip原文件转存到OSS，图片由worker下载解压后上传，任何worker都能执行，不依赖本机的临时目录
+    zipKey = f"imports/{g.user_id}/{datetime.now().strftime('%Y%m%d%H%M%S%f')}.zip"
+    aliOss.uploadPrivateFile(zipKey, zipPath)
     mobileUserRightRecord = MobileUserRight.get_one_right(g.admin_user_id, g.type)
     MobileUserRight.set_right(mobileUserRightRecord, 'requested_num', (mobileUserRightRecord.requested_num + len(datas)))
-    datasArr = splitThreadData(datas)
-    g.current_threads = []
-    for datas in datasArr:
-        thread = threading.Thread(target=threadZipBatchValDone, args=(datas,tmpIdPath))
-        g.current_threads.append(thread)
-        thread.start()
-    return jsonify({'msg': '批量入库成功，AI评估中....', 'filename': "", 'code': 1,'errorTag':errorTag}), 200
+    AiJobService.enqueue('ai_val_zip_import', [datas, zipKey, imageDir], g.admin_user_id)
+    return (jsonify({'msg': '批量入库成功，AI评估中....', 'filename': "", 'code': 1,'errorTag':errorTag}), 200), 1
 
 def excelCheck(filePath):
-    df = pd.read_excel(filePath)
-    df = df.astype(str).fillna('')
-    datas = []
-    id = int(datetime.now().strftime("%Y%m%d%H%M%S%f"))
-    errorTag = 0
-    if g.type == 0:
-        if '产品缺陷描述' not in df or '原因分析' not in df or '解决措施实施' not in df or '回归测试' not in df:
-            return jsonify({'msg': '请下载标准模板', "code": -1}), 200,1
-        length = len(df['产品缺陷描述'])
-        for i in range(0, length):
-            data = {}
-            data['step1'] = str(df['产品缺陷描述'][i])
-            data['step2'] = str(df['原因分析'][i])
-            data['step3'] = str(df['解决措施实施'][i])
-            data['step4'] = str(df['回归测试'][i])
-            if data['step1'] == "" and data['step2'] == "" and data['step3'] == "" and data['step4'] == "":
-                errorTag = 1
-            #     return jsonify({'msg': 'excel模板文件中：产品缺陷描述，原因分析，解决措施实施，验证结果对应的数据都不可以为空',"code": -1}), 200
-            data['type'] = int(g.type)
-            data['user_id'] = g.user_id
-            data["id"] = str(g.user_id)+str(id + i)
-            data["state"] = -1
-            data['admin_user_id'] = g.admin_user_id
-            datas.append(data)
-    if g.type == 1:
-        if '需求描述' not in df or '需求分析' not in df or '需求决策' not in df or '验证结果' not in df:
-            return jsonify({'msg': '请下载标准模板', "code": -1}), 200,1
-        length = len(df['需求描述'])
-        for i in range(0, length):
-            data = {}
-            data['step1'] = str(df['需求描述'][i])
-            data['step2'] = str(df['需求分析'][i])
-            data['step3'] = str(df['需求决策'][i])
-            data['step4'] = str(df['验证结果'][i])
-            if data['step1'] == "" and data['step2'] == "" and data['step3'] == "" and data['step4'] == "":
-                errorTag = 1
-            data['type'] = int(g.type)
-            data['user_id'] = g.user_id
-            data["id"] = str(g.user_id)+str(id + i)
-            data["state"] = -1
-            data['admin_user_id'] = g.admin_user_id
-            datas.append(data)
-    return datas,0,errorTag
-def batchExecNoPic(file):
-    rs, code,errorTag = excelCheck(file)
+    """
+    校验EXCEL，所有错误一次返回
+    :return: (有效记录数, 0, errorTag)，校验失败时是 (jsonify结果, 200, 1)，中间有空行被跳过时errorTag是1
+    """
+    try:
+        total, errors, skipped = AiValImportService.validate(filePath, g.type)
+    except ValueError as e:
+        return jsonify({'msg': str(e), "code": -1}), 200,1
+    if len(errors) > 0:
+        return jsonify(AiValImportService.get_error_response(errors)), 200,1
+    if total == 0:
+        return jsonify({'msg': 'EXCEL文件中没有要提问的记录', "code": -1}), 200,1
+    return total,0,1 if skipped > 0 else 0
+def batchExecNoPic(file,filePath):
+    rs, code,errorTag = excelCheck(filePath)
     if code == 200:
         return rs,code
-    datas = rs
+    total = rs
     mobileUserRightRecord = MobileUserRight.get_one_right(g.admin_user_id, g.type)
     rs, code = mobileUserRightRecord.check_request_right(mobileUserRightRecord)
     if code < 0:
         return jsonify(rs), 200
-    if (mobileUserRightRecord.request_num - (mobileUserRightRecord.requested_num + len(datas))) < 0:
-        return jsonify({'msg': f'EXCEL文件中要提问的记录数量为{len(datas)}条，剩余提问次数的为{(mobileUserRightRecord.request_num - mobileUserRightRecord.requested_num)}次,剩余提问次数不足',"code": -2}), 200
-    MobileUserRight.set_right(mobileUserRightRecord, 'requested_num', (mobileUserRightRecord.requested_num + len(datas)))
+    if (mobileUserRightRecord.request_num - (mobileUserRightRecord.requested_num + total)) < 0:
+        return jsonify({'msg': f'EXCEL文件中要提问的记录数量为{total}条，剩余提问次数的为{(mobileUserRightRecord.request_num - mobileUserRightRecord.requested_num)}次,剩余提问次数不足',"code": -2}), 200
+    MobileUserRight.set_right(mobileUserRightRecord, 'requested_num', (mobileUserRightRecord.requested_num + total))
     file.close()
-    datasArr = splitThreadData(datas)
-    g.current_threads = []
-    lenNum = 0
-    for datas in datasArr:
-        lenNum = lenNum + len(datas)
-        thread = threading.Thread(target=threadBatchValDone, args=(datas,))
-        g.current_threads.append(thread)
-        thread.start()
+    # 校验通过后再按块读取入队，不把整个文件的记录放在内存里
+    for datas in AiValImportService.iter_records(filePath, g.type, g.user_id, g.admin_user_id):
+        AiJobService.enqueue_chunks('ai_val_batch', datas, g.admin_user_id)
     return jsonify({'msg': '批量入库成功，AI评估中....', 'filename': file.filename, 'code': 1,'errorTag':errorTag}), 200
 
 @aiVal.route('/download/<filename>',methods=['GET'])
@@ -326,8 +299,7 @@ def uploadPic():
         filename = file.filename
         extension = os.path.splitext(filename)[-1]
         tmpFileName = datetime.now().strftime("%Y%m%d%H%M%S%f")+str(g.user_id)+extension
-        file.save(f'./tmp/upload/{tmpFileName}')
-        aliOss.uploadFile(f'./tmp/upload/{tmpFileName}')
+        aliOss.upload_stream(tmpFileName, file.stream)
         return jsonify({'msg':"上传成功",'url':f"https://{app_config['ali_bucket']}.{app_config['ali_endpoint']}/{tmpFileName}","code":1}), 200
 
 
@@ -376,13 +348,7 @@ def export():
     items = AiSugScore.getDateTypeExport(user_id=g.user_id, type=g.type, state=1, b_date=b_date, e_date=e_date, is_admin=0)
     id_list = [item.id for item in items]
     pics = UploadFiles.getUserAllPic(id_list)
-    tmp_date_path = f'./tmp/export/{datetime.now().strftime("%Y%m%d")}/'
-    tmp_id_path = tmp_date_path+f"{g.user_id}"
-    if not os.path.exists(tmp_date_path):
-        os.mkdir(tmp_date_path)
-    if not os.path.exists(tmp_id_path):
-        os.mkdir(tmp_id_path)
-    pic_dicts = aliOss.batch_download_images_from_oss(pics,tmp_id_path)
+    pic_dicts = aliOss.get_export_pic_dicts(pics)
     id_list = []
     data = {}
     if g.type== 1:
@@ -447,90 +413,116 @@ def export():
             data['回归测试AI建议'].append(item.ai_step4)
             data['回归测试AI得分（满分10）'].append(item.step4_score)
             i = i+1
-    df = pd.DataFrame(data)
-    df_filled = df.astype(str).fillna('')
-    df_filled.to_excel(f"{tmp_id_path}/export.xlsx", index=False)
-    zip.zipDirectory(tmp_id_path,tmp_date_path+f'/{g.user_id}_export.zip')
-    shutil.rmtree(tmp_id_path)
-    try:
-        return send_file(
-            tmp_date_path+f'/{g.user_id}_export.zip',
-            mimetype='application/octet-stream',
-            as_attachment=True,
-            download_name=tmp_date_path+f'/{g.user_id}_export.zip',  # Flask 2.0+ 支持
-            # 对于旧版 Flask，用 `attachment_filename`
-            # attachment_filename=fileName,
-        )
-    finally:
-        if os.path.exists(tmp_date_path+f'/{g.user_id}_export.zip'):
-            os.remove(tmp_date_path+f'/{g.user_id}_export.zip')
-
-    # try:
-    #     return send_file(
-    #         tmpFilePath,
-    #         mimetype='application/octet-stream',
-    #         as_attachment=True,
-    #         download_name=fileName,  # Flask 2.0+ 支持
-    #         # 对于旧版 Flask，用 `attachment_filename`
-    #         # attachment_filename=fileName,
-    #     )
-    #
-    def generate(file):
-        with open(file, 'rb') as f:
-            while True:
-                chunk = f.read(4096)  # 每次读取 4KB
-                if not chunk:
-                    subprocess.run(f'rm -Rf {file}', shell=True)
-                    break
-                yield chunk
-    return Response(generate(tmp_date_path+f'/{g.user_id}_export.zip'), mimetype='application/octet-stream',headers={'Content-Disposition': f'attachment;filename={g.user_id}_export.zip'})
+    file_names = {value[1]: value[0] for value in pic_dicts.values()}
+    workers = int(app_config.get('export_image_workers', 8))
+    def generate():
+        # 图片并发读取(经过 OssCache 本地缓存)，读完一张写入一张，最后写入表格，不生成临时的zip文件
+        # 下载失败的图片表格里保留原来的url
+        stream = ZipStream()
+        failed_names = set()
+        for object_name, image_data in aliOss.iter_objects(list(file_names.keys()), workers):
+            if image_data is None:
+                failed_names.add(object_name)
+                continue
+            yield stream.add(file_names[object_name], image_data, zipfile.ZIP_STORED)
+        yield stream.add_workbook("export.xlsx", aliOss.restore_export_images(data, pic_dicts, failed_names))
+        yield stream.close()
+    return Response(generate(), mimetype='application/octet-stream',headers={'Content-Disposition': f'attachment;filename={g.user_id}_export.zip'})
 def threadBatchValDone(datas):
     from app import app
     with app.app_context():
-        admin_user_id = 0
-        type = 0
         errorIds = []
         for d in datas:
-            admin_user_id = d['admin_user_id']
-            type = d['type']
+            # 任务重试时记录可能已经入库，图片已经转存，直接用库里的内容评估，不再转存和写图片记录
+            item = AiSugScore.get_one(d['user_id'], d['id'])
+            if item is not None:
+                for step in AiSugScore.columnStep:
+                    d[step] = getattr(item, step)
+                continue
             d['step1'], url1,error1,_ = aliOss.dealImgSrc(d['step1'], d['user_id'])
             d['step2'], url2,error2,_ = aliOss.dealImgSrc(d['step2'], d['user_id'])
             d['step3'], url3,error3,_ = aliOss.dealImgSrc(d['step3'], d['user_id'])
             d['step4'], url4,error4,_ = aliOss.dealImgSrc(d['step4'], d['user_id'])
-            AiSugScore.add_one(d)
+            urls = url1 + url2 + url3 + url4
             if (error1 + error2 + error3 + error4) > 0:
                 errorIds.append(d["id"])
-                continue
-            urls = url1 + url2 + url3 + url4
-            if len(urls)>0:
+            elif len(urls)>0:
+                # 先写图片记录再写评估记录，中途失败重试时记录不存在，会重新转存并覆盖图片记录
                 UploadFiles.bulkInsert(urls, d["id"], d['user_id'])
-        mobileUserRightRecord = MobileUserRight.get_one_right(admin_user_id, type)
-        for d in datas:
-            try:
-                rs = AiValSrvice.get_score_suggestion(d['type'], d)
-                AiSugScore.edit_ai(rs)
-            except:
-                MobileUserRight.set_right(mobileUserRightRecord, 'requested_num', (mobileUserRightRecord.requested_num - 1))
-        MobileUserRight.ai_val_sms(mobileUserRightRecord, admin_user_id, type)
-def threadZipBatchValDone(datas,tmpIdPath):
+            AiSugScore.add_one(d)
+        batchValDone(datas)
+def threadZipBatchImport(datas, zipKey, imageDir=""):
+    """
+    zip批量导入：下载web请求转存到OSS的zip，解压后并发上传图片，入库，然后按块把评估任务放入队列
+    :param zipKey: zip在OSS里的对象名，导入完成后删除
+    :param imageDir: 图片相对zip根目录的位置
+    """
     from app import app
     with app.app_context():
-        admin_user_id = 0
-        type = 0
-        for d in datas:
-            admin_user_id = d['admin_user_id']
-            type = d['type']
-            #tmpIdPath = f"./tmp/upload/{d['user_id']}"
-            d['step1'], url1,cod1 = aliOss.extract_local_images(d['step1'], d['user_id'],tmpIdPath)
-            d['step2'], url2,cod2 = aliOss.extract_local_images(d['step2'], d['user_id'],tmpIdPath)
-            d['step3'], url3,cod3 = aliOss.extract_local_images(d['step3'], d['user_id'],tmpIdPath)
-            d['step4'], url4,cod4 = aliOss.extract_local_images(d['step4'], d['user_id'],tmpIdPath)
-            AiSugScore.add_one(d)
-            if (cod1+cod2+cod3+cod4)!=4:
-                print("有文件上传失败")
-            urls = url1 + url2 + url3 + url4
-            if len(urls)>0:
-                UploadFiles.bulkInsert(urls, d["id"], d['user_id'])
+        tmpIdPath = f'./tmp/zip_import/{uuid.uuid4().hex}/'
+        os.makedirs(tmpIdPath, exist_ok=True)
+        try:
+            zipPath = f'{tmpIdPath}import.zip'
+            aliOss.bucket.get_object_to_file(zipKey, zipPath)
+            zip.extractWithEncoding(zipPath, tmpIdPath)
+            imagePath = os.path.join(tmpIdPath, imageDir)
+            # 任务重试时已入库的记录不再上传图片，用库里的内容评估
+            news = []
+            for d in datas:
+                item = AiSugScore.get_one(d['user_id'], d['id'])
+                if item is None:
+                    news.append(d)
+                else:
+                    for step in AiSugScore.columnStep:
+                        d[step] = getattr(item, step)
+            srcs = []
+            for d in news:
+                for step in AiSugScore.columnStep:
+                    srcs.extend(aliOss.find_local_images(d[step]))
+            url_map = aliOss.upload_local_images(srcs, imagePath)
+            for d in news:
+                urls = []
+                for step in AiSugScore.columnStep:
+                    d[step], step_urls, code = aliOss.extract_local_images(d[step], d['user_id'], imagePath, url_map)
+                    urls = urls + step_urls
+                    if code != 1:
+                        print(f"zip导入图片上传失败{d['id']}")
+                if len(urls)>0:
+                    UploadFiles.bulkInsert(urls, d["id"], d['user_id'])
+                AiSugScore.add_one(d)
+        finally:
+            shutil.rmtree(tmpIdPath, ignore_errors=True)
+        if len(datas) > 0:
+            AiJobService.enqueue_chunks('ai_val_batch_eval', datas, datas[0]['admin_user_id'])
+        deleteImportZip(zipKey)
+
+def zipBatchImportFailed(datas, zipKey, imageDir="", error_mess=""):
+    """
+    zip导入重试用完后仍失败：退回没有入库的记录占用的提问次数，删除zip
+    """
+    from app import app
+    with app.app_context():
+        num = len([d for d in datas if AiSugScore.get_one(d['user_id'], d['id']) is None])
+        if num > 0:
+            mobileUserRightRecord = MobileUserRight.get_one_right(datas[0]['admin_user_id'], datas[0]['type'])
+            MobileUserRight.set_right(mobileUserRightRecord, 'requested_num', (mobileUserRightRecord.requested_num - num))
+        deleteImportZip(zipKey)
+
+def deleteImportZip(zipKey):
+    try:
+        aliOss.deleteFile(zipKey)
+    except Exception as e:
+        print(f"删除导入文件{zipKey}失败：{e}")
+def batchValDone(datas):
+    """
+    对已入库的记录逐条评估，评估失败的退回提问次数
+    """
+    from app import app
+    with app.app_context():
+        if len(datas) == 0:
+            return
+        admin_user_id = datas[0]['admin_user_id']
+        type = datas[0]['type']
         mobileUserRightRecord = MobileUserRight.get_one_right(admin_user_id, type)
         for d in datas:
             try:
@@ -539,28 +531,4 @@ def threadZipBatchValDone(datas,tmpIdPath):
             except Exception as e:
                 MobileUserRight.set_right(mobileUserRightRecord, 'requested_num', (mobileUserRightRecord.requested_num - 1))
                 print("Ai评估失败")
-        # mobileUserRightRecord = mobileUserRight.getOneRight(admin_user_id, type)
-        # aiSugScoreNum = aiSugScore.getAdminUserRecordNum(admin_user_id,type,mobileUserRightRecord.admin_last_update)
-        # aqNum = valAiaq.getAdminRecordNum(admin_user_id,type,mobileUserRightRecord.admin_last_update)
-        # mobileUserRight.setRght(mobileUserRightRecord, 'requested_num', aqNum+aiSugScoreNum)
         MobileUserRight.ai_val_sms(mobileUserRightRecord, admin_user_id, type)
-        #subprocess.run(f'rm -Rf {tmpIdPath}', shell=True)
-def splitThreadData(datas):
-    thred_num = 30
-    #每个线程几条数据
-    long = len(datas)
-    quotient, remainder = divmod(long, thred_num)
-    d = []
-    d2 = []
-    for i in range(0,thred_num):
-        if remainder>0:
-            end = quotient+1
-            remainder = remainder-1
-        else:
-            end = quotient
-        d = datas[0:end]
-        d2.append(d)
-        datas = datas[end:]
-        if len(datas)==0:
-            break
-    return d2
@@ -1,5 +1,6 @@
 import time
-from flask import Blueprint, request, jsonify, session, g
+import json
+from flask import Blueprint, request, jsonify, session, g, Response, stream_with_context
 from models.ai_sug_score.model import AiSugScore  as aiSugScore
 from models.valAiaq import valAiaq
 from datetime import datetime
@@ -11,8 +12,14 @@ from models.upload_files.model import UploadFiles
 import os
 from models.lx_ai_sug_score.model import LxAiSugScore
 from common.aliDocAnalysis import aliDocAnalysis
+from common.docParsePoller import DocParsePoller
+from utils.doc_markdown_builder import DocMarkdownBuilder
 from services.ai_val_service import AiValSrvice
+from services.ai_job_service import AiJobService
 from user.lxAiVal import ai_done_thread
+from conf.config import app_config
+from concurrent.futures import ThreadPoolExecutor
+import queue
 
 api = Blueprint('api', __name__)
 @api.before_request
@@ -48,6 +55,7 @@ def ai_val():
     steps = data['items']
     service_type = data['service_type']
     asy = data['async']
+    stream = data.get('stream', False)
     record_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
     mobile_user_right_record = MobileUserRight.get_one_right(g.admin_user_id, service_type)
     rs,code = mobile_user_right_record.check_request_right(mobile_user_right_record)
@@ -55,8 +63,32 @@ def ai_val():
         return jsonify(rs),200
     MobileUserRight.set_right(mobile_user_right_record, 'requested_num', (mobile_user_right_record.requested_num + 1))
     MobileUserRight.ai_val_sms(mobile_user_right_record, g.admin_user_id, service_type)
+    data["id"] = record_id + str(g.user_id)
+    if stream and not asy:
+        response = Response(stream_with_context(stream_ai_val(data, steps, service_type, mobile_user_right_record)),
+                            mimetype='text/event-stream; charset=utf-8')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Connection'] = 'keep-alive'
+        response.headers['X-Accel-Buffering'] = 'no'  # 禁用反向代理缓冲
+        return response
+    rs = add_api_record(data, steps, service_type, mobile_user_right_record)
+    if rs is not None:
+        return jsonify(rs), 200
+    if asy:
+        AiJobService.enqueue('api_ai_val', [data, service_type], g.admin_user_id)
+        return jsonify({'msg': 'AI评估进行中,请稍后根据record_id发请求查看评估结果', "code": 0, 'items': [],"record_id": data["id"]}), 200
+    else:
+        items, msg = done_ai(data, service_type)
+        code = 1  if items else -1
+        return jsonify({'msg': msg, "code": code, 'items': items, "record_id": data["id"]}), 200
+
+
+def add_api_record(data, steps, service_type, mobile_user_right_record):
+    """
+    图片转存到oss并入库，失败时退回提问次数
+    :return: 成功返回None，失败返回错误信息
+    """
     try:
-        data["id"] = record_id + str(g.user_id)
         if 'email_user_id' in data and "defect_id" in data:
             data['user_id'] = data['email_user_id']
         else:
@@ -72,30 +104,157 @@ def ai_val():
         error_imgs =  error_img1+error_img2+error_img3+error_img4
         if len(error_imgs)>0:
             url_str = ',  '.join(error_imgs)
-            return jsonify({'msg': '你的要评估的内容中的图片url服务器无法访问：'+url_str, "code": -1, 'items': [],"record_id":0}), 200
+            return {'msg': '你的要评估的内容中的图片url服务器无法访问：'+url_str, "code": -1, 'items': [],"record_id":0}
         if (error1+error2+error3+error4)>0:
-            return jsonify({'msg': '数据录入超时，请重新发请求', "code": -1, 'items': [],"record_id":0}), 200
+            return {'msg': '数据录入超时，请重新发请求', "code": -1, 'items': [],"record_id":0}
         urls = url1+url2+url3+url4
+        data['image_num'] = len(urls)
         UploadFiles.bulkInsert(urls, data["id"], g.user_id)
         aiSugScore.add_one(data)
     except Exception as e:
         MobileUserRight.set_right(mobile_user_right_record, 'requested_num', (mobile_user_right_record.requested_num - 1))
-        return jsonify({'msg': '数据处理异常' , "code": -1, 'items': [],"record_id": 0}), 200
-    if asy:
-        thread = threading.Thread(target=done_ai, args=(data, service_type))
-        thread.start()
-        return jsonify({'msg': 'AI评估进行中,请稍后根据record_id发请求查看评估结果', "code": 0, 'items': [],"record_id": data["id"]}), 200
-    else:
-        items, msg = done_ai(data, service_type)
-        code = 1  if items else -1
-        return jsonify({'msg': msg, "code": code, 'items': items, "record_id": data["id"]}), 200
+        return {'msg': '数据处理异常' , "code": -1, 'items': [],"record_id": 0}
+    return None
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
 
+def stream_ai_val(data, steps, service_type, mobile_user_right_record):
+    """
+    同步评估的SSE模式：依次推送 accepted、images、request、step(每个步骤解析完成就推送一条)、done 事件，
+    等待大模型期间每 api_stream_heartbeat 秒推送一次注释行保持连接
+    """
+    yield sse_event('accepted', {'record_id': data['id']})
+    rs = add_api_record(data, steps, service_type, mobile_user_right_record)
+    if rs is not None:
+        yield sse_event('done', rs)
+        return
+    yield sse_event('images', {'record_id': data['id'], 'image_num': data['image_num']})
+    yield sse_event('request', {'record_id': data['id'], 'msg': '大模型评估中'})
+    heartbeat = float(app_config.get('api_stream_heartbeat', 15))
+    steps_queue = queue.Queue()
+    sent = set()
 
-def done_ai(data, service_type):
+    def on_step(step, result):
+        steps_queue.put((step, result['ai_' + step], result[step + '_score']))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(done_ai, data, service_type, on_step)
+        last_time = time.time()
+        while not (future.done() and steps_queue.empty()):
+            try:
+                step, suggestion, score = steps_queue.get(timeout=1)
+            except queue.Empty:
+                if time.time() - last_time >= heartbeat:
+                    yield ": ping\n\n"
+                    last_time = time.time()
+                continue
+            sent.add(step)
+            yield sse_event('step', {'record_id': data['id'], 'step': int(step[4:]), 'suggestion': suggestion, 'score': score})
+            last_time = time.time()
+        items, msg = future.result()
+    for i, item in enumerate(items):
+        if f"step{i + 1}" not in sent:
+            yield sse_event('step', {'record_id': data['id'], 'step': i + 1, 'suggestion': item[0], 'score': item[1]})
+    code = 1 if items else -1
+    yield sse_event('done', {'msg': msg, "code": code, 'items': items, "record_id": data["id"]})
+
+
+@api.route('/ai_val_batch', methods=['POST'])
+def ai_val_batch():
+    """
+    批量评估：一次提交多条记录，统一预占提问次数、一个事务入库，评估任务放入队列异步执行
+    请求：{"token":"","service_type":0,"records":[{"items":[step1,step2,step3,step4]},...]}
+    返回每条记录的record_id，之后用 get_val_results 批量查询结果
+    """
+    data = request.json
+    records = data['records']
+    service_type = data['service_type']
+    max_records = int(app_config.get('api_batch_max_records', 500))
+    if len(records) == 0 or len(records) > max_records:
+        return jsonify({'msg': f'每次提交的记录数量为1~{max_records}条', "code": -1, 'items': []}), 200
+    # 先检查每条记录的格式，格式错误的不预占提问次数
+    items = [None] * len(records)
+    valid = []
+    for i, record in enumerate(records):
+        steps = record.get('items') if isinstance(record, dict) else None
+        if not isinstance(steps, list) or len(steps) != 4 or any(not isinstance(step, str) for step in steps):
+            items[i] = {'msg': 'items必须是4个步骤内容组成的字符串数组', "code": -1, "record_id": 0}
+        else:
+            valid.append(i)
+    if len(valid) == 0:
+        return jsonify({'msg': '没有格式正确的记录', "code": -1, 'items': items}), 200
+    mobile_user_right_record = MobileUserRight.get_one_right(g.admin_user_id, service_type)
+    rs,code = mobile_user_right_record.check_request_right(mobile_user_right_record)
+    if code<0:
+        return jsonify(rs),200
+    if not MobileUserRight.reserve_request_num(mobile_user_right_record, len(valid)):
+        return jsonify({'msg': f'要评估的记录数量为{len(valid)}条，剩余提问次数的为{(mobile_user_right_record.request_num - mobile_user_right_record.requested_num)}次,剩余提问次数不足', "code": -2, 'items': []}), 200
+    datas = []
+    try:
+        MobileUserRight.ai_val_sms(mobile_user_right_record, g.admin_user_id, service_type)
+        record_id = int(datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        with ThreadPoolExecutor(max_workers=int(app_config.get('api_batch_img_workers', 8))) as executor:
+            future_list = [executor.submit(deal_record_images, records[i]['items'], g.user_id) for i in valid]
+            images = [future.result() for future in future_list]
+        urls = {}
+        for i, image in zip(valid, images):
+            record = records[i]
+            steps, step_urls, error, error_imgs = image
+            d = {'id': str(record_id + i) + str(g.user_id), 'type': service_type, 'admin_user_id': g.admin_user_id}
+            if 'email_user_id' in record and "defect_id" in record:
+                d['user_id'] = record['email_user_id']
+                d['defect_id'] = record['defect_id']
+            else:
+                d['user_id'] = g.user_id
+            d['step1'], d['step2'], d['step3'], d['step4'] = steps
+            if len(error_imgs) > 0:
+                items[i] = {'msg': '你的要评估的内容中的图片url服务器无法访问：' + ',  '.join(error_imgs), "code": -1, "record_id": 0}
+            elif error > 0:
+                items[i] = {'msg': '数据录入超时，请重新发请求', "code": -1, "record_id": 0}
+            else:
+                items[i] = {'msg': 'AI评估进行中', "code": 0, "record_id": d['id']}
+                datas.append(d)
+                urls[d['id']] = step_urls
+        aiSugScore.add_batch(datas, urls)
+    except Exception as e:
+        print(f"批量评估入库失败：{e}")
+        datas = []
+        for i in valid:
+            items[i] = {'msg': '数据处理异常', "code": -1, "record_id": 0}
+    refund = len(valid) - len(datas)
+    if refund > 0:
+        mobile_user_right_record = MobileUserRight.get_one_right(g.admin_user_id, service_type)
+        MobileUserRight.set_right(mobile_user_right_record, 'requested_num', (mobile_user_right_record.requested_num - refund))
+    AiJobService.enqueue_many('api_ai_val', [[d, service_type] for d in datas], g.admin_user_id)
+    return jsonify({'msg': f'{len(datas)}条记录AI评估进行中,请稍后根据record_id发请求查看评估结果', "code": 0, 'items': items}), 200
+
+
+def deal_record_images(steps, user_id):
+    from app import app
+    with app.app_context():
+        htmls = []
+        urls = []
+        error = 0
+        error_imgs = []
+        for step in steps[0:4]:
+            html, url, err, error_img = aliOss.dealImgSrc(step, user_id)
+            htmls.append(html)
+            urls = urls + url
+            error = error + err
+            error_imgs = error_imgs + error_img
+        return htmls, urls, error, error_imgs
+
+
+def done_ai(data, service_type, on_step=None):
     from app import app
     with app.app_context():
         try:
-            rs = AiValSrvice.get_score_suggestion(service_type, data)
+            if on_step is not None:
+                rs = AiValSrvice.get_score_suggestion_stream(service_type, data, on_step)
+            else:
+                rs = AiValSrvice.get_score_suggestion(service_type, data)
             aiSugScore.edit_ai(rs)
             return [[rs['ai_step1'], rs['step1_score']], [rs['ai_step2'], rs['step2_score']],
                     [rs['ai_step3'], rs['step3_score']], [rs['ai_step4'], rs['step4_score']]], 'AI评估成功'
@@ -105,38 +264,76 @@ def done_ai(data, service_type):
             return [], "请求超时，请重新发起评估请求"
 
 
+def done_ai_job(data, service_type):
+    """
+    任务队列执行异步评估，异常直接抛出由队列重试，最后一次失败后由 done_ai_failed 处理
+    """
+    from app import app
+    with app.app_context():
+        rs = AiValSrvice.get_score_suggestion(service_type, data)
+        aiSugScore.edit_ai(rs)
+
+
+def done_ai_failed(data, service_type, error_mess=""):
+    """
+    异步评估重试用完后仍失败：记录置为评估失败并退回提问次数
+    """
+    from app import app
+    with app.app_context():
+        aiSugScore.edit_ai_false_state({'user_id': data['user_id'], 'id': data['id'], 'state': -3}, error_mess)
+        mobile_user_right_record = MobileUserRight.get_one_right(data['admin_user_id'], service_type)
+        MobileUserRight.set_right(mobile_user_right_record, 'requested_num', (mobile_user_right_record.requested_num - 1))
+
+
 @api.route('/get_val_result', methods=['GET', 'POST'])
 def getValResult():
     data = request.json
     item = aiSugScore.get_one(g.user_id, data['record_id'])
+    return jsonify(get_val_result_item(item, data['record_id'])), 200
+
+
+@api.route('/get_val_results', methods=['POST'])
+def getValResults():
+    """
+    批量查询评估结果，请求：{"token":"","record_ids":[...]}
+    """
+    data = request.json
+    record_ids = [str(record_id) for record_id in data['record_ids']]
+    max_records = int(app_config.get('api_batch_max_records', 500))
+    if len(record_ids) > max_records:
+        return jsonify({'msg': f'每次最多查询{max_records}条', "code": -1, 'items': []}), 200
+    records = {item.id: item for item in aiSugScore.get_by_ids(g.user_id, record_ids)}
+    items = [get_val_result_item(records.get(record_id), record_id) for record_id in record_ids]
+    return jsonify({'msg': '', "code": 1, 'items': items}), 200
+
+
+def get_val_result_item(item, record_id):
     if item == None:
-        return jsonify({'msg': 'record_id错误', "code": -1, 'items': [], "record_id": data["record_id"]}), 200
+        return {'msg': 'record_id错误', "code": -1, 'items': [], "record_id": record_id}
     if item.state == 0:
         timestamp = int(time.mktime(time.strptime(str(item.create_time), '%Y-%m-%d %H:%M:%S')))
         current_timestamp = time.time()
         if (current_timestamp - timestamp) >= 600:
             mess = "大模型评估超时"
             d = {}
-            d['user_id'] = g.user_id
+            d['user_id'] = item.user_id
+            d['id'] = item.id
             d['state'] = -3
             aiSugScore.edit_ai_false_state(d, mess)
-            return jsonify(
-                {'msg': '系统评估失败，请稍后再重发请求', "code": -1, 'items': [], "record_id": data["id"]}), 200
+            return {'msg': '系统评估失败，请稍后再重发请求', "code": -1, 'items': [], "record_id": record_id}
         else:
-            return jsonify({'msg': 'AI评估进行中,请稍后再根据record_id发请求查看评估结果', "code": 0, 'items': [],
-                            "record_id": data["record_id"]}), 200
+            return {'msg': 'AI评估进行中,请稍后再根据record_id发请求查看评估结果', "code": 0, 'items': [],
+                    "record_id": record_id}
     elif item.state == -3:
-        return jsonify(
-            {'msg': '系统评估失败，请稍后再重发请求', "code": -1, 'items': [], "record_id": data["record_id"]}), 200
+        return {'msg': '系统评估失败，请稍后再重发请求', "code": -1, 'items': [], "record_id": record_id}
     elif item.state == -4:
-        return jsonify(
-            {'msg': '系统评估失败，请联系管理员检查原因', "code": -1, 'items': [], "record_id": data["record_id"]}), 200
+        return {'msg': '系统评估失败，请联系管理员检查原因', "code": -1, 'items': [], "record_id": record_id}
     elif item.state == 1:
         items = [[item.ai_step1, item.step1_score], [item.ai_step2, item.step2_score],
                  [item.ai_step3, item.step3_score], [item.ai_step4, item.step4_score]]
-        return jsonify({'msg': 'AI评估成功', "code": 1, 'items': items, "record_id": data["record_id"]}), 200
+        return {'msg': 'AI评估成功', "code": 1, 'items': items, "record_id": record_id}
     else:
-        return jsonify({'msg': 'record_id错误', "code": -1, 'items': [], "record_id": data["record_id"]}), 200
+        return {'msg': 'record_id错误', "code": -1, 'items': [], "record_id": record_id}
 
 
 @api.route('/ai_question', methods=['POST'])
@@ -233,35 +430,12 @@ def dealLxUploadFileDone(tmpIdPathFile,recordId,user_id):
             id, key = aliDocAnalysis.SubmitDocParserJob(tmpIdPathFile)
         except:
             return jsonify({'msg': '文件上传失败', "code": -1}), 200
-        markDownText = ""
-        page = 1
         perPageNum = 3000
-        lastNumberOfSuccessfulParsing = -1
         try:
-            while (True):
-                d = aliDocAnalysis.QueryDocParserStatus(id)
-                if d['Status'] == 'Fail':
-                    break
-                if lastNumberOfSuccessfulParsing < d['NumberOfSuccessfulParsing']:
-                    lastNumberOfSuccessfulParsing = d['NumberOfSuccessfulParsing']
-                else:
-                    if lastNumberOfSuccessfulParsing== 0 and d['Status']=="success":
-                        break
-                    time.sleep(1)
-                    continue
-                datas = aliDocAnalysis.GetDocParserResult(id, page, perPageNum)
-                if lastNumberOfSuccessfulParsing <= page * perPageNum and d['Status'] == 'success':
-                    for data in datas:
-                        markDownText = markDownText + data['markdownContent']
-                    break
-                elif lastNumberOfSuccessfulParsing <= page * perPageNum and d['Status'] == 'Processing':
-                    time.sleep(1)
-                    continue
-                elif lastNumberOfSuccessfulParsing > page * perPageNum and (
-                        d['Status'] == 'Processing' or d['Status'] == 'success'):
-                    for data in datas:
-                        markDownText = markDownText + data['markdownContent']
-                    page = page + 1
+            builder = DocMarkdownBuilder()
+            for datas in DocParsePoller.pages(id, perPageNum):
+                builder.add_page(datas)
+            markDownText = builder.build()
             LxAiSugScore.saveApiMarkdown(recordId, markDownText, key)
             return ai_done_thread(recordId, user_id)
         except Exception as e:
@@ -1,5 +1,5 @@
 from flask import Blueprint, render_template, request, jsonify, session, g, current_app, redirect, send_file, \
-    after_this_request
+    after_this_request, Response, stream_with_context
 from models.lx_ai_sug_score.model import LxAiSugScore
 from models.doc_files.model import DocFiles
 from models.users.models import MobileUserRight
@@ -11,15 +11,17 @@ from datetime import datetime
 from common.Ai import Ai
 from common.aliOss import aliOss
 from services.lx_ai_val_service import LxAiValSrvice
-from concurrent.futures import ThreadPoolExecutor
+from common.taskGraph import TaskGraph
+from common.scoreStore import ScoreStore
+from conf.config import app_config
 
 import json
 
 from services.upload_file_service import UploadFileService
+from services.ai_job_service import AiJobService
+from common.progressStore import ProgressStore
 
 lxAiVal = Blueprint('lxAiVal', __name__)
-lxStepScoreLock = threading.RLock()
-LxstepScoresThread = {}
 @lxAiVal.before_request
 def before_request():
     g.type = 2
@@ -84,13 +86,17 @@ def upload_doc():
     if extension.lower() not in ['.ppt','.pptx','.doc','.docx','.pdf']:
         return jsonify({'msg': '你上传的文件类型不被允许','code': -1}), 200
     if file:
-        key,url,_ = UploadFileService.upload_files(file,f"{g.user_id}")
+        key,url,file_info = UploadFileService.upload_files(file,f"{g.user_id}")
         data = {'file_name': file.filename}
         record_id = LxAiSugScore.addUploadRec(data, g.user_id, g.admin_user_id, record_id)
-        cache = current_app.extensions.get('cache')
-        cache.setdefault(str(g.user_id) +"upload_state" + str(record_id), "uploading")
-        thread = threading.Thread(target=UploadFileService.lx_deal_markdown, args=(g.user_id, key, cache, record_id))
-        thread.start()
+        UploadFileService.set_progress(g.user_id, record_id, "uploaded")
+        args = [g.user_id, key, record_id, file_info['sha256']]
+        if ProgressStore.get_store().store_type == "memory":
+            # 内存里的进度只有本进程能看到，worker进程解析时写的进度这里查不到，改在本进程的线程里解析
+            thread = threading.Thread(target=lx_upload_parse, args=args)
+            thread.start()
+        else:
+            AiJobService.enqueue('lx_upload_parse', args, g.admin_user_id)
         return jsonify({'msg': '上传成功', 'id': record_id, 'code': 1}), 200
     else:
         return jsonify({'msg': '服务器端错误', 'filename': "", 'code': -100}), 200
@@ -126,11 +132,19 @@ def aiDoneState():
 def get_upload_state():
     return UploadFileService.get_upload_state()
 
+@lxAiVal.route('/upload_state_stream', methods=['GET'])
+def upload_state_stream():
+    """
+    用SSE推送上传解析进度，代替前端每2秒轮询 get_upload_state
+    """
+    record_id = request.values.get('id', 0)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(UploadFileService.stream_upload_state(g.user_id, record_id)), mimetype='text/event-stream', headers=headers)
+
 @lxAiVal.route('/ai_done', methods=['POST', "GET"])
 def ai_done():
     record_id = request.values.get('id', 0)
-    thread = threading.Thread(target=ai_done_thread, args=(record_id, g.user_id))
-    thread.start()
+    AiJobService.enqueue('lx_ai_done', [record_id, g.user_id], g.admin_user_id)
     #return aiDoneThread(id,user_id)
     return jsonify({'msg': 'AI评估中', 'code': 0}), 200
 
@@ -184,8 +198,7 @@ def batchDelete():
 def repeat():
     id = request.values.get('id',0)
     LxAiSugScore.repeat_set_state(id, g.user_id)
-    thread = threading.Thread(target=ai_done_thread, args=(id, g.user_id))
-    thread.start()
+    AiJobService.enqueue('lx_ai_done', [id, g.user_id], g.admin_user_id)
     return  jsonify({'msg': '评估中', 'code': 0}), 200
 
 # @lxAiVal.route("/test", methods=['GET', 'POST'])
@@ -233,12 +246,22 @@ def test():
     # print(a.anti_shake_logs.filter(LxAntiShakeLog.type==102).all())
     #     aiDoneThread(177,76,-3)
     #     return ''
+def lx_upload_parse(user_id, key, record_id, file_hash):
+    """
+    任务队列里解析上传的立项文档，解析进度写入 ProgressStore
+    upload_progress_store=memory 时由 upload_doc 直接在线程里调用，lx_deal_markdown 自带app上下文
+    """
+    UploadFileService.lx_deal_markdown(user_id, key, None, record_id, file_hash)
+
 def ai_done_thread(record_id, user_id, state=-2):
     """
     这个函数api一起调用的
     重新评估的时候state=-3
     调用api的时候state=-2
     选完那两项以后state=-2
+    各步骤按依赖关系放进 TaskGraph 执行：
+    步骤评分(防抖时每次采样一个任务) -> 平均分 -> 二次评定 -> 根据上级得分调整 -> 判定case，
+    总结、脑图和步骤评分并行，评估建议总结在步骤评分之后
     """
     from app import app
     with app.app_context():
@@ -250,83 +273,55 @@ def ai_done_thread(record_id, user_id, state=-2):
         model = LxAiValSrvice.get_lx_model()
         module = model.model.to_dict()
         model = model.to_dict()
-        current_threads = []
-        step_threads = []
+        graph = TaskGraph(f"立项评估{record_id}", int(app_config.get('lx_graph_record_workers', 8)), app.app_context)
+        step_nodes = []
+        step_keys = []
         is_val_score = False
-        lxStepScoreLock.acquire()
-        LxstepScoresThread[str(record_id)] = {}
-        LxstepScoresThread[str(record_id)]['tmp_log'] = ""
-        lxStepScoreLock.release()
+        is_anti_shake = model['anti_shake_status']=="open" and module['key_name']!="xj-qianwen"
+        ScoreStore.get_store().clear(record_id)
         if module['key_name']!= "xj-qianwen":
-            for x in range(1,6):
-                for key,value in LxAiSugScore.drives.items():
-                    data = {'stepNum': key, 'child_type_1': item.select_1, 'child_type_2': item.select_2,'markdown': item.all_markdwon_text}
-                    score = getattr(item,'step_'+key+'_score')
-                    print('score:'+str(score))
-                    if score is None or score==-1:
-                        if key not in  LxstepScoresThread[str(record_id)]:
-                            lxStepScoreLock.acquire()
-                            LxstepScoresThread[str(record_id)][key] = []
-                            lxStepScoreLock.release()
-                        is_val_score = True
-                        thread = threading.Thread(target=get_step, args=(record_id, user_id, data, state, model,module))
-                        step_threads.append(thread)
-                        thread.start()
-                if model['anti_shake_status']=="closed" or module['key_name']== "xj-qianwen":
-                    break
+            config = LxAiValSrvice.get_anti_shake_config()
+            for key,value in LxAiSugScore.drives.items():
+                data = {'stepNum': key, 'child_type_1': item.select_1, 'child_type_2': item.select_2,'markdown': item.all_markdwon_text}
+                score = getattr(item,'step_'+key+'_score')
+                print('score:'+str(score))
+                if score is None or score==-1:
+                    step_keys.append(key)
+                    is_val_score = True
+                    if model['anti_shake_status']=="open":
+                        sample_nodes = [graph.add(f"step_{key}_sample_{i + 1}", get_step_sample, record_id, user_id, data, state, model, module) for i in range(config['min_samples'])]
+                        step_nodes.append(graph.add(f"step_{key}", get_step_samples, record_id, user_id, data, state, model, module, deps=sample_nodes))
+                    else:
+                        step_nodes.append(graph.add(f"step_{key}", get_step_sample, record_id, user_id, data, state, model, module))
         summarize =  getattr(item,'summarize_text')
         if summarize is None or summarize== "":
-            thread = threading.Thread(target=get_summarize, args=(record_id, user_id, item.all_markdwon_text, state))
-            current_threads.append(thread)
-            thread.start()
+            graph.add("summarize", get_summarize, record_id, user_id, item.all_markdwon_text, state)
         xmind_json = getattr(item,'xmind_json')
         if xmind_json is None or xmind_json== "":
-            thread = threading.Thread(target=get_xmind, args=(record_id, user_id, item.all_markdwon_text, state))
-            current_threads.append(thread)
-            thread.start()
-        for thread in step_threads:
-            thread.join()
+            graph.add("xmind", get_xmind, record_id, user_id, item.all_markdwon_text, state)
         if item.summarize_val_sug == "" or item.summarize_val_sug is None:
-            thread = threading.Thread(target=summarize_val_sug, args=(record_id,user_id,state))
-            current_threads.append(thread)
-            thread.start()
+            graph.add("summarize_val_sug", summarize_val_sug, record_id, user_id, state, deps=step_nodes)
+        case_deps = step_nodes
         if is_val_score:
-            step_average_score = {}
-            print(LxstepScoresThread[str(record_id)])
-            content_logs = ""
-            if model['anti_shake_status']=="open" and module['key_name']!="xj-qianwen":
-                for key, value in LxstepScoresThread[str(record_id)].items():  # 如果是repeat的话有可能不是全部执行
-                    if key =="tmp_log":
-                        continue
-                    step_average_score[key] = LxAiValSrvice.get_step_average_score(LxstepScoresThread[str(record_id)][key])
-                    # 获取分数失败
-                    if step_average_score[key] == -1:
-                        LxAiSugScore.set_fail(record_id, user_id, state)
-                        lxStepScoreLock.acquire()
-                        del LxstepScoresThread[str(record_id)]
-                        lxStepScoreLock.release()
-                        return {'msg': 'AI评估失败', 'code': -1}
-                content_logs = "<b>平均分记录入库：</b><br>"
-                content_log = LxAiValSrvice.set_average_score(record_id, user_id, state, step_average_score, LxstepScoresThread)
-                content_logs = content_logs+content_log
-            if model['anti_shake_status']=="closed":
-                content_logs ="防抖已被关闭<br>"
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                # 提交所有任务
-                future_list = [executor.submit(get_twice_score, record_id, user_id, state, step) for step in [2, 3]]
-                # 等待所有任务完成，并获取结果
-                results = [future.result() for future in future_list]
-            content_logs = content_logs + "<b>根据AI评估建议判定是否合格：</b><br>"+";".join(results)+"<br>"
-            content_log = LxAiValSrvice.set_score_by_last_level(record_id, user_id, state)
-            content_logs = content_logs+"<b>根据上级得分是否及格决定下级得分:</b><br>"+content_log
-            lxStepScoreLock.acquire()
-            del LxstepScoresThread[str(record_id)]
-            lxStepScoreLock.release()
-            LxAiValSrvice.add_anti_shake_log(record_id, content_logs)
-        item = LxAiValSrvice.set_case(record_id, user_id, state)
-        print(f"setScoretwice:{item.step_1_score},{item.step_2_score},{item.step_3_score},{item.step_4_score},{item.step_5_score}")
-        for thread in current_threads:
-            thread.join()
+            graph.add("average", set_step_average, record_id, user_id, state, step_keys, is_anti_shake, deps=step_nodes)
+            twice_nodes = [graph.add(f"twice_{step}", get_twice_score, record_id, user_id, state, step, deps=["average"]) for step in [2, 3]]
+            graph.add("last_level", set_last_level, record_id, user_id, state, graph, model['anti_shake_status'], deps=twice_nodes)
+            case_deps = ["last_level"]
+        graph.add("case", LxAiValSrvice.set_case, record_id, user_id, state, deps=case_deps)
+        graph.run()
+        ScoreStore.get_store().clear(record_id)
+        timing_log = graph.get_timing_log()
+        print(f"立项评估{record_id}耗时：{timing_log}")
+        current_app.logger.info_module(f"立项评估{record_id}耗时：{timing_log}", "model")
+        if is_val_score and graph.get_state("average") == TaskGraph.FAILED:
+            return {'msg': 'AI评估失败', 'code': -1}
+        # 评分后续步骤出错时和原来一样抛出，由任务队列重试
+        for name in ["twice_2", "twice_3", "last_level", "case"]:
+            if name in graph.errors:
+                raise graph.errors[name]
+        if graph.get_state("case") == TaskGraph.DONE:
+            item = graph.results["case"]
+            print(f"setScoretwice:{item.step_1_score},{item.step_2_score},{item.step_3_score},{item.step_4_score},{item.step_5_score}")
         return jsonify(LxAiValSrvice.get_total(record_id, user_id, state)),200
 
 def get_step(record_id, user_id, data, state, module,model):
@@ -334,16 +329,76 @@ def get_step(record_id, user_id, data, state, module,model):
     with app.app_context():
         if model['key_name'] !="xj-qianwen":
             aiReturn,_ = Ai.get_lx_content_score_suggestion(2, data,model)
+            score_list = []
             if module['anti_shake_status']=="open":
-                lxStepScoreLock.acquire()
-                LxstepScoresThread[str(record_id)][data['stepNum']].append(int(float(str(aiReturn['step_' + str(data['stepNum']) + '_score']).replace("分",""))))
-                lxStepScoreLock.release()
+                score_list = ScoreStore.get_store().append(record_id, data['stepNum'], int(float(str(aiReturn['step_' + str(data['stepNum']) + '_score']).replace("分",""))))
                 aiReturn['step_'+str(data['stepNum']+'_score')] = None
-            LxAiSugScore.set_step(record_id, user_id, aiReturn, state, len(LxstepScoresThread[str(record_id)][data['stepNum']]))
+            LxAiSugScore.set_step(record_id, user_id, aiReturn, state, len(score_list))
         else:
             return ""
 
 
+def get_step_sample(record_id, user_id, data, state, module, model):
+    """
+    单次步骤评分，失败只记录不抛出，和原来各自独立的线程一样不影响后面的任务
+    """
+    try:
+        get_step(record_id, user_id, data, state, module, model)
+    except Exception as e:
+        print(f"立项步骤评分失败{record_id}-{data['stepNum']}：{e}")
+
+
+def get_step_samples(record_id, user_id, data, state, module, model):
+    """
+    防抖自适应采样：前 min_samples 次采样由任务图并发执行，分数分歧超过容忍度时在这里逐次追加，最多 max_samples 次
+    """
+    config = LxAiValSrvice.get_anti_shake_config()
+    key = data['stepNum']
+    store = ScoreStore.get_store()
+    sample_num = config['min_samples']
+    while sample_num < config['max_samples'] and not LxAiValSrvice.is_scores_converged(store.get(record_id, key), config['tolerance']):
+        sample_num = sample_num + 1
+        get_step_sample(record_id, user_id, data, state, module, model)
+    score_list = store.get(record_id, key)
+    store.append_log(record_id, f"{LxAiSugScore.drives[key]}防抖采样{len(score_list)}次：{LxAiValSrvice.get_stop_rule(score_list, config)}<br>")
+
+
+def set_step_average(record_id, user_id, state, step_keys, is_anti_shake):
+    """
+    防抖打开时把各步骤的多次分数取平均入库，有步骤取平均失败时整条记录判定失败
+    :param step_keys: 本次评分的步骤，如果是repeat的话有可能不是全部执行
+    :return: 平均分日志
+    """
+    if not is_anti_shake:
+        return ""
+    store = ScoreStore.get_store()
+    step_scores = {key: store.get(record_id, key) for key in step_keys}
+    print(step_scores)
+    step_average_score = {}
+    for key, value in step_scores.items():
+        step_average_score[key] = LxAiValSrvice.get_step_average_score(value)
+        # 获取分数失败
+        if step_average_score[key] == -1:
+            LxAiSugScore.set_fail(record_id, user_id, state)
+            raise RuntimeError(f"{LxAiSugScore.drives[key]}获取平均分失败")
+    content_log = LxAiValSrvice.set_average_score(record_id, user_id, state, step_average_score, step_scores)
+    return "<b>平均分记录入库：</b><br>"+content_log+store.get_log(record_id)
+
+
+def set_last_level(record_id, user_id, state, graph, anti_shake_status):
+    """
+    根据上级得分是否及格调整下级得分，并写入防抖日志
+    """
+    content_logs = graph.results.get("average", "")
+    if anti_shake_status=="closed":
+        content_logs ="防抖已被关闭<br>"
+    results = [graph.results[f"twice_{step}"] for step in [2, 3]]
+    content_logs = content_logs + "<b>根据AI评估建议判定是否合格：</b><br>"+";".join(results)+"<br>"
+    content_log = LxAiValSrvice.set_score_by_last_level(record_id, user_id, state)
+    content_logs = content_logs+"<b>根据上级得分是否及格决定下级得分:</b><br>"+content_log
+    LxAiValSrvice.add_anti_shake_log(record_id, content_logs)
+
+
 def get_summarize(record_id, user_id, all_markdwon_text, state):
     from app import app
     with app.app_context():
@@ -0,0 +1,40 @@
+import re
+
+# 阿里云文档解析(DocMind)结果里的图片块
+DOCMIND_IMAGE_RE = re.compile(r'!\[(.*?)\]\((http://docmind-api-cn-hangzhou.oss-cn-hangzhou.aliyuncs.com.+?)\)')
+
+
+class DocMarkdownBuilder():
+    """
+    拼接文档解析结果的markdown：各块先放进列表，全部解析完后一次join，
+    代替逐页逐块的字符串相加(几百页的文档相加是平方级的复制)
+    传入 on_image(src) 时，以DocMind图片开头的块整块换成 on_image 返回的占位符
+
+    用法：
+        builder = DocMarkdownBuilder(on_image)
+        for datas in DocParsePoller.pages(ali_id):
+            builder.add_page(datas)
+        mark_down_text = builder.build()
+    """
+
+    def __init__(self, on_image=None):
+        self.on_image = on_image
+        self.parts = []
+        self.pages = 0
+        self.images = 0
+
+    def add_page(self, datas):
+        self.pages = self.pages + 1
+        match_image = DOCMIND_IMAGE_RE.match
+        append = self.parts.append
+        for data in datas:
+            content = data['markdownContent']
+            if self.on_image is not None:
+                match = match_image(content)
+                if match:
+                    content = self.on_image(match.group(2))
+                    self.images = self.images + 1
+            append(content)
+
+    def build(self):
+        return "".join(self.parts)
@@ -1,4 +1,5 @@
 # utils/file_handler.py
+import hashlib
 import os
 import uuid
 from datetime import datetime
@@ -96,6 +97,15 @@ class FileHandler:
             'mime_type': FileHandler.get_mime_type(filename)
         }
 
+    @staticmethod
+    def get_file_sha256(file_path: str) -> str:
+        """分块计算文件内容的sha256"""
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
     @staticmethod
     def get_mime_type(filename: str) -> str:
         """获取文件的MIME类型"""
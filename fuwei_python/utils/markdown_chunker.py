@@ -0,0 +1,89 @@
+import re
+
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*)$')
+CJK_RE = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算token数：中文字符约一个token，其他字符约四个一个token
+    """
+    if not text:
+        return 0
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_sections(markdown_text: str) -> list:
+    """
+    按标题切分Markdown，代码块里的 # 不当作标题
+    返回 [{'path': 上级标题路径, 'text': 该标题下的内容(含标题行)}]
+    """
+    sections = []
+    stack = []
+    lines = []
+    path = ""
+    in_code = False
+    for line in markdown_text.split("\n"):
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+        match = None if in_code else HEADING_RE.match(line)
+        if match:
+            if lines:
+                sections.append({'path': path, 'text': "\n".join(lines)})
+            level = len(match.group(1))
+            stack = [item for item in stack if item[0] < level]
+            path = " > ".join([item[1] for item in stack])
+            stack.append((level, match.group(2).strip()))
+            lines = [line]
+        else:
+            lines.append(line)
+    if lines and "\n".join(lines).strip():
+        sections.append({'path': path, 'text': "\n".join(lines)})
+    return sections
+
+
+def split_long_text(text: str, max_tokens: int) -> list:
+    """
+    超长的单个章节先按空行分段，单段仍然超长时按字符硬切
+    """
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        if estimate_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        # 按中文一字一token保守切分
+        for i in range(0, len(paragraph), max_tokens):
+            pieces.append(paragraph[i:i + max_tokens])
+    return pieces
+
+
+def chunk_markdown(markdown_text: str, max_tokens: int) -> list:
+    """
+    把Markdown按标题切成不超过 max_tokens 的块，相邻的小章节合并到同一块
+    :return: [{'path': 第一个章节的上级标题路径, 'text': 块内容, 'tokens': 估算token数}]
+    """
+    chunks = []
+    current = {'path': "", 'parts': [], 'tokens': 0}
+
+    def flush():
+        if current['parts']:
+            text = "\n\n".join(current['parts'])
+            chunks.append({'path': current['path'], 'text': text, 'tokens': estimate_tokens(text)})
+        current['parts'] = []
+        current['tokens'] = 0
+
+    for section in split_sections(markdown_text):
+        pieces = [section['text']]
+        if estimate_tokens(section['text']) > max_tokens:
+            pieces = split_long_text(section['text'], max_tokens)
+        for piece in pieces:
+            tokens = estimate_tokens(piece)
+            if current['tokens'] + tokens > max_tokens:
+                flush()
+            if not current['parts']:
+                current['path'] = section['path']
+            current['parts'].append(piece)
+            current['tokens'] = current['tokens'] + tokens
+    flush()
+    return chunks
@@ -0,0 +1,108 @@
+import json
+
+
+class StreamStepParseError(Exception):
+    """流式输出的结构无法恢复，继续接收没有意义"""
+
+
+class StreamStepParser:
+    """
+    增量解析大模型流式输出的评估结果
+    输出格式：{"step1": {"evaluate": "", "suggestion": "", "score": 0}, "step2": {...}, ...}
+    (前后可以有 ```json 之类的文字)，每个步骤的对象一闭合就解析出来，不用等整个回复结束
+
+    用法：
+        parser = StreamStepParser(["step1", "step2", "step3", "step4"])
+        for chunk in chunks:
+            for step, value in parser.feed(chunk):
+                ...
+    """
+    FIELDS = ["evaluate", "suggestion", "score"]
+
+    def __init__(self, steps, max_preamble=4000):
+        self.steps = steps
+        self.max_preamble = max_preamble
+        self.done = {}
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = []
+        self._last_key = None
+        self._pending_key = None
+        self._step_key = None
+        self._step_buf = []
+        self._preamble = 0
+        self._finished = False
+
+    def feed(self, chunk):
+        """
+        :param chunk: 新收到的文本
+        :return: 本次新解析完成的 [(step, {evaluate, suggestion, score})]
+        """
+        completed = []
+        for char in chunk:
+            if self._finished:
+                break
+            if self._depth >= 2:
+                self._step_buf.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = ''.join(self._string)
+                else:
+                    if self._depth == 1:
+                        self._string.append(char)
+                continue
+            if char == '"':
+                if self._depth == 0:
+                    continue
+                self._in_string = True
+                self._string = []
+            elif char == ':':
+                if self._depth == 1:
+                    self._pending_key = self._last_key
+            elif char == '{':
+                self._depth = self._depth + 1
+                if self._depth == 2:
+                    self._step_key = self._pending_key
+                    self._step_buf = ['{']
+            elif char == '}':
+                if self._depth == 0:
+                    continue
+                self._depth = self._depth - 1
+                if self._depth == 1:
+                    step = self.parse_step(self._step_key, ''.join(self._step_buf))
+                    if step is not None:
+                        completed.append(step)
+                elif self._depth == 0:
+                    self._finished = True
+            elif self._depth == 0:
+                self._preamble = self._preamble + 1
+                if self._preamble > self.max_preamble:
+                    raise StreamStepParseError(f"超过{self.max_preamble}个字符仍未开始输出JSON")
+        return completed
+
+    def parse_step(self, key, text):
+        if key not in self.steps or key in self.done:
+            return None
+        try:
+            value = json.loads(text)
+        except ValueError as e:
+            raise StreamStepParseError(f"{key}的JSON格式错误：{e}")
+        for field in self.FIELDS:
+            if field not in value:
+                raise StreamStepParseError(f"{key}缺少{field}字段")
+        try:
+            value['score'] = int(float(str(value['score']).replace("分", "")))
+        except ValueError:
+            raise StreamStepParseError(f"{key}的分数格式错误：{value['score']}")
+        self.done[key] = value
+        return key, value
+
+    def get_missing(self):
+        return [step for step in self.steps if step not in self.done]